@@ -0,0 +1,120 @@
+#! /usr/bin/env python
+
+import asyncio
+import functools
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+import StepMotor
+
+logger = logging.getLogger(__name__)
+
+
+#==============================================================================
+# AsyncStepMotor:
+#==============================================================================
+class AsyncStepMotor(object):
+    '''asyncio counterpart of StepMotor.StepMotor.
+
+    Every call is handed to a single worker thread that owns the serial port,
+    so the event loop never blocks on serial reads or motion waits, and calls
+    reach the controller in the order they were awaited. The wrapped
+    StepMotor is available as .motor.
+
+    Use AsyncStepMotor.open() to create one; it runs the port discovery on
+    the worker thread as well.
+    '''
+    def __init__(self, motor, executor=None):
+        self.motor = motor
+        if executor is None:
+            executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='StepMotor')
+        self._executor = executor
+        self._pending = 0
+
+    @classmethod
+    async def open(cls, *args, **kwargs):
+        '''Create the StepMotor on the worker thread. Arguments are passed
+        through to StepMotor.StepMotor().'''
+        executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='StepMotor')
+        loop = asyncio.get_running_loop()
+        try:
+            motor = await loop.run_in_executor(
+                executor, functools.partial(StepMotor.StepMotor, *args, **kwargs))
+        except BaseException:
+            executor.shutdown(wait=False)
+            raise
+        return cls(motor, executor)
+
+    @property
+    def idle(self):
+        '''True if nothing is running or queued on the worker thread.'''
+        return self._pending == 0
+
+    async def run(self, fn, *args, **kwargs):
+        '''Run fn(*args, **kwargs) on the worker thread and return its result.
+
+        An abort() while fn waits its turn stops it as well, see
+        StepMotor.queued().'''
+        loop = asyncio.get_running_loop()
+        self._pending += 1
+        try:
+            return await loop.run_in_executor(
+                self._executor, functools.partial(
+                    self.motor.queued, self.motor.aborts, fn, *args, **kwargs))
+        finally:
+            self._pending -= 1
+
+    async def send_cmd(self, cmd, timeout=None):
+        return await self.run(self.motor.send_cmd, cmd, timeout)
+
+    async def send_batch(self, cmds, timeout=None):
+        return await self.run(self.motor.send_batch, cmds, timeout)
+
+    async def initialize_drive(self, enable_limits=True, vel=5, accel=10):
+        return await self.run(self.motor.InitializeDrive, enable_limits, vel, accel)
+
+    async def move_degrees(self, deg):
+        return await self.run(self.motor.MoveDegrees, deg)
+
+    async def go_to_degrees(self, deg):
+        return await self.run(self.motor.GoToDegrees, deg)
+
+    async def turn360(self, n=1):
+        return await self.run(self.motor.Turn360, n)
+
+    async def scan(self, deg=360, vel=1, interval=0.05, start=None):
+        return await self.run(self.motor.Scan, deg, vel, interval, start)
+
+    async def go_home(self):
+        return await self.run(self.motor.GoHome)
+
+    async def read_position(self):
+        return await self.run(self.motor.ReadPosition)
+
+    async def set_home(self):
+        return await self.run(self.motor.SetHome)
+
+    async def abort(self, kill=True):
+        '''Emergency stop. Runs beside the worker thread rather than queued
+        behind it, see StepMotor.Abort().'''
+        return await asyncio.to_thread(self.motor.Abort, kill)
+
+    async def wait_for_motion(self, timeout=None, settle_time=None):
+        return await self.run(self.motor.WaitForMotion, timeout, settle_time)
+
+    async def finish(self):
+        await self.go_to_degrees(0)
+        await self.close()
+
+    async def close(self):
+        '''Close the serial port and stop the worker thread.'''
+        try:
+            await self.run(self.motor.close)
+        finally:
+            self._executor.shutdown(wait=False)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
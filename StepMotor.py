@@ -1,11 +1,25 @@
 #! /usr/bin/env python
 
-import sys
+import os
+import json
 import serial
 import serial.tools.list_ports
 import re
 import time
 import logging
+import functools
+import collections
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import numpy as np
+
+import journal
+import metrics
+from clock import SYSTEM_CLOCK
+from journal import Journal, port_prefix
+from replay import RecordingPort
+from motion_model import MotionModel
 
 logger = logging.getLogger(__name__)
 
@@ -14,8 +28,143 @@ RESP_TERM = '\r\n> '
 RESP_UNDEF = '\r\n? '
 RESP_PROG = '\r\n- '  # In the middle of a program definition.
 
+# The same prompts as bytes, for matching against the raw serial stream.
+PROMPTS = (RESP_TERM.encode(), RESP_UNDEF.encode(), RESP_PROG.encode())
+
+# Where we keep state between runs, e.g. which port the controller was on.
+STATE_DIR = os.path.expanduser('~/.rotation_table')
+PORT_CACHE = os.path.join(STATE_DIR, 'port.json')
+JOURNAL_DIR = os.path.join(STATE_DIR, 'journal')
+
+# Software travel limits (steps) set by InitializeDrive(), to keep the
+# cables from winding up too far either way.
+LSPOS_STEPS = 1000000
+LSNEG_STEPS = -990000
+
+# Homing setup sent before every HOM0.
+HOME_PARAMS = [
+    'MC0',
+    'HOMA10',
+    'HOMV7',
+    'HOMVF.3',
+    'HOMBAC1',
+    'HOMDF1',
+    'HOMEDG0',
+]
+
+# Largest burst send_batch writes before waiting for the replies.
+BATCH_MAX_BYTES = 128
+
+# Settings StepMotor keeps a shadow copy of, so it can skip commands that
+# wouldn't change anything. Longest first so e.g. LSPOS isn't read as LS.
+# The controller takes e.g. "DRES 25000" and "dres25000" as DRES25000, and
+# so does SHADOW_RE, on the upper cased command.
+SHADOWED = sorted([
+    'A', 'AD', 'D', 'DMODE', 'DRES', 'DRIVE', 'ECHO', 'LS', 'LSNEG', 'LSPOS',
+    'MA', 'MC', 'V',
+    'HOMA', 'HOMBAC', 'HOMDF', 'HOMEDG', 'HOMV', 'HOMVF',
+], key=len, reverse=True)
+SHADOW_RE = re.compile(r'\s*(' + '|'.join(SHADOWED) + r')\s*([-+]?\d*\.?\d+)\s*')
+
+# After these the controller state is unknown and the shadow is dropped.
+RESYNC_CMDS = ('RESET', 'RFS', 'RUN', 'K', '!K', 'S', '!S')
+
+# A command the GT6 doesn't know. Its reply tells us which prompt is the
+# newest, see probe_port() and Resync().
+SYNC_CMD = 'xxx'
+SYNC_REPLY = '*UNDEFINED_LABEL'
+
+# Reply to the immediate !TPC, which comes at once, even mid move, and on
+# a line of its own rather than with a prompt.
+TPC_REPORT_RE = re.compile(rb'\*TPC([-+]?\d+)\r\n')
+TPE_REPORT_RE = re.compile(rb'\*TPE([-+]?\d+)\r\n')
+
+# TAS answers with 32 status bits, bit 1 first, e.g. *TAS0000_0000_...
+# Bit 1 is set while the motor is moving.
+TAS_MOVING = 1
+
+# Timeout for a move: MOVE_TIMEOUT_FACTOR times the time the motion model
+# predicts, plus MOVE_TIMEOUT_MARGIN seconds. Moves that take longer than
+# DRAG_FACTOR times the prediction plus DRAG_MARGIN seconds are logged as a
+# sign of mechanical drag.
+MOVE_TIMEOUT_FACTOR = 2.0
+MOVE_TIMEOUT_MARGIN = 5.0
+DRAG_FACTOR = 1.25
+DRAG_MARGIN = 1.0
+
+# Command name for the metrics: the leading letters, e.g. D for D-4500.
+OPCODE_RE = re.compile(r'!?[A-Za-z]*')
+
+# Health of the serial link and the drive, served as /metrics by the web
+# app (see metrics.py). Everything but the probes is labelled by port.
+CMD_SECONDS = metrics.Histogram(
+    'gt6_command_seconds', 'Time from sending a command to its prompt',
+    ('opcode', 'port'))
+CMD_ERRORS = metrics.Counter(
+    'gt6_command_errors_total', 'Commands the controller rejected (kind="undefined") '
+    'or never answered (kind="timeout")', ('opcode', 'port', 'kind'))
+BYTES_SENT = metrics.Counter(
+    'gt6_bytes_sent_total', 'Bytes written to the controller', ('port',))
+BYTES_RECEIVED = metrics.Counter(
+    'gt6_bytes_received_total', 'Bytes read from the controller', ('port',))
+MOVES = metrics.Counter(
+    'gt6_moves_total', 'Moves made, by operation', ('operation', 'port'))
+MOVE_DEGREES = metrics.Counter(
+    'gt6_move_degrees_total', 'Degrees travelled by the moves of known length', ('port',))
+MOVE_OVERRUN = metrics.Histogram(
+    'gt6_move_overrun_ratio', 'Time a move took over the motion model prediction',
+    ('port',), (0.9, 1.0, 1.05, 1.1, 1.25, 1.5, 2.0, 3.0))
+ABORTS = metrics.Counter(
+    'gt6_aborts_total', 'Emergency stops sent', ('port',))
+RESYNCS = metrics.Counter(
+    'gt6_resyncs_total', 'Resynchronisations with the controller', ('port',))
+PROBES = metrics.Counter(
+    'gt6_port_probes_total', 'Serial ports probed for a controller, by outcome',
+    ('result',))
+DISCOVERIES = metrics.Counter(
+    'gt6_discoveries_total', 'Searches for the controller, by how it was found '
+    '(cached, scanned or none)', ('result',))
+
 class StepMotorError(Exception): pass
 class StepMotorNoDevice(StepMotorError): pass
+class StepMotorTimeout(StepMotorError): pass
+class StepMotorAborted(StepMotorError): pass
+
+
+def parse_bits(resp, name='TAS'):
+    '''Return the bit string of a status report such as TAS, bit 1 first,
+    or None if the reply doesn't contain one.'''
+    m = re.search(r'\*' + name + r'([01_]+)', resp)
+    if not m:
+        return None
+    return m.group(1).replace('_', '')
+
+def parse_position(resp, name='TPE'):
+    '''Return the integer position from a TPE/TPC reply, or None.'''
+    m = re.search(r'\*' + name + r'([-+]?\d+)', resp)
+    if not m:
+        return None
+    return int(m.group(1))
+
+def bits_to_int(bits):
+    '''Pack a bit string from parse_bits() into an int, bit 1 as the LSB.'''
+    return int(bits[::-1], 2) if bits else 0
+
+def axis_moving(resp):
+    '''True if a TAS reply says the axis is moving.'''
+    bits = parse_bits(resp)
+    return bool(bits) and bits[TAS_MOVING - 1] == '1'
+
+def read_script(fname):
+    '''The commands of a GT6 script (.prg) file: everything after a ';' is
+    a comment, blank lines are skipped and each line is one command.'''
+    cmds = []
+    with open(fname) as f:
+        for line in f:
+            cmd = line.split(';')[0].strip()
+            if cmd:
+                cmds.append(cmd)
+    return cmds
 
 
 # Some debugging commands for the Parker GT6 Gemini Stepper controller:
@@ -24,7 +173,322 @@ class StepMotorNoDevice(StepMotorError): pass
 # *CLS
 # *TST
 #
-# Connection to the stepper is typically 8-N-1 9600 Baud
+# Connection to the stepper is typically 8-N-1 9600 Baud. The controller
+# starts at DEFAULT_BAUDRATE; BAUD switches it to any of BAUDRATES, fastest
+# first. StepMotor switches to the fastest one after connecting, and the
+# port cache remembers the rate in case the controller keeps it.
+DEFAULT_BAUDRATE = 9600
+BAUDRATES = (19200, 9600)
+
+#==============================================================================
+# FrameReader:
+#==============================================================================
+class FrameReader(object):
+    '''Split the byte stream from the GT6 into prompt terminated frames.
+
+    Whatever the port has buffered is read in one go into a reusable
+    bytearray, and the search for the next prompt resumes where the previous
+    search stopped, so each received byte is only looked at once.
+    '''
+    def __init__(self, port, max_chunk=4096, abort=None, on_read=None,
+                 clock=SYSTEM_CLOCK):
+        self.port = port
+        self.max_chunk = max_chunk
+        # Deadlines are clock.monotonic() values, see clock.py.
+        self.clock = clock
+        # threading.Event; once set, waiting for a frame raises StepMotorAborted.
+        self.abort = abort
+        # Called with the number of bytes of every chunk read.
+        self.on_read = on_read
+        self.buf = bytearray()
+        self._scan = 0          # Where to resume looking for a prompt.
+
+    def _find_prompt(self):
+        '''Return the index just past the first complete prompt, or -1.'''
+        buf = self.buf
+        i = buf.find(b'\r\n', self._scan)
+        while i >= 0 and i + 4 <= len(buf):
+            if buf[i:i+4] in PROMPTS:
+                return i + 4
+            i = buf.find(b'\r\n', i + 1)
+        # A prompt is 4 bytes, so a partial one can only start in the last 3.
+        self._scan = max(len(buf) - 3, 0)
+        return -1
+
+    def _fill(self):
+        '''Read whatever is waiting (at least one byte, or until the port
+        timeout) and append it to the buffer.'''
+        n = min(max(self.port.in_waiting, 1), self.max_chunk)
+        chunk = self.port.read(n)
+        if chunk:
+            self.buf += chunk
+            if self.on_read:
+                self.on_read(len(chunk))
+        return len(chunk)
+
+    def read_frame(self, deadline=None):
+        '''Return the next reply, up to and including its prompt, as a str.
+
+        deadline is a self.clock.monotonic() value. StepMotorTimeout is
+        raised if no complete frame has arrived by then, StepMotorAborted if the abort
+        event is set while waiting.
+        '''
+        while True:
+            end = self._find_prompt()
+            if end >= 0:
+                frame = self.buf[:end].decode('ascii', errors='replace')
+                del self.buf[:end]
+                self._scan = 0
+                return frame
+            if deadline is not None and self.clock.monotonic() > deadline:
+                raise StepMotorTimeout(
+                    f'No prompt from controller, have {bytes(self.buf)!r}')
+            if self.abort is not None and self.abort.is_set():
+                raise StepMotorAborted('Aborted while waiting for the controller')
+            self._fill()
+
+    def read_report(self, regex, deadline=None):
+        '''Take the first complete report matching regex (bytes) out of the
+        stream and return its groups. Frames around it are left in place.
+        For immediate commands such as !TPC, which answer without a prompt
+        while an earlier command is still waiting for its own.'''
+        while True:
+            m = regex.search(self.buf)
+            if m:
+                groups = m.groups()
+                del self.buf[m.start():m.end()]
+                self._scan = 0
+                return groups
+            if deadline is not None and self.clock.monotonic() > deadline:
+                raise StepMotorTimeout(
+                    f'No report from controller, have {bytes(self.buf)!r}')
+            if self.abort is not None and self.abort.is_set():
+                raise StepMotorAborted('Aborted while waiting for the controller')
+            self._fill()
+
+    def frame_ready(self):
+        '''True if a complete frame is buffered.'''
+        return self._find_prompt() >= 0
+
+    def read_frames(self, n, deadline=None):
+        '''Return the next n replies as a list.'''
+        return [self.read_frame(deadline) for _ in range(n)]
+
+    def reset(self):
+        '''Drop anything buffered, e.g. after a timeout left us out of sync.'''
+        self.buf.clear()
+        self._scan = 0
+
+
+#==============================================================================
+# Port discovery:
+#==============================================================================
+def candidate_ports():
+    '''Return the ListPortInfo of every USB serial adapter on the host.'''
+    ports = []
+    for info in sorted(serial.tools.list_ports.comports()):
+        logger.debug('device=%s hwid=%s', info.device, info.hwid)
+        if 'usbserial' in info.device or 'ttyUSB' in info.device:
+            ports.append(info)
+    return ports
+
+def baudrates_to_try(first=None):
+    '''The rates to probe for the controller at: first (e.g. the one that
+    worked last time), then the power up default, then the others.'''
+    rates = [first] if first else []
+    return rates + [r for r in (DEFAULT_BAUDRATE,) + BAUDRATES if r not in rates]
+
+def probe_port(device, baudrate=None, timeout=0.5, rate_timeout=0.1):
+    '''Open device and check that a GT6 answers on it.
+
+    Sends a bogus command, which the controller answers with
+    *UNDEFINED_LABEL. baudrate is a rate or a list of rates to try in turn
+    (default baudrates_to_try()). The first rate, the one most likely to
+    work, is given timeout seconds to answer, the others rate_timeout
+    each, so a port with nothing on it isn't waited on for long. Returns
+    the open port, set to the rate that worked, or None if nothing (or
+    something else) answered at any of them.
+    '''
+    if baudrate is None:
+        rates = baudrates_to_try()
+    else:
+        rates = [baudrate] if isinstance(baudrate, int) else list(baudrate)
+    logger.info(f'Trying serial port: {device}')
+    try:
+        port = serial.Serial(device, baudrate=rates[0], timeout=0.1)
+    except serial.SerialException as exc:
+        logger.info(f'dev={device}: {exc}')
+        PROBES.labels('open_failed').inc()
+        return None
+    for i, rate in enumerate(rates):
+        try:
+            port.baudrate = rate
+            port.reset_input_buffer()
+            if sync_port(port, timeout if i == 0 else rate_timeout):
+                PROBES.labels('answered').inc()
+                return port
+        except serial.SerialException as exc:
+            logger.info(f'dev={device}: {exc}')
+            break
+        logger.info(f'dev={device}: no controller at {rate} baud')
+    PROBES.labels('silent').inc()
+    port.close()
+    return None
+
+def sync_port(port, timeout=0.5):
+    '''Send SYNC_CMD and wait for its reply. True if it came in time.'''
+    logger.debug('SEND: %s', SYNC_CMD)
+    port.write(f'{SYNC_CMD}\n'.encode())
+    reader = FrameReader(port)
+    deadline = time.monotonic() + timeout
+    try:
+        while True:
+            # There may be a stale prompt or two ahead of our answer.
+            resp = reader.read_frame(deadline)
+            logger.debug('RESP: %r', resp)
+            if SYNC_REPLY in resp:
+                return True
+    except StepMotorTimeout:
+        return False
+
+def find_controller(devices, baudrate=None):
+    '''Probe all devices at once and return the open port of the first one
+    that answers, or None. Ports that answer later are closed again.'''
+    if not devices:
+        return None
+    found = None
+    pool = ThreadPoolExecutor(max_workers=len(devices), thread_name_prefix='probe')
+    futures = [pool.submit(probe_port, dev, baudrate) for dev in devices]
+    for fut in as_completed(futures):
+        found = fut.result()
+        if found:
+            break
+    # Don't wait for the stragglers, just close whatever they open.
+    for fut in futures:
+        if found and fut.done() and fut.result() is found:
+            continue
+        fut.add_done_callback(_close_probe)
+    pool.shutdown(wait=False)
+    return found
+
+def find_controllers(devices, baudrate=None):
+    '''Probe all devices at once and return the ones a controller answers
+    on, in the order given. The ports are closed again.'''
+    if not devices:
+        return []
+    with ThreadPoolExecutor(max_workers=len(devices), thread_name_prefix='probe') as pool:
+        ports = list(pool.map(functools.partial(probe_port, baudrate=baudrate), devices))
+    found = []
+    for device, port in zip(devices, ports):
+        if port:
+            port.close()
+            found.append(device)
+    return found
+
+def _close_probe(fut):
+    port = fut.result()
+    if port:
+        port.close()
+
+def load_port_cache(fname=PORT_CACHE):
+    try:
+        with open(fname) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def save_port_cache(info, fname=PORT_CACHE, **extra):
+    '''Remember the ListPortInfo of the port the controller answered on.
+    info may also be a dict, e.g. an updated load_port_cache().'''
+    if isinstance(info, dict):
+        cache = dict(info, **extra)
+    else:
+        cache = dict(device=info.device, hwid=info.hwid,
+                     serial_number=info.serial_number, **extra)
+    try:
+        os.makedirs(os.path.dirname(fname), exist_ok=True)
+        with open(fname, 'w') as f:
+            json.dump(cache, f, indent=2)
+    except OSError as exc:
+        logger.warning(f'Could not save {fname}: {exc}')
+
+def cached_port(ports, cache):
+    '''Pick the port from ports that matches the cache. The USB serial number
+    is preferred since device names can change between plug-ins.'''
+    for key in ('serial_number', 'hwid', 'device'):
+        if cache.get(key):
+            for info in ports:
+                if getattr(info, key) == cache[key]:
+                    return info
+    return None
+
+
+#==============================================================================
+# ScanTrack:
+#==============================================================================
+class ScanTrack(object):
+    '''Table angle against time, as recorded by StepMotor.Scan().
+
+    t holds time.time() seconds, deg the table angle in degrees (absolute,
+    so it runs past 360 on a full turn) and steps the TPC reading each came
+    from. Each reading is stamped with the midpoint of its request and
+    reply; latency is how long that round trip took.
+    '''
+    def __init__(self, t, deg, steps, latency):
+        self.t = np.asarray(t, dtype=float)
+        self.deg = np.asarray(deg, dtype=float)
+        self.steps = np.asarray(steps, dtype=np.int64)
+        self.latency = np.asarray(latency, dtype=float)
+
+    def __len__(self):
+        return len(self.t)
+
+    def heading_at(self, t):
+        '''Table angle at time.time() values t (array ok), interpolated
+        linearly; NaN outside the scan.'''
+        return np.interp(t, self.t, self.deg, left=np.nan, right=np.nan)
+
+    def save(self, fname):
+        '''Write the track as CSV: time, degrees, steps.'''
+        np.savetxt(fname, np.column_stack((self.t, self.deg, self.steps)),
+                   fmt=['%.6f', '%.5f', '%d'], delimiter=',', header='time,degrees,steps')
+
+    @classmethod
+    def load(cls, fname):
+        '''Read a track written by save(). The latencies aren't saved, so
+        they come back as zeros.'''
+        data = np.loadtxt(fname, delimiter=',', ndmin=2)
+        return cls(data[:, 0], data[:, 1], data[:, 2], np.zeros(len(data)))
+
+
+def operation(fn):
+    '''Decorator for the high level StepMotor methods: the commands they
+    send are journaled under their name. Nested calls keep the outer name.
+
+    An operation cut short by Abort() resynchronises with the controller
+    before StepMotorAborted is passed on. So does one called through
+    StepMotor.queued() that was aborted before it got to start.'''
+    @functools.wraps(fn)
+    def wrapper(self, *args, **kwargs):
+        if self.operation:
+            return fn(self, *args, **kwargs)
+        self.operation = fn.__name__
+        since, self._queued_at = self._queued_at, None
+        # Only clear the flag before looking at the count: an Abort() from
+        # here on either sets the flag again or shows in the count.
+        self._abort.clear()
+        try:
+            if since is not None and self.aborts != since:
+                raise StepMotorAborted('Aborted before it started')
+            return fn(self, *args, **kwargs)
+        except StepMotorAborted:
+            self._abort.clear()
+            self.Resync()
+            raise
+        finally:
+            self.operation = ''
+    return wrapper
+
 
 #==============================================================================
 # StepMotor:
@@ -33,185 +497,770 @@ class StepMotor(object):
     def __init__(self,
                  spname=None,
                  steps_per_rotation=900000,
-                 post_move_sleep=1,
+                 post_move_sleep=0,
+                 cmd_timeout=120,
+                 settle_time=0.05,
+                 poll_min=0.01,
+                 poll_max=0.25,
+                 keep_drive_enabled=False,
+                 journal=True,
+                 baudrate=BAUDRATES[0],
+                 clock=SYSTEM_CLOCK,
+                 record=None,
     ):
         self.serialport = None
+        # Everything that tells the time or waits goes through this, so a
+        # replay (see replay.py) can run on a VirtualClock.
+        self.clock = clock
+        self.reader = None
         self.steps_per_rotation = steps_per_rotation
         self.post_move_sleep = post_move_sleep
+        # Longest we wait for a prompt. The reply to GO only comes once the
+        # move is done, so this has to cover the slowest move we make.
+        self.cmd_timeout = cmd_timeout
+        # See WaitForMotion()
+        self.settle_time = settle_time
+        self.poll_min = poll_min
+        self.poll_max = poll_max
+        # Leave the drive enabled between moves, which saves the DRIVE0 and
+        # DRIVE1 round trips around each one.
+        self.keep_drive_enabled = keep_drive_enabled
+        # Last value sent for each of SHADOWED, see send_batch(elide=True).
+        self.shadow = {}
+        # Position (steps) last read back from the controller, if known.
+        self.position = None
+        # (predicted, actual) seconds of the last move, see _move().
+        self.last_move = None
+        # If set, called as on_position(time, tpc, tpe) with the position
+        # read every position_interval seconds during a move, on the thread
+        # making the move. See telemetry.py.
+        self.on_position = None
+        self.position_interval = 0.1
+        # Commands rejected or not answered on this connection, by kind as
+        # in CMD_ERRORS.
+        self.errors = {'undefined': 0, 'timeout': 0}
+        # Binary record of every exchange (see journal.py), and the name of
+        # the high level operation currently sending commands.
+        self.journal = None
+        self.operation = ''
+        # Set by Abort() to break off the running operation. Writes go through
+        # the lock, since Abort() writes from whatever thread it is called on.
+        self._abort = threading.Event()
+        self._write_lock = threading.Lock()
+        # Number of Abort() calls so far, and what it was when the call
+        # now starting was queued, see queued().
+        self.aborts = 0
+        self._queued_at = None
         if spname == 'dryrun':
-            splist = []
+            pass
+        elif spname is not None and not isinstance(spname, str):
+            # An open port object, e.g. a replay.ReplayPort.
+            self.serialport = spname
+            spname = getattr(spname, 'port', None) or type(spname).__name__
+        elif spname is None:
+            self.serialport = self.discover()
+            spname = self.serialport.port
         else:
-            if spname is None:
-                splist = list(self.get_serial_ports())
-            else:
-                splist = [ spname ]
-            for spname in splist:
-                try:
-                    logger.info('Trying serial port: {}'.format(spname))
-                    self.serialport = serial.Serial(spname, baudrate=9600, timeout=0.1)
-
-                    # See if we get a prompt from the serial port sending a bogus command
-                    # and read everything in the buffer until we timeout.  If we don't get
-                    # the undefined label response, go to the next serial port and try
-                    # again.
-                    msg = 'xxx\n'
-                    logging.debug(f"SEND: {msg.strip()}")
-                    self.serialport.write(msg.encode())
-                    resp = self.serialport.read(128).decode()
-                    logger.debug(f'RESP: {resp.strip()}')
-                    if '*UNDEFINED_LABEL' not in resp:
-                        continue
-                    break
-                except serial.SerialException as exc:
-                    logger.info('dev={}: {}'.format(spname, exc))
-                else:
-                  raise StepMotorNoDevice('No Serial Device Found')
+            cache = load_port_cache()
+            last = cache.get('baudrate') if cache.get('device') == spname else None
+            self.serialport = probe_port(spname, baudrates_to_try(last))
+            if not self.serialport:
+                raise StepMotorNoDevice(f'No controller answering on {spname}')
+
+        # Metrics children for this port, see the module level metrics.
+        self.port_label = spname
+        self._bytes_sent = BYTES_SENT.labels(spname)
+        self._bytes_received = BYTES_RECEIVED.labels(spname)
+        self._cmd_seconds = {}          # opcode -> CMD_SECONDS child
 
         if self.serialport:
             self.serialport.flushInput()                # flush input buffer
             self.serialport.flushOutput()               # flush output buffer
+            # record: a file to capture the serial traffic in, see replay.py.
+            if record:
+                self.serialport = RecordingPort(self.serialport, record, clock)
+            self.reader = FrameReader(self.serialport, abort=self._abort,
+                                      on_read=self._bytes_received.inc,
+                                      clock=clock)
+            # journal: True for the default place, a directory, or a Journal.
+            if journal is True:
+                journal = JOURNAL_DIR
+            if isinstance(journal, str):
+                journal = Journal(journal, prefix=port_prefix(spname))
+            self.journal = journal or None
+            # baudrate: the rate to switch the link to, None to leave it.
+            if baudrate and baudrate != self.serialport.baudrate:
+                try:
+                    self.SetBaudRate(baudrate)
+                except StepMotorError:
+                    self.close()
+                    raise
+            self.remember_baudrate()
         logger.info('Using serial port: {}'.format(spname))
 
+    def discover(self, cache_file=PORT_CACHE):
+        '''Find the controller among the USB serial ports and return it open.
+
+        The port that worked last time (see PORT_CACHE) is tried first. If
+        that fails all candidates are probed in parallel, and the winner is
+        cached for next time.
+        '''
+        ports = candidate_ports()
+        cache = load_port_cache(cache_file)
+        info = cached_port(ports, cache)
+        rates = baudrates_to_try(cache.get('baudrate'))
+        if info:
+            port = probe_port(info.device, rates)
+            if port:
+                DISCOVERIES.labels('cached').inc()
+                return port
+            logger.info(f'Cached port {info.device} did not answer, scanning')
+        port = find_controller([p.device for p in ports], rates)
+        if not port:
+            DISCOVERIES.labels('none').inc()
+            raise StepMotorNoDevice('No Serial Device Found')
+        DISCOVERIES.labels('scanned').inc()
+        for info in ports:
+            if info.device == port.port:
+                save_port_cache(info, cache_file, baudrate=port.baudrate)
+        return port
+
+    def remember_baudrate(self, cache_file=PORT_CACHE):
+        '''Note the current rate in the port cache, if the cache is about
+        this port, so the next connection tries it first.'''
+        cache = load_port_cache(cache_file)
+        if cache.get('device') == self.serialport.port and \
+                cache.get('baudrate') != self.serialport.baudrate:
+            save_port_cache(cache, cache_file, baudrate=self.serialport.baudrate)
+
     def get_serial_ports(self):
-        # Starting with serial version 3.0.1? list_ports.comports() returns an
-        # object. Older versions return a list of tuples.
-        #logging.info(f'{serial.VERSION=}')
-        if '3' in serial.VERSION[0]:
-            p = serial.tools.list_ports.comports()
-            for port, desc, hwid in sorted(p):
-                logging.info(f'{port=}')
-                #logging.debug(f"{port=} {desc=} {hwid=}")
-                #if p.subsystem in ('pnp', 'usb-serial'):
-                #    yield p.device
-                if 'usbserial' in port:
-                  print(f'Found {port}')
-                  yield port
-                if 'ttyUSB' in port:
-                  print(f'Found {port}')
-                  yield port
-        #else:
-        #    for p in serial.tools.list_ports.comports():
-        #        if 'USB' in p[0]:
-        #            yield p[0]
-
-    def send_cmd(self, cmd):
+        for info in candidate_ports():
+            yield info.device
+
+    def send_cmd(self, cmd, timeout=None):
+        '''Send a command and return the reply, including the trailing prompt.
+
+        Raises StepMotorTimeout if the controller hasn't prompted within
+        timeout seconds (default self.cmd_timeout).
+        '''
+        cmd = cmd.strip()
+        t_send = self.clock.monotonic()
+        self.write_cmd(cmd)
+        resp = ''
+        if self.serialport:
+            try:
+                resp = self.read_reply(timeout)
+            except StepMotorTimeout:
+                self._reply(cmd, t_send, '', journal.TIMEOUT)
+                raise
+        self._reply(cmd, t_send, resp)
+        return resp
+
+    def write_cmd(self, cmd):
+        '''Send a command without waiting for its reply. Collect the reply
+        later with read_reply().'''
         msg = '{}\n'.format(cmd.strip())
-        logger.debug(f"SEND: {msg.strip()}")
+        logger.debug('SEND: %s', cmd)
+        words = msg.upper().split()
+        if words and words[0] in RESYNC_CMDS:
+            self.Invalidate()
         if self.serialport:
-            self.serialport.write(msg.encode())
+            self._write(msg.encode())
 
-        resp = ''
+    def _write(self, data):
+        with self._write_lock:
+            self.serialport.write(data)
+        self._bytes_sent.inc(len(data))
+
+    def send_stream(self, cmds, timeout=None, window=BATCH_MAX_BYTES):
+        '''Send many commands and return their replies, like send_batch(),
+        but as a sliding window: a new command goes out as soon as the
+        replies that have come in leave room for it, so the line never
+        idles while a burst is answered. At most window bytes of commands
+        are waiting for replies at any time, which keeps the controller's
+        input buffer from overflowing.'''
+        cmds = [cmd.strip() for cmd in cmds]
+        if not self.serialport:
+            return self.send_batch(cmds, timeout)
+        replies = []
+        pending = collections.deque()           # (command, bytes, t_send)
+        outstanding = 0                         # Bytes sent but not answered
+        i = 0
+        while len(replies) < len(cmds):
+            burst = []
+            size = outstanding
+            while i < len(cmds):
+                n = len(cmds[i]) + 1
+                if (pending or burst) and size + n > window:
+                    break
+                burst.append(cmds[i])
+                size += n
+                i += 1
+            if burst:
+                for cmd in burst:
+                    logger.debug('SEND: %s', cmd)
+                    if cmd.upper().split()[0] in RESYNC_CMDS:
+                        self.Invalidate()
+                t_send = self.clock.monotonic()
+                self._write(''.join(f'{cmd}\n' for cmd in burst).encode())
+                pending.extend((cmd, len(cmd) + 1, t_send) for cmd in burst)
+                outstanding = size
+            cmd, n, t_send = pending.popleft()
+            try:
+                resp = self.read_reply(timeout)
+            except StepMotorTimeout:
+                self._reply(cmd, t_send, '', journal.TIMEOUT)
+                raise
+            outstanding -= n
+            if resp.endswith(RESP_UNDEF):
+                logger.warning(f'Controller rejected {cmd!r}: {resp.strip()}')
+            self._reply(cmd, t_send, resp)
+            replies.append(resp)
+        return replies
+
+    def send_batch(self, cmds, timeout=None, elide=False):
+        '''Send several commands back to back and return their replies.
+
+        The commands go out as one burst, each on its own line, so the
+        controller answers every one with its own prompt and the replies can
+        be matched up with the commands afterwards. The bursts are kept under
+        BATCH_MAX_BYTES so the controller's input buffer can't overflow.
+        timeout applies to each reply, as for send_cmd.
+
+        With elide=True, commands that would set a SHADOWED setting to the
+        value it already has are not sent; their reply is ''.
+        '''
+        cmds = [cmd.strip() for cmd in cmds]
+        replies = [''] * len(cmds)
+        todo = list(range(len(cmds)))
+        if elide:
+            todo = self._elide(cmds)
+        if not self.serialport:
+            for i in todo:
+                self.write_cmd(cmds[i])
+                self._reply(cmds[i], self.clock.monotonic(), '')
+            return replies
+
+        start = 0
+        while start < len(todo):
+            end = start
+            msg = b''
+            while end < len(todo):
+                line = f'{cmds[todo[end]]}\n'.encode()
+                if msg and len(msg) + len(line) > BATCH_MAX_BYTES:
+                    break
+                msg += line
+                end += 1
+            for i in todo[start:end]:
+                logger.debug('SEND: %s', cmds[i])
+            t_send = self.clock.monotonic()
+            self._write(msg)
+            for i in todo[start:end]:
+                try:
+                    resp = self.read_reply(timeout)
+                except StepMotorTimeout:
+                    self._reply(cmds[i], t_send, '', journal.TIMEOUT)
+                    raise
+                if resp.endswith(RESP_UNDEF):
+                    logger.warning(f'Controller rejected {cmds[i]!r}: {resp.strip()}')
+                self._reply(cmds[i], t_send, resp)
+                replies[i] = resp
+            start = end
+        return replies
+
+    def _reply(self, cmd, t_send, resp, status=None):
+        '''Book keeping for every answered command: debug log, shadow
+        settings and journal.'''
+        t_recv = self.clock.monotonic()
+        logger.debug('RESP: %r', resp)
+        self._track(cmd, resp)
+        if status is None:
+            if resp.endswith(RESP_TERM):
+                status = journal.OK
+            elif resp.endswith(RESP_UNDEF):
+                status = journal.ERROR
+            elif resp.endswith(RESP_PROG):
+                status = journal.PROGRAM
+            else:
+                status = journal.NO_REPLY
+        self._observe(cmd, t_recv - t_send, status)
+        if self.journal:
+            if status != journal.NO_REPLY:
+                resp = resp[:-len(RESP_TERM)].strip()
+            self.journal.record(t_send, t_recv, self.operation, cmd, resp, status)
+
+    def _observe(self, cmd, seconds, status):
+        '''Command metrics: latency by opcode, and errors. The deliberate
+        error from SYNC_CMD doesn't count.'''
+        opcode = OPCODE_RE.match(cmd).group(0).upper()
+        child = self._cmd_seconds.get(opcode)
+        if child is None:
+            child = self._cmd_seconds[opcode] = CMD_SECONDS.labels(opcode, self.port_label)
+        if status == journal.TIMEOUT:
+            CMD_ERRORS.labels(opcode, self.port_label, 'timeout').inc()
+            self.errors['timeout'] += 1
+            return
+        if status == journal.NO_REPLY:
+            return                      # Dry run
+        child.observe(seconds)
+        if status == journal.ERROR and cmd != SYNC_CMD:
+            CMD_ERRORS.labels(opcode, self.port_label, 'undefined').inc()
+            self.errors['undefined'] += 1
+
+    def _elide(self, cmds):
+        '''Return the indexes of the commands in cmds that need sending.'''
+        state = dict(self.shadow)
+        todo = []
+        for i, cmd in enumerate(cmds):
+            m = SHADOW_RE.fullmatch(cmd.upper())
+            if m:
+                value = float(m.group(2))
+                if state.get(m.group(1)) == value:
+                    logger.debug(f'SKIP: {cmd}')
+                    continue
+                state[m.group(1)] = value
+            todo.append(i)
+        return todo
+
+    def _track(self, cmd, resp):
+        '''Update the shadow settings for a command the controller answered.'''
+        if resp.endswith(RESP_UNDEF):
+            # Something went wrong; don't trust what we think is set.
+            self.Invalidate()
+        elif resp.endswith(RESP_PROG):
+            pass                        # Stored in a program, not executed.
+        else:
+            m = SHADOW_RE.fullmatch(cmd.upper())
+            if m:
+                self.shadow[m.group(1)] = float(m.group(2))
+
+    def Invalidate(self):
+        '''Forget the shadow settings, so everything is sent again, and the
+        position.'''
+        if self.shadow:
+            logger.debug('Shadow settings invalidated')
+        self.shadow.clear()
+        self.position = None
+
+    @operation
+    def Resync(self, timeout=2):
+        '''Get back in step with the controller after a reset, error or
+        abort: drop anything unread, forget the shadow settings, and skip
+        replies until the one to SYNC_CMD, so late replies to earlier
+        commands can't be taken for answers to the next ones.'''
+        logger.info('Resync with controller')
+        RESYNCS.labels(self.port_label).inc()
+        self.Invalidate()
         if self.serialport:
-            while not (resp.endswith(RESP_TERM) or resp.endswith(RESP_UNDEF)) or resp.endswith(RESP_PROG):
-                ch = self.serialport.read(1).decode()
-                if ch:
-                    resp += ch
+            self.serialport.flushInput()
+            self.reader.reset()
+            t_send = self.clock.monotonic()
+            self.write_cmd(SYNC_CMD)
+            deadline = t_send + timeout
+            while True:
+                resp = self.reader.read_frame(deadline)
+                if SYNC_REPLY in resp:
+                    break
+            self._reply(SYNC_CMD, t_send, resp)
 
-        logger.debug(f'RESP: {resp.strip()}')
-        return resp
+    @operation
+    def SetBaudRate(self, rate, timeout=0.5):
+        '''Switch the link to rate: BAUD tells the controller, then the port
+        follows and the controller has to answer at the new rate. If it
+        doesn't, fall back: to the old rate if the controller never switched,
+        else to DEFAULT_BAUDRATE. Returns the rate in use.'''
+        port = self.serialport
+        old = port.baudrate
+        logger.info(f'Switching from {old} to {rate} baud')
+        try:
+            # The reply comes at the old rate, if at all.
+            if self.send_cmd(f'BAUD{rate}', timeout).endswith(RESP_UNDEF):
+                logger.warning(f'Controller does not do {rate} baud, staying at {old}')
+                return old
+        except StepMotorTimeout:
+            pass
+        for cmd, baud in ((None, rate), (None, old), (f'BAUD{DEFAULT_BAUDRATE}', DEFAULT_BAUDRATE)):
+            if cmd:
+                # Lost it: at the rate it should be at, ask for the default.
+                self.write_cmd(cmd)
+                port.flush()
+            port.baudrate = baud
+            try:
+                self.Resync(timeout)
+            except StepMotorTimeout:
+                logger.info(f'No answer at {baud} baud')
+                port.baudrate = rate
+                continue
+            if baud != rate:
+                logger.warning(f'Could not switch to {rate} baud, staying at {baud}')
+            return baud
+        raise StepMotorNoDevice(f'Lost the controller switching to {rate} baud')
+
+    def Abort(self, kill=True):
+        '''Emergency stop; safe to call from any thread.
+
+        Writes !K (kill: stop at once and drop anything buffered) or !S
+        (stop: decelerate at AD) straight to the port, ahead of any queued
+        command. An operation running on another thread wakes up and raises
+        StepMotorAborted once it has resynchronised. Returns the seconds it
+        took to get the command out.
+        '''
+        cmd = '!K' if kill else '!S'
+        t0 = time.monotonic()
+        # Counted before looking at self.operation, see operation().
+        self.aborts += 1
+        if self.operation:
+            self._abort.set()
+        ABORTS.labels(self.port_label).inc()
+        if self.serialport:
+            with self._write_lock:
+                self.serialport.write(f'{cmd}\n'.encode())
+                self.serialport.flush()
+            self._bytes_sent.inc(len(cmd) + 1)
+            if self._abort.is_set() and hasattr(self.serialport, 'cancel_read'):
+                self.serialport.cancel_read()           # Wake the reader now
+        elapsed = time.monotonic() - t0
+        logger.warning(f'Abort: {cmd} sent in {1000 * elapsed:.1f}ms')
+        return elapsed
+
+    def queued(self, mark, fn, *args, **kwargs):
+        '''Call fn(*args, **kwargs), which was queued when self.aborts was
+        mark. If fn is an operation and Abort() has been called since, it
+        raises StepMotorAborted without sending anything: the stop was meant
+        for it, even though it hadn't started yet.'''
+        self._queued_at = mark
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            self._queued_at = None
 
+    def _sleep(self, secs):
+        '''Sleep on self.clock, cut short by Abort().'''
+        if self.clock.wait(self._abort, secs):
+            raise StepMotorAborted('Aborted')
+
+    def read_reply(self, timeout=None):
+        '''Wait for the next prompt terminated reply from the controller.'''
+        if timeout is None:
+            timeout = self.cmd_timeout
+        try:
+            return self.reader.read_frame(self.clock.monotonic() + timeout)
+        except StepMotorTimeout:
+            # Whatever is left in the buffer belongs to the failed command.
+            self.reader.reset()
+            self.Invalidate()
+            raise
+
+    @operation
     def send_script(self, fname):
-        for l in open(fname, 'rb'):
-          line = l.strip()
-          if not line:
-              continue
-          cmd = line.split(';')[0].strip()
-          if not cmd:
-              continue
-          print(self.send_cmd(cmd).strip())
+        '''Send the commands of a script file (see read_script()) and return
+        their replies. See prg_upload.py to skip scripts the controller
+        already has.'''
+        return self.send_stream(read_script(fname))
 
+    @operation
     def InitializeDrive(self, enable_limits=True, vel=5, accel=10):
         logger.info('Initializing motor drive')
         if self.serialport:
             self.send_cmd('')                 # Force prompt
             self.send_cmd('')
 
-        self.send_cmd('ECHO0')            # Disable echoing of sent command.
-        self.send_cmd('DMODE12')          # Steping Drive Mode
-        self.send_cmd('DRES25000')        # Set Drive Resolution 25000 counts/rev
-        self.send_cmd(f'V{vel}')               # Set velosity to 5rps
-        self.send_cmd(f'A{accel}')        # Set acceleration to 10
-        self.send_cmd(f'A{accel}')        # Set deceleration to 10
-        self.send_cmd('MA0')              # Set to incremental mode
-
-        # Set positive and negative sofware limits
-        self.send_cmd('LSPOS+1000000')
-        self.send_cmd('LSNEG-990000')
-        if enable_limits:
-            self.send_cmd('LS3')
+        # Not elided: the controller may have been reset or power cycled
+        # since the shadow settings were recorded, and nothing tells us.
+        self.send_batch([
+            'ECHO0',                          # Disable echoing of sent command.
+            'DMODE12',                        # Steping Drive Mode
+            'DRES25000',                      # Set Drive Resolution 25000 counts/rev
+            f'V{vel}',                        # Set velosity to 5rps
+            f'A{accel}',                      # Set acceleration to 10
+            f'AD{accel}',                     # Set deceleration to 10
+            'MA0',                            # Set to incremental mode
+            # Set positive and negative sofware limits
+            f'LSPOS{LSPOS_STEPS:+d}',
+            f'LSNEG{LSNEG_STEPS:+d}',
+            'LS3' if enable_limits else 'LS0',
+        ])
+
+    def _drive_off(self):
+        '''The command to finish a move with, if any.'''
+        return [] if self.keep_drive_enabled else ['DRIVE0']
+
+    def motion_model(self):
+        '''MotionModel for the current drive settings, or None if they are
+        not known (nothing sent yet, or forgotten after a resync).'''
+        return MotionModel.from_settings(self.shadow, self.steps_per_rotation)
+
+    def PredictMove(self, steps):
+        '''Seconds of motion a move of steps will take, or None if unknown.'''
+        model = self.motion_model()
+        if model is None or steps is None:
+            return None
+        return model.time_steps(steps)
+
+    def _move(self, cmds, steps):
+        '''Send cmds, which end with a GO over steps steps (None if not
+        known), and wait for the axis to settle.
+
+        The reply to GO only comes when the move is done, so the timeout is
+        sized from the motion model rather than cmd_timeout. Afterwards the
+        time taken is compared with the prediction; a move that took much
+        longer points at drag on the table.
+        '''
+        predicted = self.PredictMove(steps)
+        timeout = None
+        if predicted is not None:
+            timeout = MOVE_TIMEOUT_FACTOR * predicted + MOVE_TIMEOUT_MARGIN
+        t0 = self.clock.monotonic()
+        if self.on_position and self.serialport and cmds[-1] == 'GO':
+            self.send_batch(cmds[:-1], elide=True)
+            self._watch_go(timeout or self.cmd_timeout)
+            self.send_batch(self._drive_off(), elide=True)
         else:
-            self.send_cmd('LS0')
+            self.send_batch(cmds + self._drive_off(), timeout, elide=True)
+        self.WaitForMotion(timeout)
+        actual = self.clock.monotonic() - t0 - self.post_move_sleep
+        self.last_move = (predicted, actual)
+        self._count_move(steps)
+        if predicted:
+            MOVE_OVERRUN.labels(self.port_label).observe(actual / predicted)
+        if predicted is not None:
+            logger.debug(f'Move took {actual:.3f}s, predicted {predicted:.3f}s')
+            if actual > DRAG_FACTOR * predicted + DRAG_MARGIN:
+                logger.warning(f'{self.operation} took {actual:.2f}s, '
+                               f'expected {predicted:.2f}s: drag on the table?')
 
+    def _watch_go(self, timeout):
+        '''Send GO and, until it answers, pass the position to on_position
+        every position_interval seconds. As in Scan(), the immediate !TPC
+        and !TPE are answered mid move.'''
+        t_go = self.clock.monotonic()
+        deadline = t_go + timeout
+        self.write_cmd('GO')
+        try:
+            while not self.reader.frame_ready():
+                t_send = self.clock.monotonic()
+                self._write(b'!TPC\n!TPE\n')
+                tpc, = self.reader.read_report(TPC_REPORT_RE, deadline)
+                tpe, = self.reader.read_report(TPE_REPORT_RE, deadline)
+                self.on_position(self.clock.time(), int(tpc), int(tpe))
+                self._sleep(max(0, t_send + self.position_interval - self.clock.monotonic()))
+            self._reply('GO', t_go, self.reader.read_frame(deadline))
+        except StepMotorTimeout:
+            self._reply('GO', t_go, '', journal.TIMEOUT)
+            self.reader.reset()
+            self.Invalidate()
+            raise
+
+    def _count_move(self, steps):
+        MOVES.labels(self.operation, self.port_label).inc()
+        if steps is not None:
+            MOVE_DEGREES.labels(self.port_label).inc(abs(steps) * 360 / self.steps_per_rotation)
+
+    @operation
     def MoveDegrees(self, deg):
         logger.info(f'Move: {deg} deg')
         steps = int(self.steps_per_rotation *deg/360)           # Find steps for input degrees
 
-        self.send_cmd('DRIVE1')               # Enable Drive
-        self.send_cmd('D{}'.format(steps))    # Set Distance to input degrees
-        self.send_cmd('GO')                   # Enable Movment
-        self.send_cmd('DRIVE0')               # Disable Drive
-        self.send_cmd('TAS')                  # Get Axis Status
-        time.sleep(self.post_move_sleep)
+        self._move([
+            'DRIVE1',                         # Enable Drive
+            'MA0',                            # Incremental mode
+            'D{}'.format(steps),              # Set Distance to input degrees
+            'GO',                             # Enable Movment
+        ], steps)
         logger.debug('Move complete')
         # The response from the controller will not occur until the command has
         # completed. As such, no need to sleep after sending the 'DRIVE0' command.
         #time.sleep(abs(float(deg))*0.012)
 
 
+    @operation
     def GoToDegrees(self, deg):
         logger.info(f'GoToDegrees: {deg}')
         steps = int(self.steps_per_rotation *deg/360)           # Find steps for input degrees
 
-        self.send_cmd('DRIVE1')               # Enable Drive
-        self.send_cmd('MA1')                  # Switch to absolute mode.
-        self.send_cmd('D{}'.format(steps))    # Set Distance to input degrees
-        self.send_cmd('GO')                   # Enable Movment
-        self.send_cmd('MA0')                  # Switch back to incremental mode
-        self.send_cmd('DRIVE0')               # Disable Drive
-        self.send_cmd('TAS')                  # Get Axis Status
-        time.sleep(self.post_move_sleep)
+        # Absolute mode is left on; the incremental moves switch back
+        # themselves, and only when they need to.
+        self._move([
+            'DRIVE1',                         # Enable Drive
+            'MA1',                            # Switch to absolute mode.
+            'D{}'.format(steps),              # Set Distance to input degrees
+            'GO',                             # Enable Movment
+        ], None if self.position is None else steps - self.position)
         logger.debug('Move complete')
 
 
+    @operation
     def Turn360(self, n=1):
         logger.info('Turn360')
-        self.send_cmd('DRIVE1')               # Enable Drive
-        self.send_cmd(f'D{n*self.steps_per_rotation}') # Set distance to one opposite rev
-        self.send_cmd('GO')                   # Enable Movment
-        self.send_cmd('DRIVE0')               # Disable Drive
-        time.sleep(self.post_move_sleep)
+        self._move([
+            'DRIVE1',                         # Enable Drive
+            'MA0',                            # Incremental mode
+            f'D{n*self.steps_per_rotation}',  # Set distance to one opposite rev
+            'GO',                             # Enable Movment
+        ], n * self.steps_per_rotation)
+
+
+    @operation
+    def Scan(self, deg=360, vel=1, interval=0.05, start=None):
+        '''Turn deg degrees at a constant vel (motor revs/s) and return a
+        ScanTrack of the table angle, read every interval seconds while it
+        turns.
 
+        If start is given the table first goes there (absolute degrees).
+        The position is read with the immediate !TPC, which the controller
+        answers straight away, mid move, while the GO is still waiting for
+        its prompt. The previous velocity is restored afterwards.
+        '''
+        logger.info(f'Scan: {deg} deg at V{vel}')
+        if start is not None:
+            self.GoToDegrees(start)
+        steps = int(self.steps_per_rotation * deg / 360)
+        scale = 360 / self.steps_per_rotation
+        prev_vel = self.shadow.get('V')
+        restore = ([f'V{prev_vel:g}'] if prev_vel else []) + self._drive_off()
+        t, pos, latency = [], [], []
+        scanned = False
+        try:
+            self.send_batch([
+                'DRIVE1',                         # Enable Drive
+                'MA0',                            # Incremental mode
+                f'V{vel}',                        # Scan velocity
+                f'D{steps}',
+            ], elide=True)
+            predicted = self.PredictMove(steps)
+            timeout = self.cmd_timeout
+            if predicted is not None:
+                timeout = MOVE_TIMEOUT_FACTOR * predicted + MOVE_TIMEOUT_MARGIN
+            t_go = self.clock.monotonic()
+            self.write_cmd('GO')
+            if self.serialport:
+                deadline = t_go + timeout
+                wall = self.clock.time() - t_go           # monotonic -> wall clock
+                done = False
+                while True:
+                    t_send = self.clock.monotonic()
+                    self._write(b'!TPC\n')
+                    tpc, = self.reader.read_report(TPC_REPORT_RE, deadline)
+                    t_recv = self.clock.monotonic()
+                    t.append((t_send + t_recv) / 2 + wall)
+                    pos.append(int(tpc))
+                    latency.append(t_recv - t_send)
+                    if done:
+                        break
+                    if self.reader.frame_ready():
+                        done = True                       # GO has answered; one
+                        continue                          # more for the end point
+                    self._sleep(max(0, t_send + interval - self.clock.monotonic()))
+                self._reply('GO', t_go, self.reader.read_frame(deadline))
+                self.position = pos[-1]
+            else:
+                self._reply('GO', t_go, '')
+            self._count_move(steps)
+            scanned = True
+        finally:
+            if scanned:
+                self.send_batch(restore, elide=True)
+            else:
+                # As in read_reply(): what is left in the buffer belongs to
+                # the failed scan, and the settings are no longer known.
+                self.reader.reset()
+                self.Invalidate()
+                try:
+                    self.send_batch(restore)
+                except (OSError, StepMotorError) as exc:
+                    logger.warning(f'Scan: could not restore V{prev_vel}: {exc}')
+        track = ScanTrack(t, np.asarray(pos) * scale, pos, latency)
+        if len(track):
+            logger.info(f'Scan: {len(track)} readings, '
+                        f'median latency {1000 * np.median(track.latency):.1f}ms')
+        return track
 
+    @operation
     def GoHome(self):
         logger.info('GoHome')
 
-        self.send_cmd('MC0')
-        self.send_cmd('HOMA10')
-        self.send_cmd('HOMV7')
-        self.send_cmd('HOMVF.3')
-        self.send_cmd('HOMBAC1')
-        self.send_cmd('HOMDF1')
-        self.send_cmd('HOMEDG0')
+        steps = self.position
+        # Not elided, as for InitializeDrive(): homing with the wrong
+        # parameters after a controller reset could run into the stops.
+        self.send_batch(HOME_PARAMS + [
+            'DRIVE1',                         # Enable Drive
+            'HOM0',                           # Enable Movment
+        ] + self._drive_off())
+        self.WaitForMotion()
+        self._count_move(steps)
 
-        self.send_cmd('DRIVE1')               # Enable Drive
-        self.send_cmd('HOM0')                 # Enable Movment
-        self.send_cmd('DRIVE0')               # Disable Drive
-        time.sleep(self.post_move_sleep)
 
+    @operation
+    def WaitForMotion(self, timeout=None, settle_time=None):
+        '''Poll the axis until it has come to rest, and return the seconds waited.
 
+        The axis counts as settled once TAS says it isn't moving and TPE has
+        stayed put for settle_time seconds (default self.settle_time). Polling
+        starts every poll_min seconds and backs off towards poll_max while the
+        move goes on. post_move_sleep, if set, is added on top as a fixed dwell.
+        '''
+        start = self.clock.monotonic()
+        if self.serialport:
+            if settle_time is None:
+                settle_time = self.settle_time
+            deadline = start + (timeout or self.cmd_timeout)
+            interval = self.poll_min
+            still_since = None
+            last_pos = None
+            while True:
+                tas, tpe = self.send_batch(['TAS', 'TPE'])
+                now = self.clock.monotonic()
+                pos = parse_position(tpe)
+                last_pos, moved = pos, last_pos is not None and pos != last_pos
+                if axis_moving(tas) or moved:
+                    still_since = None
+                elif still_since is None:
+                    still_since = now
+                if still_since is not None and now - still_since >= settle_time:
+                    self.position = pos
+                    break
+                if now > deadline:
+                    raise StepMotorTimeout(f'Axis still moving after {now - start:.1f}s')
+                if still_since is None:
+                    self._sleep(interval)
+                    interval = min(interval * 2, self.poll_max)
+                else:
+                    self._sleep(settle_time - (now - still_since))
+        if self.post_move_sleep:
+            self._sleep(self.post_move_sleep)
+        waited = self.clock.monotonic() - start
+        logger.debug(f'Motion settled after {waited:.3f}s')
+        return waited
+
+    @operation
+    def ReadPosition(self):
+        '''Return (commanded steps, actual steps, TAS bit string) from one
+        TPC/TPE/TAS burst. Values are None if the controller didn't report
+        them (always the case for a dry run).'''
+        tpc, tpe, tas = self.send_batch(['TPC', 'TPE', 'TAS'])
+        moving = axis_moving(tas)
+        tpc, tpe, tas = parse_position(tpc, 'TPC'), parse_position(tpe, 'TPE'), parse_bits(tas)
+        if tpc is not None and not moving:
+            self.position = tpc
+        return tpc, tpe, tas
+
+    @operation
     def SetHome(self):
         '''Set the current position to be "Home".
         '''
         logger.info('SetHome')
-        self.send_cmd('DRIVE1')
-        self.send_cmd('PSET0')
-        self.send_cmd('DRIVE0')
+        self.send_batch(['DRIVE1', 'PSET0'] + self._drive_off(), elide=True)
+        if self.serialport:
+            self.position = 0
 
     def close(self):
         if self.serialport:
             self.serialport.close()
             logger.info('serial port closed')
+        if self.journal:
+            self.journal.close()
 
+    @operation
     def Finish(self):
         self.GoToDegrees(0)
         self.close()
@@ -0,0 +1,489 @@
+#! /usr/bin/env python
+'''Angle of Arrival error of a DF system against the table heading.
+
+Joins the heading the receiver reports with the heading of the table at
+the same moment, and collects error statistics per table heading.
+
+The table heading comes from either
+  * a scan track (CSV written by scan.py or ScanTrack.save()), or
+  * the StepMotor journal (see journal.py): every TPE/TPC reading, with the
+    table taken to sit still from one reading until the next GO or HOM.
+
+The receiver log is either NMEA, where each HDT sentence takes its time
+from the RMC, ZDA or GGA sentence before it, or CSV with a column of
+time.time() seconds and one of headings. The log is read in blocks, so
+its size doesn't matter; each block is parsed, joined with the track and
+added to the statistics with NumPy, and then dropped.
+
+    python aoa_analysis.py --track scan.csv receiver.nmea -o aoa.npz
+    python aoa_analysis.py --journal ~/.rotation_table/journal \\
+        --fit-offset receiver.nmea.gz -o aoa.npz
+
+The error is the receiver heading minus (offset + sign * table heading),
+wrapped to +-180 degrees. The results (per heading bin: count, mean, std,
+rms, median and 95th percentile of the absolute error, max) are written
+with numpy.savez_compressed.
+'''
+
+import os
+import sys
+import glob
+import gzip
+import argparse
+import datetime
+import logging
+
+import numpy as np
+
+import journal
+import StepMotor
+
+logger = logging.getLogger(__name__)
+
+BLOCK_BYTES = 16 << 20
+
+# NMEA sentences we read, by the three letters after the talker ID.
+HDT, RMC, ZDA, GGA = (int.from_bytes(name, 'big') for name in (b'HDT', b'RMC', b'ZDA', b'GGA'))
+
+# Longest number field read from NMEA, in characters.
+FIELD_WIDTH = 12
+
+# Resolution and range of the absolute error histogram each heading bin
+# keeps, for the percentiles. Larger errors land in the last bin.
+ERR_RES = 0.05
+ERR_MAX = 45.0
+
+
+#==============================================================================
+# Table heading:
+#==============================================================================
+def journal_track(j, steps_per_rotation=900000):
+    '''ScanTrack of the table heading from journal records (see
+    journal.load_journals()).'''
+    cmd = np.char.strip(j['cmd'])
+    ok = j['status'] == journal.OK
+    t = (j['wall_send'] + j['wall_recv']) / 2
+    report = ok & ((cmd == b'TPE') | (cmd == b'TPC'))
+    moves = ok & ((cmd == b'GO') | (cmd == b'HOM0'))
+    idx = np.flatnonzero(report | moves)
+    steps = np.zeros(len(idx), dtype=np.int64)
+    is_report = report[idx]
+    steps[is_report] = np.char.lstrip(j['reply'][idx[is_report]], b'*TPEC').astype(np.int64)
+    # A move starts from wherever the last reading had the table.
+    last = np.where(is_report, np.arange(len(idx)), -1)
+    np.maximum.accumulate(last, out=last)
+    known = last >= 0
+    idx, steps = idx[known], steps[last[known]]
+    t = np.where(is_report[known], t[idx], j['wall_send'][idx])
+    return StepMotor.ScanTrack(t, steps * 360 / steps_per_rotation, steps, np.zeros(len(t)))
+
+
+def load_track(track=None, journals=None, steps_per_rotation=900000):
+    '''The track CSV track, or the track from the journal segments matching
+    the glob journals (a directory means all of its segments).'''
+    if track:
+        return StepMotor.ScanTrack.load(track)
+    if os.path.isdir(journals):
+        journals = os.path.join(journals, '*.bin')
+    j = journal.load_journals(sorted(glob.glob(journals)))
+    if not j:
+        raise ValueError(f'No journal records in {journals}')
+    return journal_track(j, steps_per_rotation)
+
+
+def moving_at(track, t):
+    '''True for the times t that fall between two track points with
+    different headings, i.e. while the table was turning.'''
+    i = np.clip(np.searchsorted(track.t, t), 1, len(track.t) - 1)
+    return track.deg[i - 1] != track.deg[i]
+
+
+#==============================================================================
+# Receiver logs:
+#==============================================================================
+def read_blocks(fname, block_bytes=BLOCK_BYTES):
+    '''Yield the file in blocks of about block_bytes, each ending at the end
+    of a line. .gz files are decompressed on the way.'''
+    opener = gzip.open if fname.endswith('.gz') else open
+    rest = b''
+    with opener(fname, 'rb') as f:
+        while True:
+            block = f.read(block_bytes)
+            if not block:
+                break
+            block = rest + block
+            end = block.rfind(b'\n') + 1
+            rest = block[end:]
+            if end:
+                yield block[:end]
+    if rest:
+        yield rest
+
+
+def _days(year, month, day):
+    '''Days since 1970-01-01 of the dates in the arrays.'''
+    months = ((year - 1970) * 12 + month - 1).astype('datetime64[M]')
+    return months.astype('datetime64[D]').astype(np.int64) + day - 1
+
+
+def _fill(values, valid, carry):
+    '''values forward filled over the rows where valid is False; rows before
+    the first valid one get carry. Returns the filled array and the carry
+    for the next block.'''
+    last = np.where(valid, np.arange(len(values)), -1)
+    np.maximum.accumulate(last, out=last)
+    out = np.where(last >= 0, values[np.maximum(last, 0)], carry)
+    return out, (out[-1] if len(out) else carry)
+
+
+class _Fields(object):
+    '''The comma separated fields of the NMEA sentences starting at
+    offsets p of buf, read for all sentences at once.'''
+    def __init__(self, buf, p):
+        self.buf = buf
+        # Field separators and sentence ends; the first one after each "$"
+        # is the comma after the sentence name.
+        self.delim = np.flatnonzero((buf == ord(',')) | (buf == ord('*')) |
+                                    (buf == ord('\r')) | (buf == ord('\n')))
+        self.first = np.searchsorted(self.delim, p)
+        newlines = np.flatnonzero(buf == ord('\n'))
+        i = np.searchsorted(newlines, p)
+        self.line_end = np.where(i < len(newlines), newlines[np.minimum(i, len(newlines) - 1)], len(buf))
+
+    def number(self, k, mask):
+        '''Field k (1 based) of the sentences selected by mask, as
+        non-negative numbers; NaN where the field is empty or missing.'''
+        buf, delim = self.buf, self.delim
+        i = np.minimum(self.first[mask] + k - 1, len(delim) - 1)    # The comma before it
+        start = delim[i] + 1
+        end = delim[np.minimum(i + 1, len(delim) - 1)]
+        # Only fields still in the sentence: after a comma, before the line ends.
+        ok = (buf[start - 1] == ord(',')) & (start < self.line_end[mask]) & (end - start <= FIELD_WIDTH)
+        width = np.where(ok, end - start, 0)
+
+        # Digit by digit, for all the fields at once.
+        value = np.zeros(len(start))
+        scale = np.ones(len(start))
+        after_point = np.zeros(len(start), dtype=bool)
+        digits = np.zeros(len(start), dtype=bool)
+        top = len(buf) - 1
+        for j in range(int(width.max(initial=0))):
+            c = buf[np.minimum(start + j, top)]
+            inside = j < width
+            d = c - np.uint8(ord('0'))    # Wraps around for anything below '0'
+            digit = inside & (d <= 9)
+            value = np.where(digit, value * 10 + d, value)
+            scale = np.where(digit & after_point, scale * 10, scale)
+            after_point |= inside & (c == ord('.'))
+            digits |= digit
+        return np.where(digits, value / scale, np.nan)
+
+
+class NmeaParser(object):
+    '''Turns blocks of NMEA text into (time.time() seconds, heading) arrays.
+    The time and date seen last carry over from one block to the next.
+
+    date (a datetime.date) is used until the first RMC or ZDA sentence; a
+    log with only GGA times needs it.
+    '''
+    def __init__(self, date=None):
+        self.tod = np.nan
+        self.day = np.nan
+        self.fallback = np.nan if date is None else float((date - datetime.date(1970, 1, 1)).days)
+        self.wraps = 0
+        self.day_wraps = 0
+
+    def parse(self, block):
+        buf = np.frombuffer(block, dtype=np.uint8)
+        # Sentences: "$", two letter talker, three letter name, ",".
+        p = np.flatnonzero(buf == ord('$'))
+        p = p[p + 6 < len(buf)]
+        p = p[buf[p + 6] == ord(',')]
+        name = (buf[p + 3].astype(np.int32) << 16) | (buf[p + 4].astype(np.int32) << 8) | buf[p + 5]
+        keep = np.isin(name, (HDT, RMC, ZDA, GGA))
+        p, name = p[keep], name[keep]
+        if not len(p):
+            return np.empty(0), np.empty(0)
+        fields = _Fields(buf, p)
+
+        hdt, rmc, zda, gga = (name == HDT), (name == RMC), (name == ZDA), (name == GGA)
+        tod_raw = np.full(len(p), np.nan)
+        for mask in (rmc, zda, gga):
+            if mask.any():
+                tod_raw[mask] = fields.number(1, mask)
+        h = np.floor(tod_raw / 10000)
+        m = np.floor(tod_raw / 100) % 100
+        tod = h * 3600 + m * 60 + tod_raw % 100
+
+        day = np.full(len(p), np.nan)
+        if rmc.any():
+            d = fields.number(9, rmc)                 # ddmmyy
+            day[rmc] = _days(2000 + d % 100, d // 100 % 100, d // 10000)
+        if zda.any():
+            day[zda] = _days(fields.number(4, zda), fields.number(3, zda), fields.number(2, zda))
+
+        last_tod = self.tod
+        tod, self.tod = _fill(tod, ~np.isnan(tod), self.tod)
+        # Midnights passed, so a date seen before one (or the fallback date)
+        # still gives the right day after it.
+        prev = np.concatenate(([last_tod], tod[:-1]))
+        wraps = self.wraps + np.cumsum(prev - tod > 43200)
+        dated = ~np.isnan(day)
+        day, self.day = _fill(day, dated, self.day)
+        day_wraps, self.day_wraps = _fill(wraps, dated, self.day_wraps)
+        undated = np.isnan(day)
+        day = np.where(undated, self.fallback, day) + wraps - np.where(undated, 0, day_wraps)
+        self.wraps = wraps[-1]
+
+        t = (day * 86400 + tod)[hdt]
+        heading = fields.number(1, hdt)
+        keep = ~np.isnan(t) & ~np.isnan(heading)
+        return t[keep], heading[keep]
+
+
+class CsvParser(object):
+    '''Turns blocks of CSV text into (time, heading) arrays, taking columns
+    time_col and heading_col (0 based). Lines that don't parse as numbers,
+    such as a header, are skipped.'''
+    def __init__(self, time_col=0, heading_col=1, delimiter=','):
+        self.cols = (time_col, heading_col)
+        self.delimiter = delimiter
+
+    def parse(self, block):
+        lines = [l for l in block.decode('ascii', errors='replace').splitlines()
+                 if l[:1].isdigit() or l[:1] in '-+.']
+        if not lines:
+            return np.empty(0), np.empty(0)
+        data = np.loadtxt(lines, delimiter=self.delimiter, usecols=self.cols, ndmin=2)
+        return data[:, 0], data[:, 1]
+
+
+#==============================================================================
+# Statistics:
+#==============================================================================
+def wrap180(deg):
+    return (deg + 180) % 360 - 180
+
+
+class AoaStats(object):
+    '''Error statistics per table heading bin, in constant memory: sums for
+    the mean and rms, the largest error, and a histogram of the absolute
+    error for the percentiles.'''
+    def __init__(self, bin_width=1.0):
+        self.bin_width = bin_width
+        self.nbins = int(round(360 / bin_width))
+        self.nerr = int(round(ERR_MAX / ERR_RES)) + 1
+        self.count = np.zeros(self.nbins, dtype=np.int64)
+        self.sum = np.zeros(self.nbins)
+        self.sum_sq = np.zeros(self.nbins)
+        self.max_abs = np.zeros(self.nbins)
+        self.hist = np.zeros(self.nbins * self.nerr, dtype=np.int64)
+
+    def add(self, table_deg, err):
+        b = (np.floor((table_deg % 360) / self.bin_width).astype(np.int64)) % self.nbins
+        n = self.nbins
+        self.count += np.bincount(b, minlength=n)
+        self.sum += np.bincount(b, err, minlength=n)
+        self.sum_sq += np.bincount(b, err * err, minlength=n)
+        a = np.abs(err)
+        np.maximum.at(self.max_abs, b, a)
+        e = np.minimum((a / ERR_RES).astype(np.int64), self.nerr - 1)
+        self.hist += np.bincount(b * self.nerr + e, minlength=n * self.nerr)
+
+    def percentile(self, q):
+        '''Upper edge of the absolute error histogram bin holding the q
+        quantile, per heading bin; NaN for empty bins.'''
+        cum = np.cumsum(self.hist.reshape(self.nbins, self.nerr), axis=1)
+        want = np.ceil(q * self.count)[:, None]
+        i = np.argmax(cum >= np.maximum(want, 1), axis=1)
+        return np.where(self.count > 0, (i + 1) * ERR_RES, np.nan)
+
+    def results(self):
+        n = np.where(self.count > 0, self.count, 1)
+        mean = self.sum / n
+        empty = self.count == 0
+        nan = lambda a: np.where(empty, np.nan, a)
+        return {
+            'heading': (np.arange(self.nbins) + 0.5) * self.bin_width,
+            'count': self.count,
+            'mean': nan(mean),
+            'std': nan(np.sqrt(np.maximum(self.sum_sq / n - mean ** 2, 0))),
+            'rms': nan(np.sqrt(self.sum_sq / n)),
+            'p50_abs': self.percentile(0.5),
+            'p95_abs': self.percentile(0.95),
+            'max_abs': nan(self.max_abs),
+            'abs_error_hist': self.hist.reshape(self.nbins, self.nerr),
+            'abs_error_res': ERR_RES,
+        }
+
+
+#==============================================================================
+# Join:
+#==============================================================================
+def joined(track, blocks, parser, time_offset=0.0, skip_moving=True, counts=None):
+    '''Yield (table heading, receiver heading) arrays for every block of the
+    receiver log, for the epochs the track covers. counts, a dict, gets the
+    number of epochs read, outside the track and skipped while moving.'''
+    counts = counts if counts is not None else {}
+    for key in ('epochs', 'outside', 'moving', 'joined'):
+        counts.setdefault(key, 0)
+    for block in blocks:
+        t, rx = parser.parse(block)
+        t = t + time_offset
+        table = track.heading_at(t)
+        keep = ~np.isnan(table)
+        counts['epochs'] += len(t)
+        counts['outside'] += len(t) - np.count_nonzero(keep)
+        if skip_moving:
+            moving = keep & moving_at(track, t)
+            counts['moving'] += np.count_nonzero(moving)
+            keep &= ~moving
+        counts['joined'] += np.count_nonzero(keep)
+        yield table[keep], rx[keep]
+
+
+def fit_offset(pairs, sign=1):
+    '''Circular mean of receiver minus table heading: the receiver heading
+    at table heading 0.'''
+    s = c = 0.0
+    for table, rx in pairs:
+        d = np.radians(rx - sign * table)
+        s += np.sin(d).sum()
+        c += np.cos(d).sum()
+    return float(np.degrees(np.arctan2(s, c))) % 360
+
+
+def analyse(track, blocks, parser, offset=0.0, sign=1, bin_width=1.0, **join_kwargs):
+    '''AoaStats of the receiver log against the track, and the join counts.'''
+    stats = AoaStats(bin_width)
+    counts = {}
+    for table, rx in joined(track, blocks, parser, counts=counts, **join_kwargs):
+        stats.add(table, wrap180(rx - (offset + sign * table)))
+    return stats, counts
+
+
+def main():
+    parser = argparse.ArgumentParser(
+          description="AoA error of receiver headings against the table heading.",
+          formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+          )
+    parser.add_argument("log",
+                        help="Receiver log: NMEA, or CSV with --csv (.gz ok)",
+                        )
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--track",
+                        help="Table heading track CSV from scan.py",
+                        )
+    source.add_argument("--journal",
+                        help="StepMotor journal directory, or a glob of its segments, "
+                             "to take the table heading from",
+                        )
+    parser.add_argument("--csv",
+                        action='store_true',
+                        help="The log is CSV, see --time-col and --heading-col",
+                        )
+    parser.add_argument("--time-col",
+                        type=int,
+                        default=0,
+                        help="CSV column (0 based) of the time, in time.time() seconds",
+                        )
+    parser.add_argument("--heading-col",
+                        type=int,
+                        default=1,
+                        help="CSV column (0 based) of the heading, degrees",
+                        )
+    parser.add_argument("--date",
+                        type=datetime.date.fromisoformat,
+                        default=None,
+                        help="UTC date (YYYY-MM-DD) of an NMEA log without RMC or ZDA sentences",
+                        )
+    parser.add_argument("--time-offset",
+                        type=float,
+                        default=0.0,
+                        help="Seconds to add to the receiver times, e.g. for the host clock being off",
+                        )
+    parser.add_argument("--offset",
+                        type=float,
+                        default=0.0,
+                        help="Receiver heading at table heading 0",
+                        )
+    parser.add_argument("--fit-offset",
+                        action='store_true',
+                        help="Estimate --offset from the data first (reads the log twice)",
+                        )
+    parser.add_argument("--reverse",
+                        action='store_true',
+                        help="The receiver heading goes down as the table angle goes up",
+                        )
+    parser.add_argument("--bin",
+                        type=float,
+                        default=1.0,
+                        help="Width of the table heading bins, degrees",
+                        )
+    parser.add_argument("--keep-moving",
+                        action='store_true',
+                        help="Also use epochs while the table turns (always done for a --track)",
+                        )
+    parser.add_argument("--steps-per-rotation",
+                        type=int,
+                        default=900000,
+                        help="Motor steps per table turn, for --journal",
+                        )
+    parser.add_argument("-o", "--output",
+                        default='aoa.npz',
+                        help="Results file (numpy .npz)",
+                        )
+    parser.add_argument(
+        "--verbose", "-v",
+        action='count',
+        default=0,
+        help="use multiple -v for more detailed messages."
+    )
+    args = parser.parse_args()
+    logging.basicConfig(
+          format='%(levelname)-8s [%(filename)s:%(lineno)d] %(message)s',
+          level=logging.WARNING - (10 * args.verbose),
+          )
+
+    try:
+        track = load_track(args.track, args.journal, args.steps_per_rotation)
+    except (OSError, ValueError) as exc:
+        sys.exit(str(exc))
+    if len(track) < 2:
+        sys.exit('Need at least two table positions')
+    logger.info(f'Track: {len(track)} points, {track.t[-1] - track.t[0]:.0f}s')
+
+    def make_parser():
+        if args.csv:
+            return CsvParser(args.time_col, args.heading_col)
+        return NmeaParser(args.date)
+
+    sign = -1 if args.reverse else 1
+    join = dict(time_offset=args.time_offset, skip_moving=not (args.keep_moving or args.track))
+    offset = args.offset
+    if args.fit_offset:
+        offset = fit_offset(joined(track, read_blocks(args.log), make_parser(), **join), sign)
+        print(f'Fitted offset: {offset:.3f} deg')
+
+    stats, counts = analyse(track, read_blocks(args.log), make_parser(),
+                            offset=offset, sign=sign, bin_width=args.bin, **join)
+    print(f"{counts['epochs']} epochs: {counts['joined']} used, "
+          f"{counts['outside']} outside the table track, {counts['moving']} while moving")
+    if not counts['joined']:
+        sys.exit('Nothing to analyse; check the clocks (--time-offset) and --date')
+
+    res = stats.results()
+    np.savez_compressed(args.output, offset=offset, sign=sign, bin_width=args.bin,
+                        **counts, **res)
+    print(f"{'heading':>8} {'n':>8} {'mean':>8} {'std':>8} {'p95|e|':>8} {'max|e|':>8}")
+    for i in np.flatnonzero(res['count']):
+        print(f"{res['heading'][i]:8.1f} {res['count'][i]:8d} {res['mean'][i]:8.3f} "
+              f"{res['std'][i]:8.3f} {res['p95_abs'][i]:8.2f} {res['max_abs'][i]:8.3f}")
+    total = stats.count.sum()
+    print(f'All: rms {np.sqrt(stats.sum_sq.sum() / total):.3f} deg, '
+          f'mean {stats.sum.sum() / total:.3f} deg. Written to {args.output}')
+
+
+if __name__ == '__main__':
+    main()
+# vim:expandtab:sw=4:ts=4
@@ -2,11 +2,15 @@
 
 import os
 import sys
-import time
 import argparse
+import configparser
 import logging
 
 import StepMotor
+import gemini_program
+from clock import VirtualClock
+from endurance import EnduranceTest, DriftError
+from replay import ReplayPort
 
 CFG_FILE_NAME = "back_forth.ini"
 
@@ -71,6 +75,60 @@ def main():
                         default=False,
                         help="Enable software extent limits",
                         )
+    endp = parser.add_argument_group('Endurance', 'See endurance.py')
+    endp.add_argument("--endurance",
+                        action=argparse.BooleanOptionalAction,
+                        default=False,
+                        help="Keep move statistics and check for drift; -n 0 runs until interrupted",
+                        )
+    endp.add_argument("--check-every",
+                        type=int,
+                        default=100,
+                        help="Compare TPC and TPE every so many cycles (0: never)",
+                        )
+    endp.add_argument("--rehome-every",
+                        type=int,
+                        default=0,
+                        help="Check the position against the expected one and home, every so many cycles (0: never)",
+                        )
+    endp.add_argument("--max-drift",
+                        type=float,
+                        default=None,
+                        help="Stop when the drift exceeds this many degrees",
+                        )
+    endp.add_argument("--summary-interval",
+                        type=float,
+                        default=600,
+                        help="Seconds between summaries",
+                        )
+    endp.add_argument("--summary-file",
+                        default=None,
+                        help="Append each summary to this file as a JSON line",
+                        )
+    fb_p.add_argument("--on-controller",
+                        action=argparse.BooleanOptionalAction,
+                        default=False,
+                        help="Upload the movements as a program and let the controller run it",
+                        )
+    initp.add_argument("--port",
+                        default=None,
+                        help="Serial port of the controller (e.g. from gt6_sim.py). Default: search",
+                        )
+    initp.add_argument("--record",
+                        default=None,
+                        help="Record the serial traffic to this file, see replay.py",
+                        )
+    initp.add_argument("--replay",
+                        default=None,
+                        help="Instead of the controller, play back a recording made with --record, "
+                             "on a virtual clock",
+                        )
+    initp.add_argument("--journal",
+                        action=argparse.BooleanOptionalAction,
+                        default=True,
+                        help="Keep the serial traffic in the journal (see journal.py). "
+                             "Turn off for the simulator, so it isn't taken for the table's history",
+                        )
     initp.add_argument("--dryrun",
                         action=argparse.BooleanOptionalAction,
                         default=False,
@@ -105,7 +163,19 @@ def main():
                   args.number,
                   args.degrees_fwd, args.degrees_back,
                   args.sleep_time,
-                  args.home_start, args.home_end
+                  args.home_start, args.home_end,
+                  args.on_controller,
+                  args.port,
+                  args.record,
+                  args.replay,
+                  journal=args.journal,
+                  endurance=dict(
+                      check_every=args.check_every,
+                      rehome_every=args.rehome_every,
+                      max_drift=args.max_drift,
+                      summary_interval=args.summary_interval,
+                      summary_file=args.summary_file,
+                  ) if args.endurance else None,
                   )
 
 
@@ -117,36 +187,92 @@ def do_back_forth(
     degrees_fwd: float, degrees_back: float,
     sleep_time: float,
     home_start: bool, home_end: bool,
+    on_controller: bool = False,
+    port: str = None,
+    record: str = None,
+    replay: str = None,
+    journal: bool = True,
+    endurance: dict = None,
 ):
     if dryrun:
         print('Init dry run')
         motor = StepMotor.StepMotor('dryrun')
+    elif replay:
+        print(f'Replaying {replay}')
+        clock = VirtualClock()
+        motor = StepMotor.StepMotor(ReplayPort(replay, clock), clock=clock, journal=False)
     else:
         print('Go for it')
-        motor = StepMotor.StepMotor()
+        motor = StepMotor.StepMotor(port, record=record, journal=journal)
+    t0 = motor.clock.monotonic()
     motor.InitializeDrive(enable_limits=limits,
                           vel=velocity,
                           accel=accel,
                           )
+    if on_controller:
+        # Same sequence, but timed by the controller instead of this loop.
+        lines = gemini_program.compile_back_forth(
+            'BKFWD', number, degrees_fwd, degrees_back,
+            dwell=sleep_time,
+            home_start=home_start, home_end=home_end,
+            steps_per_rotation=motor.steps_per_rotation,
+        )
+        gemini_program.upload_program(motor, lines)
+        gemini_program.run_program(
+            motor, 'BKFWD',
+            on_progress=lambda n: logging.info(f'{n=}/{number}'),
+            number=number,
+            **gemini_program.program_timeouts(
+                motor, degrees_fwd, degrees_back,
+                dwell=sleep_time,
+                home_start=home_start, home_end=home_end,
+            ),
+        )
+        return done(motor, t0)
+
     if home_start:
         motor.GoHome()
-        log_sleep(sleep_time)
+        log_sleep(motor, sleep_time)
+    if endurance is not None:
+        # endurance: EnduranceTest settings.
+        test = EnduranceTest(motor, degrees_fwd, degrees_back, sleep_time, **endurance)
+        try:
+            test.run(number)
+        except KeyboardInterrupt:
+            print(f'Interrupted after {test.cycles} cycles')
+            # The reply to a GO or TAS may still be on its way: stop the
+            # table and skip it, or it is taken for the reply to the next
+            # command.
+            motor.Abort(kill=False)
+            motor.Resync()
+        except DriftError as exc:
+            # Leave the table where it is, to see what went wrong.
+            motor.close()
+            sys.exit(str(exc))
+        if home_end:
+            motor.GoHome()
+        return done(motor, t0)
     for n in range(number):
         logging.info(f'{n=}/{number}')
         logging.info(f'Move: {degrees_fwd} deg')
         motor.MoveDegrees(degrees_fwd)
-        log_sleep(sleep_time)
+        log_sleep(motor, sleep_time)
         logging.info(f'Move: {degrees_back} deg')
         motor.MoveDegrees(-1 * degrees_back)
-        log_sleep(sleep_time)
+        log_sleep(motor, sleep_time)
     if home_end:
         motor.GoHome()
 
+    return done(motor, t0)
+
+def done(motor, t0):
+    logger.info(f'Took {motor.clock.monotonic() - t0:.1f}s')
+    motor.close()
     return "\nDone\n"
 
-def log_sleep(t):
+def log_sleep(motor, t):
     logging.debug(f'Sleeping {t}')
-    time.sleep(t)
+    motor.clock.sleep(t)
 
 if __name__ == '__main__':
     main()
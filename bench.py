@@ -0,0 +1,236 @@
+#!/usr/bin/env python
+'''Latency and throughput benchmarks for the motor control stack.
+
+Runs against the GT6 simulator by default, or the real table with --port.
+Everything is reported as one JSON document so results from different
+versions can be compared:
+
+    python bench.py --label my-branch > bench.json
+
+Move timings are compared with the time the move itself needs according to
+the drive parameters; "overhead" is what is left over, i.e. what the host,
+the serial link and the command protocol cost. With the simulator the
+motion part is divided by --time-scale, the overhead is not.
+'''
+
+import sys
+import json
+import time
+import argparse
+import logging
+import platform
+import datetime
+import contextlib
+
+import StepMotor
+import gt6_sim
+import back_forth
+from motion_model import MotionModel
+
+logger = logging.getLogger(__name__)
+
+
+def summarize(samples):
+    '''Latency statistics for a list of durations in seconds, reported in ms.'''
+    s = sorted(samples)
+    if not s:
+        return {'n': 0}
+    def pct(p):
+        return 1000 * s[min(len(s) - 1, int(round(p / 100 * (len(s) - 1))))]
+    return {
+        'n': len(s),
+        'mean_ms': 1000 * sum(s) / len(s),
+        'p50_ms': pct(50),
+        'p90_ms': pct(90),
+        'p99_ms': pct(99),
+        'max_ms': 1000 * s[-1],
+    }
+
+
+def timed(fn, *args):
+    t0 = time.perf_counter()
+    fn(*args)
+    return time.perf_counter() - t0
+
+
+def motion_time(steps_per_rotation, deg, vel, accel, time_scale):
+    '''Seconds the drive needs for a move of deg table degrees.'''
+    model = MotionModel(steps_per_rotation, vel, accel)
+    return model.time_deg(deg) / time_scale
+
+
+def bench_send_cmd(motor, n):
+    return summarize([timed(motor.send_cmd, 'TAS') for _ in range(n)])
+
+
+def bench_moves(motor, fn, absolute, sizes, reps, vel, accel, time_scale):
+    '''Time fn(deg) for each size. Each move covers deg degrees and they
+    alternate in direction, so the table stays near where it started.'''
+    results = {}
+    for deg in sizes:
+        walls, ideal = [], motion_time(motor.steps_per_rotation, deg, vel, accel, time_scale)
+        for i in range(reps):
+            if absolute:
+                target = deg if i % 2 == 0 else 0
+            else:
+                target = deg if i % 2 == 0 else -deg
+            walls.append(timed(fn, target))
+        if absolute and reps % 2:
+            fn(0)
+        stats = summarize(walls)
+        mean = stats['mean_ms'] / 1000
+        stats['motion_ms'] = 1000 * ideal
+        stats['overhead_ms'] = 1000 * (mean - ideal)
+        stats['overhead_fraction'] = (mean - ideal) / mean if mean else 0
+        results[f'{deg:g}deg'] = stats
+    return results
+
+
+def bench_back_forth(port, cycles, vel, accel, deg, time_scale, steps_per_rotation):
+    '''Run back_forth.do_back_forth() end to end, homing excluded.'''
+    t0 = time.perf_counter()
+    # do_back_forth() prints; keep stdout for the report.
+    with contextlib.redirect_stdout(sys.stderr):
+        back_forth.do_back_forth(
+            dryrun=False, limits=False,
+            velocity=vel, accel=accel,
+            number=cycles,
+            degrees_fwd=deg, degrees_back=deg,
+            sleep_time=0,
+            home_start=False, home_end=False,
+            port=port,
+            journal=False,
+        )
+    wall = time.perf_counter() - t0
+    ideal = 2 * cycles * motion_time(steps_per_rotation, deg, vel, accel, time_scale)
+    return {
+        'cycles': cycles,
+        'wall_s': wall,
+        'motion_s': ideal,
+        'overhead_fraction': (wall - ideal) / wall if wall else 0,
+        'cycles_per_hour': 3600 * cycles / wall if wall else 0,
+    }
+
+
+def run(port=None, time_scale=10.0, reps=10, vel=5, accel=10, cycles=10, sizes=(1, 5, 15),
+        baudrate=StepMotor.BAUDRATES[0]):
+    sim = None
+    if port is None:
+        sim = gt6_sim.GT6Simulator(time_scale=time_scale)
+        port = sim.device
+    else:
+        time_scale = 1.0
+    try:
+        # Benchmark traffic isn't table history; keep it out of the journal.
+        motor = StepMotor.StepMotor(port, baudrate=baudrate, journal=False)
+        report = {
+            'label': None,
+            'date': datetime.datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'target': 'simulator' if sim else port,
+            'time_scale': time_scale,
+            'baudrate': motor.serialport.baudrate,
+            'velocity': vel,
+            'accel': accel,
+        }
+        inits = []
+        for _ in range(reps):
+            # Time a full setup each time, not one cut short by the shadow
+            # settings of the one before.
+            motor.Invalidate()
+            inits.append(timed(motor.InitializeDrive, False, vel, accel))
+        report['InitializeDrive'] = summarize(inits)
+        report['send_cmd'] = bench_send_cmd(motor, 10 * reps)
+        motor.SetHome()
+        report['MoveDegrees'] = bench_moves(
+            motor, motor.MoveDegrees, False, sizes, reps, vel, accel, time_scale)
+        report['GoToDegrees'] = bench_moves(
+            motor, motor.GoToDegrees, True, sizes, reps, vel, accel, time_scale)
+        homes = []
+        for _ in range(max(1, reps // 5)):
+            motor.MoveDegrees(max(sizes))
+            homes.append(timed(motor.GoHome))
+        report['GoHome'] = summarize(homes)
+        motor.close()
+
+        report['do_back_forth'] = bench_back_forth(
+            port, cycles, vel, accel, max(sizes), time_scale, motor.steps_per_rotation)
+    finally:
+        if sim:
+            sim.close()
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(
+          description="Benchmark command latency and move throughput.",
+          formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+          )
+    parser.add_argument("--port",
+                        default=None,
+                        help="Serial port of a real controller. Default: use the simulator",
+                        )
+    parser.add_argument("--time-scale",
+                        type=float,
+                        default=10.0,
+                        help="Simulator speed up",
+                        )
+    parser.add_argument("--baudrate",
+                        type=int,
+                        default=StepMotor.BAUDRATES[0],
+                        help="Link rate to switch to (0: stay at the rate it answers on)",
+                        )
+    parser.add_argument("-r", "--reps",
+                        type=int,
+                        default=10,
+                        help="Repetitions per measurement",
+                        )
+    parser.add_argument("-n", "--cycles",
+                        type=int,
+                        default=10,
+                        help="Cycles for the do_back_forth run",
+                        )
+    parser.add_argument("-V", "--velocity",
+                        type=float,
+                        default=5,
+                        help="Motor Velocity",
+                        )
+    parser.add_argument("-A", "--accel",
+                        type=float,
+                        default=10,
+                        help="Motor Acceleration",
+                        )
+    parser.add_argument("--label",
+                        default=None,
+                        help="Free text stored in the report, e.g. a git revision",
+                        )
+    parser.add_argument("-o", "--output",
+                        default=None,
+                        help="Write the JSON report here instead of stdout",
+                        )
+    parser.add_argument(
+        "--verbose", "-v",
+        action='count',
+        default=0,
+        help="use multiple -v for more detailed messages."
+    )
+    args = parser.parse_args()
+    logging.basicConfig(
+          format='%(levelname)-8s [%(filename)s:%(lineno)d] %(message)s',
+          level=logging.WARNING - (10 * args.verbose),
+          )
+
+    report = run(args.port, args.time_scale, args.reps, args.velocity, args.accel, args.cycles,
+                 baudrate=args.baudrate)
+    report['label'] = args.label
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+
+
+if __name__ == '__main__':
+    main()
+# vim:expandtab:sw=4:ts=4
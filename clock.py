@@ -0,0 +1,106 @@
+#! /usr/bin/env python
+'''Clocks for the code that waits on the table.
+
+StepMotor, back_forth.py and main.py tell the time and sleep through a
+clock object rather than the time module, so that a run can be replayed
+(see replay.py) without waiting for it. SYSTEM_CLOCK is the real thing.
+A VirtualClock stands still until someone sleeps on it, and then jumps
+ahead at once: a thousand back and forth cycles with 1 s dwells take as
+long as the replayed serial traffic takes to process.
+
+    clock = VirtualClock()
+    t0 = clock.monotonic()
+    clock.sleep(3600)
+    clock.monotonic() - t0      # 3600.0, straight away
+'''
+
+import time
+import asyncio
+import datetime
+import threading
+
+
+#==============================================================================
+# SystemClock:
+#==============================================================================
+class SystemClock(object):
+    '''The time module, and real waits.'''
+
+    def monotonic(self):
+        return time.monotonic()
+
+    def time(self):
+        return time.time()
+
+    def now(self):
+        return datetime.datetime.now()
+
+    def sleep(self, secs):
+        if secs > 0:
+            time.sleep(secs)
+
+    def wait(self, event, secs):
+        '''threading.Event.wait(): True if event was set within secs.'''
+        return event.wait(max(secs, 0))
+
+    async def wait_async(self, event, secs):
+        '''The same for an asyncio.Event.'''
+        try:
+            await asyncio.wait_for(event.wait(), max(secs, 0))
+        except asyncio.TimeoutError:
+            return event.is_set()
+        return True
+
+
+SYSTEM_CLOCK = SystemClock()
+
+
+#==============================================================================
+# VirtualClock:
+#==============================================================================
+class VirtualClock(SystemClock):
+    '''A clock that only moves when it is slept on or advanced.
+
+    monotonic() starts at 0; time() and now() count from wall (default:
+    the real time when the clock was made). A wait on an event that isn't
+    set runs the full time out, since nothing can set it while the clock
+    jumps.
+    '''
+    def __init__(self, wall=None):
+        self.wall = time.time() if wall is None else wall
+        self.t = 0.0
+        self._lock = threading.Lock()
+
+    def monotonic(self):
+        return self.t
+
+    def time(self):
+        return self.wall + self.t
+
+    def now(self):
+        return datetime.datetime.fromtimestamp(self.time())
+
+    def advance(self, secs):
+        with self._lock:
+            self.t += max(secs, 0)
+
+    def advance_to(self, t):
+        with self._lock:
+            self.t = max(self.t, t)
+
+    def sleep(self, secs):
+        self.advance(secs)
+
+    def wait(self, event, secs):
+        if event.is_set():
+            return True
+        self.advance(secs)
+        return event.is_set()
+
+    async def wait_async(self, event, secs):
+        if event.is_set():
+            return True
+        self.advance(secs)
+        await asyncio.sleep(0)          # Let others run, as a real wait would
+        return event.is_set()
+# vim:expandtab:sw=4:ts=4
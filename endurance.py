@@ -0,0 +1,224 @@
+#! /usr/bin/env python
+'''Endurance runs: back and forth for as many cycles as it takes, keeping
+statistics in constant memory and checking for lost steps as it goes.
+
+A multi-day run keeps nothing per cycle. Move times go into RollingStats,
+which holds the last `window` of them for the recent mean and max, and
+running totals for the whole run. Error replies are counted by StepMotor
+(see StepMotor.errors).
+
+Drift is looked for in two ways:
+
+    check_every N   every N cycles compare the commanded position (TPC)
+                    with the encoder (TPE)
+    rehome_every N  every N cycles compare where the run expects the table
+                    with where the controller has it (TPE), then home, so
+                    any drift found is taken out
+
+A summary is printed every summary_interval seconds, and at the end, and
+appended as a JSON line to summary_file if one is given. The run stops
+with DriftError once the drift exceeds max_drift degrees.
+
+Run it with back_forth.py --endurance:
+
+    python back_forth.py --endurance -n 0 --check-every 100 --rehome-every 5000
+'''
+
+import json
+import itertools
+import collections
+import logging
+
+import StepMotor
+
+logger = logging.getLogger(__name__)
+
+
+class DriftError(StepMotor.StepMotorError): pass
+
+
+#==============================================================================
+# RollingStats:
+#==============================================================================
+class RollingStats(object):
+    '''Mean and max of the last window values added, and count, mean and
+    max of all of them, in constant memory.'''
+    def __init__(self, window=1000):
+        self.recent = collections.deque(maxlen=window)
+        self.count = 0
+        self.mean = 0.0
+        self.max = None
+
+    def add(self, x):
+        self.recent.append(x)
+        self.count += 1
+        self.mean += (x - self.mean) / self.count
+        if self.max is None or x > self.max:
+            self.max = x
+
+    def summary(self):
+        recent = self.recent
+        return {
+            'count': self.count,
+            'mean': self.mean if self.count else None,
+            'max': self.max,
+            'recent_mean': sum(recent) / len(recent) if recent else None,
+            'recent_max': max(recent) if recent else None,
+        }
+
+
+#==============================================================================
+# EnduranceTest:
+#==============================================================================
+class EnduranceTest(object):
+    '''Back and forth cycles on motor: degrees_fwd, dwell, -degrees_back,
+    dwell. See the module docstring for the checks. Timing, dwells and the
+    summary interval follow motor.clock.
+
+    A move that times out is counted, the link resynchronised and the run
+    carries on, unless max_errors happen in a row.
+    '''
+    def __init__(self, motor, degrees_fwd, degrees_back, sleep_time=0,
+                 check_every=100, rehome_every=0, max_drift=None,
+                 summary_interval=600, summary_file=None, window=1000,
+                 max_errors=10):
+        self.motor = motor
+        self.degrees_fwd = degrees_fwd
+        self.degrees_back = degrees_back
+        self.sleep_time = sleep_time
+        self.check_every = check_every
+        self.rehome_every = rehome_every
+        self.max_drift = max_drift
+        self.summary_interval = summary_interval
+        self.summary_file = summary_file
+        self.max_errors = max_errors
+
+        self.deg = 360 / motor.steps_per_rotation
+        self.cycles = 0
+        self.moves = RollingStats(window)       # Seconds per move
+        self.drift = RollingStats(window)       # |TPE - TPC|, degrees
+        self.drift_last = None
+        self.rehome_offsets = RollingStats(window)  # |TPE - expected|, degrees
+        self.rehome_last = None
+        self.timeouts = 0
+        self._in_row = 0                        # Timeouts since the last good move
+        self.expected = None                    # Steps, where the table should be
+        self._t0 = None
+        self._next_summary = None
+
+    def run(self, number=0):
+        '''Run number cycles (0: until interrupted) and return the final
+        summary.'''
+        motor = self.motor
+        clock = motor.clock
+        self._t0 = clock.monotonic()
+        self._next_summary = self._t0 + self.summary_interval
+        self.expected, _, _ = motor.ReadPosition()
+        cycles = itertools.count() if number == 0 else range(number)
+        try:
+            for _ in cycles:
+                self.cycle()
+                self.cycles += 1
+                if self.check_every and self.cycles % self.check_every == 0:
+                    self.check_drift()
+                if self.rehome_every and self.cycles % self.rehome_every == 0:
+                    self.rehome()
+                if clock.monotonic() >= self._next_summary:
+                    self.report()
+                    self._next_summary += self.summary_interval
+        finally:
+            summary = self.report()
+        return summary
+
+    def cycle(self):
+        for deg in (self.degrees_fwd, -self.degrees_back):
+            try:
+                self.move(deg)
+                self._in_row = 0
+            except StepMotor.StepMotorTimeout as exc:
+                self.timeouts += 1
+                self._in_row += 1
+                logger.warning(f'Cycle {self.cycles}: {exc}')
+                if self._in_row >= self.max_errors:
+                    raise
+                # Carry on from wherever the table got to.
+                self.motor.Resync()
+                self.expected, _, _ = self.motor.ReadPosition()
+            self.motor.clock.sleep(self.sleep_time)
+
+    def move(self, deg):
+        self.motor.MoveDegrees(deg)
+        if self.expected is not None:
+            self.expected += int(self.motor.steps_per_rotation * deg / 360)
+        last = self.motor.last_move
+        if last is not None:
+            self.moves.add(last[1])
+
+    def check_drift(self):
+        '''Compare TPC and TPE. Returns the drift in degrees, None if the
+        controller didn't report them.'''
+        tpc, tpe, _ = self.motor.ReadPosition()
+        if tpc is None or tpe is None:
+            return None
+        drift = (tpe - tpc) * self.deg
+        self.drift.add(abs(drift))
+        self.drift_last = drift
+        logger.info(f'Cycle {self.cycles}: TPC {tpc}, TPE {tpe}, drift {drift:.4f} deg')
+        self._check_limit('TPE - TPC', drift)
+        return drift
+
+    def rehome(self):
+        '''Compare TPE with the position the run expects, then home.
+        Returns the offset in degrees, None if it isn't known.'''
+        _, tpe, _ = self.motor.ReadPosition()
+        offset = None
+        if tpe is not None and self.expected is not None:
+            offset = (tpe - self.expected) * self.deg
+            self.rehome_offsets.add(abs(offset))
+            self.rehome_last = offset
+            logger.info(f'Cycle {self.cycles}: before homing TPE {tpe}, '
+                        f'expected {self.expected}, offset {offset:.4f} deg')
+        self.motor.GoHome()
+        self.expected = 0
+        if offset is not None:
+            self._check_limit('offset at re-home', offset)
+        return offset
+
+    def _check_limit(self, what, drift):
+        if self.max_drift is not None and abs(drift) > self.max_drift:
+            raise DriftError(f'Cycle {self.cycles}: {what} is {drift:.4f} deg, '
+                             f'more than {self.max_drift}')
+
+    def summary(self):
+        return {
+            'cycles': self.cycles,
+            'elapsed': self.motor.clock.monotonic() - self._t0,
+            'time': self.motor.clock.now().isoformat(timespec='seconds'),
+            'move_seconds': self.moves.summary(),
+            'errors': dict(self.motor.errors),
+            'timeouts_recovered': self.timeouts,
+            'drift_last': self.drift_last,
+            'drift': self.drift.summary(),
+            'rehome_offset_last': self.rehome_last,
+            'rehome_offset': self.rehome_offsets.summary(),
+        }
+
+    def report(self):
+        '''Print a summary, and append it to summary_file.'''
+        s = self.summary()
+        moves = s['move_seconds']
+        line = f'{s["cycles"]} cycles in {s["elapsed"]:.0f}s'
+        if moves['count']:
+            line += (f', move {moves["recent_mean"]:.3f}s mean / {moves["recent_max"]:.3f}s max'
+                     f' (all: {moves["mean"]:.3f}s / {moves["max"]:.3f}s)')
+        line += f', errors {s["errors"]}'
+        if s['drift_last'] is not None:
+            line += f', drift {s["drift_last"]:.4f} deg (max {s["drift"]["max"]:.4f})'
+        if s['rehome_offset_last'] is not None:
+            line += f', re-home offset {s["rehome_offset_last"]:.4f} deg'
+        print(line)
+        if self.summary_file:
+            with open(self.summary_file, 'a') as f:
+                f.write(json.dumps(s) + '\n')
+        return s
+# vim:expandtab:sw=4:ts=4
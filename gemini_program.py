@@ -0,0 +1,190 @@
+#! /usr/bin/env python
+'''Compile back and forth motion plans into Gemini GT6 programs.
+
+Instead of stepping the table from Python, the whole plan is uploaded once
+as a DEF ... END program and run on the controller, which does the loop and
+the T dwells itself. The host only watches the progress markers that the
+program WRITEs at the end of every cycle.
+'''
+
+import re
+import logging
+
+import StepMotor
+from motion_model import MotionModel
+
+logger = logging.getLogger(__name__)
+
+# Written by the program at the end of each cycle.
+PROGRESS_MARKER = '#'
+
+# Gemini labels: a letter followed by letters/digits, at most 6 characters.
+NAME_RE = re.compile(r'[A-Z][A-Z0-9]{0,5}')
+
+# A setting as sent, e.g. HOMV7 or HOMVF.3.
+SETTING_RE = re.compile(r'([A-Z]+)([-+]?\d*\.?\d+)')
+
+
+def compile_back_forth(name,
+                       number,
+                       degrees_fwd,
+                       degrees_back,
+                       dwell=0,
+                       velocity=None,
+                       accel=None,
+                       home_start=False,
+                       home_end=False,
+                       steps_per_rotation=900000,
+                       ):
+    '''Return the lines of a program that does number forward/back cycles.
+
+    Mirrors do_back_forth(): move degrees_fwd, dwell, move -degrees_back,
+    dwell, with optional homing before and after. velocity and accel are only
+    set when given, otherwise whatever the drive was initialised with is used.
+    number=0 loops until the program is killed.
+    '''
+    name = name.upper()
+    if not NAME_RE.fullmatch(name):
+        raise ValueError(f'Bad Gemini program name: {name!r}')
+    fwd = int(steps_per_rotation * degrees_fwd / 360)
+    back = int(steps_per_rotation * -degrees_back / 360)
+
+    lines = [f'DEF {name}', 'DRIVE1', 'MA0']
+    if velocity:
+        lines.append(f'V{velocity}')
+    if accel:
+        lines += [f'A{accel}', f'AD{accel}']
+    if home_start:
+        lines += StepMotor.HOME_PARAMS + ['HOM0']
+        if dwell:
+            lines.append(f'T{dwell}')
+    lines.append(f'L{number}')
+    for steps in (fwd, back):
+        if steps:
+            lines += [f'D{steps}', 'GO']
+        if dwell:
+            lines.append(f'T{dwell}')
+    lines += [f'WRITE"{PROGRESS_MARKER}"', 'LN']
+    if home_end:
+        lines += StepMotor.HOME_PARAMS + ['HOM0']
+    lines += ['DRIVE0', 'END']
+    return lines
+
+
+def upload_program(motor, lines):
+    '''Define a program on the controller, replacing any old copy.
+
+    The first line must be "DEF <name>". Inside the definition the
+    controller prompts with "- " instead of "> "; send_batch() frames both,
+    so the program goes out as one pipelined burst.
+    '''
+    name = lines[0].split()[1]
+    logger.info(f'Uploading program {name} ({len(lines)} lines)')
+    motor.send_cmd(f'DEL {name}')      # Undefined the first time; that's fine.
+    replies = motor.send_batch(lines)
+    bad = [(cmd, resp.strip()) for cmd, resp in zip(lines, replies)
+           if resp.endswith(StepMotor.RESP_UNDEF)]
+    if bad:
+        if replies[-1].endswith(StepMotor.RESP_PROG):
+            motor.send_cmd('END')       # Don't leave the controller in DEF mode
+        raise StepMotor.StepMotorError(f'Program {name} rejected: {bad}')
+
+
+def _with_margin(seconds):
+    return StepMotor.MOVE_TIMEOUT_FACTOR * seconds + StepMotor.MOVE_TIMEOUT_MARGIN
+
+
+def program_timeouts(motor,
+                     degrees_fwd,
+                     degrees_back,
+                     dwell=0,
+                     velocity=None,
+                     accel=None,
+                     home_start=False,
+                     home_end=False,
+                     ):
+    '''The timeouts for run_program() of a compile_back_forth() program
+    with the same arguments, as a dict of keyword arguments.
+
+    A cycle is given the two moves as the motion model times them, with the
+    margin StepMotor allows a move, and its two dwells. Homing is given a
+    full turn of the table each way at the homing velocity. Empty if the
+    drive settings, and with them the move times, are not known.
+    '''
+    settings = dict(motor.shadow)
+    if velocity:
+        settings['V'] = velocity
+    if accel:
+        settings['A'] = settings['AD'] = accel
+    model = MotionModel.from_settings(settings, motor.steps_per_rotation)
+    if model is None:
+        return {}
+    moves = float(model.schedule([degrees_fwd, -degrees_back])[-1])
+    home = dict(m.groups() for m in map(SETTING_RE.fullmatch, StepMotor.HOME_PARAMS) if m)
+    homing = MotionModel(motor.steps_per_rotation,
+                         vel=float(home['HOMV']),
+                         accel=float(home['HOMA']),
+                         dres=model.dres).time_deg(2 * 360)
+    return {
+        'timeout': _with_margin(moves) + 2 * dwell,
+        'lead_time': _with_margin(homing) + dwell if home_start else 0,
+        'tail_time': _with_margin(homing) if home_end else 0,
+    }
+
+
+def run_program(motor, name, on_progress=None, timeout=None, poll=0.25,
+                number=0, lead_time=0, tail_time=0):
+    '''Run a program and wait for it to finish, returning the cycle count.
+
+    on_progress(n) is called each time the program reports a finished
+    cycle. timeout (default motor.cmd_timeout) is the longest we wait
+    without seeing any progress, not a limit on the whole run: the time a
+    cycle takes, see program_timeouts(). lead_time is added for the first
+    cycle and tail_time after cycle number, for what the program does
+    before and after its loop. If the program takes longer, it is killed
+    with !K and StepMotorTimeout raised.
+    '''
+    if timeout is None:
+        timeout = motor.cmd_timeout
+    logger.info(f'Running program {name}')
+    motor.write_cmd(f'RUN {name}')
+    if not motor.serialport:
+        return 0
+
+    marker = PROGRESS_MARKER.encode()
+    reader = motor.reader
+    cycles = 0
+    counted = 0                 # Bytes of reader.buf already searched for markers
+    clock = motor.clock
+    deadline = clock.monotonic() + lead_time + timeout
+    while True:
+        try:
+            frame = reader.read_frame(min(deadline, clock.monotonic() + poll))
+        except StepMotor.StepMotorTimeout as exc:
+            if clock.monotonic() > deadline:
+                logger.error(f'Program {name} stuck after {cycles} cycles, killing it')
+                motor.Abort(kill=True)
+                try:
+                    motor.Resync()
+                except StepMotor.StepMotorTimeout:
+                    reader.reset()
+                raise exc
+            seen = reader.buf.count(marker, counted)
+            counted = len(reader.buf)
+            if seen:
+                cycles += seen
+                deadline = clock.monotonic() + timeout
+                if number and cycles >= number:
+                    deadline += tail_time
+                if on_progress:
+                    on_progress(cycles)
+            continue
+        seen = frame.count(PROGRESS_MARKER, counted)
+        if seen:
+            cycles += seen
+            if on_progress:
+                on_progress(cycles)
+        if frame.endswith(StepMotor.RESP_UNDEF):
+            raise StepMotor.StepMotorError(f'Program {name} failed: {frame.strip()}')
+        logger.info(f'Program {name} done after {cycles} cycles')
+        return cycles
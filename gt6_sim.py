@@ -0,0 +1,441 @@
+#! /usr/bin/env python
+'''Simulated Gemini GT6 controller on a pseudo-terminal.
+
+The simulator opens a pty and answers on it the way the GT6 does: "> "
+after a command, "? " after an error, "- " while a program is being
+defined. It understands the commands StepMotor uses and holds back the
+reply to GO and HOM for as long as the move would take on the real drive,
+using a trapezoidal velocity profile from DRES, V, A and AD.
+
+time_scale speeds everything up, e.g. time_scale=100 makes a 10 s move
+take 0.1 s, so long runs can be exercised quickly.
+
+Run it stand alone and point the tools at the device it prints:
+
+    python gt6_sim.py --time-scale 20
+    python back_forth.py --port /dev/pts/5
+'''
+
+import os
+import re
+import tty
+import time
+import queue
+import select
+import termios
+import argparse
+import logging
+import threading
+
+from motion_model import move_time, move_position
+
+logger = logging.getLogger(__name__)
+
+PROMPT = '\r\n> '
+PROMPT_ERR = '\r\n? '
+PROMPT_DEF = '\r\n- '
+
+# Command names the simulator acts on; see parse().
+COMMANDS = sorted([
+    'A', 'AD', 'BAUD', 'D', 'DEF', 'DEL', 'DMODE', 'DRES', 'DRIVE', 'ECHO',
+    'END', 'GO', 'HOM', 'HOMA', 'HOMBAC', 'HOMDF', 'HOMEDG', 'HOMV', 'HOMVF',
+    'K', 'L', 'LN', 'LS', 'LSNEG', 'LSPOS', 'MA', 'MC', 'PSET', 'RUN', 'S',
+    'T', 'TAS', 'TPC', 'TPE', 'V', 'WRITE',
+], key=len, reverse=True)
+
+# Settings that just store a number and report it back when sent bare.
+SETTINGS = {
+    'A': 10.0, 'AD': 10.0, 'BAUD': 9600, 'DMODE': 12, 'DRES': 25000,
+    'DRIVE': 0, 'ECHO': 1, 'HOMA': 10.0, 'HOMBAC': 0, 'HOMDF': 0,
+    'HOMEDG': 0, 'HOMV': 1.0, 'HOMVF': 0.1, 'LS': 0, 'LSNEG': 0, 'LSPOS': 0,
+    'MA': 0, 'MC': 0, 'V': 1.0,
+}
+
+# Rates BAUD accepts.
+BAUDRATES = (9600, 19200)
+
+# termios speed constant -> bits per second, to see what rate the host has
+# set its end of the pty to.
+TERMIOS_SPEEDS = {getattr(termios, f'B{rate}'): rate
+                  for rate in (1200, 2400, 4800, 9600, 19200, 38400, 57600, 115200)}
+
+
+#==============================================================================
+# GT6Simulator:
+#==============================================================================
+class GT6Simulator(object):
+    '''A GT6 on the end of a pty. Open self.device with pyserial (or
+    StepMotor.StepMotor(sim.device, journal=False)) to talk to it.
+
+    The link rate matters as on a real serial line: anything sent while
+    the host's end of the pty is set to another rate than the controller's
+    (see BAUD) is garbled, and ignored.'''
+
+    def __init__(self, time_scale=1.0, baudrate=9600, cmd_latency=0.002, wire_delay=True):
+        self.time_scale = time_scale
+        self.baudrate = baudrate
+        self.cmd_latency = cmd_latency     # Controller think time per command
+        self.wire_delay = wire_delay       # Emulate serial line speed on replies
+        self._new_baudrate = None          # Set by BAUD, applied after its reply
+
+        self.settings = dict(SETTINGS, BAUD=baudrate)
+        self.distance = 0                  # D
+        self.position = 0.0                # Commanded position, steps
+        self.homed = False
+        self.limit_hit = 0                 # +1 / -1 when a soft limit stopped us
+        self.motion = None                 # (start, start_pos, steps, V, A, AD)
+        self.programs = {}
+        self.nv = {}                       # Settings outside SETTINGS, see execute()
+        self.defining = None               # Name of program being defined
+
+        self._stop = threading.Event()
+        self._kill = threading.Event()
+        self._write_lock = threading.Lock()
+        self._lock = threading.RLock()
+        self._queue = queue.Queue()
+
+        self.master, self.slave = os.openpty()
+        tty.setraw(self.slave)
+        self.device = os.ttyname(self.slave)
+        self._threads = [
+            threading.Thread(target=self._read_loop, name='gt6sim-rx', daemon=True),
+            threading.Thread(target=self._exec_loop, name='gt6sim-exec', daemon=True),
+        ]
+        for t in self._threads:
+            t.start()
+        logger.info(f'GT6 simulator on {self.device}')
+
+    def close(self):
+        self._stop.set()
+        self._kill.set()
+        self._queue.put(None)
+        for t in self._threads:
+            t.join(1)
+        os.close(self.master)
+        os.close(self.slave)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    #-- Time
+
+    def sleep(self, secs):
+        '''Sleep scaled simulated seconds. Returns False if cut short by a kill.'''
+        return not self._kill.wait(secs / self.time_scale)
+
+    def now(self):
+        '''Simulated seconds.'''
+        return time.monotonic() * self.time_scale
+
+    #-- I/O
+
+    def _write(self, text, baudrate=None):
+        '''Send text to the host. With baudrate, switch to that rate as the
+        text goes out, so the host can't answer at the new rate before the
+        simulator listens at it.'''
+        data = text.encode()
+        if self.wire_delay:
+            # 10 bits per character at the configured rate.
+            time.sleep(len(data) * 10 / self.baudrate)
+        with self._write_lock:
+            if baudrate:
+                self.baudrate = baudrate
+            os.write(self.master, data)
+
+    def _read_loop(self):
+        buf = b''
+        while not self._stop.is_set():
+            r, _, _ = select.select([self.master], [], [], 0.1)
+            if not r:
+                continue
+            try:
+                data = os.read(self.master, 1024)
+            except OSError:
+                return
+            host = self.host_baudrate()
+            if host != self.baudrate:
+                logger.debug(f'Host at {host} baud, not {self.baudrate}: dropped {data!r}')
+                continue
+            buf += data
+            while True:
+                m = re.search(rb'\r\n|[\r\n]', buf)
+                if not m:
+                    break
+                line, buf = buf[:m.start()], buf[m.end():]
+                if self.settings['ECHO']:
+                    self._write(line.decode(errors='replace') + '\r\n')
+                line = line.decode(errors='replace').strip()
+                if line.startswith('!'):
+                    # Immediate commands bypass the queue, even mid move.
+                    self._immediate(line[1:])
+                else:
+                    self._queue.put(line)
+
+    def host_baudrate(self):
+        '''The rate the host has set its end of the pty to.'''
+        try:
+            speed = termios.tcgetattr(self.slave)[5]
+        except termios.error:
+            return None
+        return TERMIOS_SPEEDS.get(speed)
+
+    def _exec_loop(self):
+        while True:
+            line = self._queue.get()
+            if line is None or self._stop.is_set():
+                return
+            if self.cmd_latency:
+                time.sleep(self.cmd_latency / self.time_scale)
+            if self.defining:
+                self._write(self._define(line))
+                continue
+            self._kill.clear()
+            try:
+                out = self.execute(line)
+            except ValueError:
+                out = None
+            baudrate, self._new_baudrate = self._new_baudrate, None
+            if out is None:
+                self._write('*UNDEFINED_LABEL' + PROMPT_ERR)
+            elif self.defining:
+                self._write(out + PROMPT_DEF)
+            else:
+                self._write(out + PROMPT, baudrate)
+            if baudrate:
+                logger.info(f'Now at {baudrate} baud')
+
+    def _immediate(self, line):
+        name, arg = self.parse(line)
+        if name in ('K', 'S'):
+            self._halt()
+        elif name in ('TAS', 'TPC', 'TPE'):
+            self._write(self.execute(line) + '\r\n')
+
+    def _define(self, line):
+        if line.upper() == 'END':
+            logger.debug(f'Defined {self.defining}: {self.programs[self.defining]}')
+            self.defining = None
+            return PROMPT
+        if line:
+            self.programs[self.defining].append(line)
+        return PROMPT_DEF
+
+    #-- Commands
+
+    def parse(self, line):
+        '''Split a command into (name, argument string). The name is the run
+        of letters it starts with, so e.g. DMTR isn't taken for D.'''
+        up = line.upper()
+        m = re.match(r'[A-Z]+', up)
+        if m:
+            return m.group(0), line[m.end():].strip()
+        return up.split()[0] if up else '', ''
+
+    def execute(self, line):
+        '''Run one command. Returns the report text ('' if there is none) or
+        None if the controller wouldn't understand it.'''
+        if not line:
+            return ''
+        name, arg = self.parse(line)
+        if name == 'DEF':
+            self.defining = arg.upper()
+            self.programs[self.defining] = []
+            return ''
+        if name == 'DEL':
+            self.programs.pop(arg.upper(), None)
+            return ''
+        if line.upper() in self.programs:
+            return self.run_program(line.upper())
+        if name == 'RUN':
+            return self.run_program(arg.upper())
+        if name == 'BAUD' and arg:
+            rate = int(float(arg))
+            if rate not in BAUDRATES:
+                return None
+            # Answered at the old rate; the new one applies from then on.
+            self.settings['BAUD'] = rate
+            self._new_baudrate = rate
+            return ''
+        if name in SETTINGS:
+            if arg == '':
+                return f'*{name}{self._fmt(self.settings[name])}'
+            self.settings[name] = float(arg)
+            return ''
+        if name == 'D':
+            if arg == '':
+                return f'*D{self.distance:+d}'
+            self.distance = int(float(arg))
+            return ''
+        if name == 'GO':
+            self.go()
+            return ''
+        if name == 'HOM':
+            self.home()
+            return ''
+        if name == 'PSET':
+            with self._lock:
+                self.position = float(arg or 0)
+            return ''
+        if name == 'TAS':
+            return '*TAS' + self.tas()
+        if name in ('TPC', 'TPE'):
+            return f'*{name}{int(round(self.current_position())):+d}'
+        if name == 'T':
+            self.sleep(float(arg or 0))
+            return ''
+        if name in ('K', 'S'):
+            self._halt()
+            return ''
+        if name == 'WRITE':
+            m = re.fullmatch(r'"(.*)"', arg)
+            return m.group(1) if m else None
+        if name not in COMMANDS and arg:
+            # Any other setting, e.g. the motor and drive setup of a .prg
+            # file: kept as sent, as the NV memory would.
+            self.nv[name] = arg
+            return ''
+        if name in self.nv:
+            return f'*{name}{self.nv[name]}'
+        return None
+
+    def run_program(self, name):
+        '''Execute a defined program. Anything it WRITEs goes straight out.'''
+        lines = self.programs.get(name)
+        if lines is None:
+            return None
+        loops = []                      # [loop start pc, passes left (0=forever)]
+        pc = 0
+        while pc < len(lines) and not self._kill.is_set():
+            line = lines[pc]
+            name, arg = self.parse(line)
+            pc += 1
+            if name == 'L':
+                loops.append([pc, int(float(arg or 0))])
+            elif name == 'LN':
+                loop = loops[-1]
+                loop[1] -= 1
+                if loop[1] != 0:
+                    pc = loop[0]
+                else:
+                    loops.pop()
+            elif name == 'WRITE':
+                self._write(self.execute(line))
+            elif self.execute(line) is None:
+                return '*UNDEFINED_LABEL'
+        return ''
+
+    #-- Motion
+
+    def _fmt(self, value):
+        return f'{int(value)}' if float(value).is_integer() else f'{value:.4f}'
+
+    def _revs(self, steps):
+        return steps / self.settings['DRES']
+
+    def current_position(self):
+        with self._lock:
+            if not self.motion:
+                return self.position
+            start, pos, steps, vel, accel, decel = self.motion
+            t = self.now() - start
+            return pos + move_position(t, self._revs(steps), vel, accel, decel) * self.settings['DRES']
+
+    def _move(self, steps, vel, accel, decel):
+        '''Move steps relative to the current position, blocking for as long
+        as the real move would take (scaled).'''
+        duration = move_time(self._revs(steps), vel, accel, decel)
+        with self._lock:
+            self.motion = (self.now(), self.position, steps, vel, accel, decel)
+        completed = self.sleep(duration)
+        with self._lock:
+            self.position = self.current_position() if not completed else self.motion[1] + steps
+            self.motion = None
+        return completed
+
+    def go(self):
+        target = self.distance if self.settings['MA'] else self.position + self.distance
+        self.limit_hit = 0
+        if self.settings['LS']:
+            if target > self.settings['LSPOS']:
+                target, self.limit_hit = self.settings['LSPOS'], 1
+            elif target < self.settings['LSNEG']:
+                target, self.limit_hit = self.settings['LSNEG'], -1
+        s = self.settings
+        self._move(target - self.position, s['V'], s['A'], s['AD'])
+
+    def home(self):
+        # The home switch is at position 0. Approach at HOMV, and reset the
+        # position to 0 once it's found.
+        s = self.settings
+        self.homed = self._move(-self.position, s['HOMV'], s['HOMA'], s['HOMA'])
+        if self.homed:
+            with self._lock:
+                self.position = 0.0
+
+    def _halt(self):
+        '''K and S: stop the motion and drop the commands still buffered.'''
+        self._kill.set()
+        try:
+            while True:
+                self._queue.get_nowait()
+        except queue.Empty:
+            pass
+
+    def tas(self):
+        '''Axis status, 32 bits in groups of 4, bit 1 first.'''
+        bits = ['0'] * 32
+        with self._lock:
+            motion = self.motion
+        if motion:
+            bits[0] = '1'                               # Moving
+            bits[1] = '1' if motion[2] < 0 else '0'     # Direction
+        bits[4] = '1' if self.homed else '0'
+        bits[5] = '1' if self.settings['MA'] else '0'
+        bits[16] = '1' if self.limit_hit > 0 else '0'
+        bits[17] = '1' if self.limit_hit < 0 else '0'
+        s = ''.join(bits)
+        return '_'.join(s[i:i+4] for i in range(0, 32, 4))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+          description="Simulate a Gemini GT6 on a pseudo-terminal.",
+          formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+          )
+    parser.add_argument("--baudrate",
+                        type=int,
+                        default=9600,
+                        choices=BAUDRATES,
+                        help="Rate the simulated controller starts at",
+                        )
+    parser.add_argument("--time-scale",
+                        type=float,
+                        default=1.0,
+                        help="Run motion this many times faster than real time",
+                        )
+    parser.add_argument(
+        "--verbose", "-v",
+        action='count',
+        default=0,
+        help="use multiple -v for more detailed messages."
+    )
+    args = parser.parse_args()
+    logging.basicConfig(
+          format='%(levelname)-8s [%(filename)s:%(lineno)d] %(message)s',
+          level=logging.WARNING - (10 * args.verbose),
+          )
+    with GT6Simulator(time_scale=args.time_scale, baudrate=args.baudrate) as sim:
+        print(sim.device, flush=True)
+        try:
+            while True:
+                time.sleep(3600)
+        except KeyboardInterrupt:
+            pass
+
+
+if __name__ == '__main__':
+    main()
+# vim:expandtab:sw=4:ts=4
@@ -0,0 +1,177 @@
+#! /usr/bin/env python
+'''Background jobs for the web app.
+
+A job runs an async generator of progress messages, such as main.py's
+do_back_forth(), as an asyncio task of its own. Nothing ties it to the
+HTTP request that started it. Every message gets a sequence number and
+goes into the job's history, a bounded deque of the most recent ones. Any
+number of subscribers can read a job at once: each replays the history
+from the offset it asks for, then follows new messages as they come. A
+subscriber that falls behind or goes away costs the job nothing; the
+motion never waits for a reader.
+'''
+
+import time
+import asyncio
+import logging
+import itertools
+import collections
+
+import StepMotor
+from motor_session import LINK_ERRORS
+
+logger = logging.getLogger(__name__)
+
+PENDING = 'pending'
+RUNNING = 'running'
+DONE = 'done'
+STOPPED = 'stopped'
+FAILED = 'failed'
+
+
+#==============================================================================
+# Job:
+#==============================================================================
+class Job(object):
+    def __init__(self, job_id, name, params=None, table=None, history=1000):
+        self.id = job_id
+        self.name = name
+        self.params = params or {}
+        self.table = table
+        self.state = PENDING
+        self.error = None
+        self.created = time.time()
+        self.started = self.finished = None
+        self.history = collections.deque(maxlen=history)   # (seq, message)
+        self.seq = 0                # Number of messages ever published.
+        self._new = asyncio.Event()
+        self.task = None
+
+    @property
+    def active(self):
+        return self.state in (PENDING, RUNNING)
+
+    def oldest(self):
+        '''Sequence number of the oldest message still held.'''
+        return self.history[0][0] if self.history else self.seq
+
+    def publish(self, message):
+        self.history.append((self.seq, message))
+        self.seq += 1
+        self._wake()
+
+    def _wake(self):
+        self._new.set()
+        self._new = asyncio.Event()
+
+    async def run(self, messages):
+        '''Publish everything the async generator messages yields.'''
+        self.state = RUNNING
+        self.started = time.time()
+        try:
+            async for message in messages:
+                self.publish(message)
+            self.state = DONE
+        except asyncio.CancelledError:
+            self.state = STOPPED
+            self.publish('Operation was canceled.')
+        except StepMotor.StepMotorAborted:
+            self.state = STOPPED
+            self.publish('Operation stopped by user.')
+        except LINK_ERRORS as exc:
+            self.state = FAILED
+            self.error = str(exc)
+            self.publish(f'Motor error: {exc}')
+        except Exception as exc:
+            logger.exception(f'Job {self.id} failed')
+            self.state = FAILED
+            self.error = str(exc)
+            self.publish(f'Error: {exc}')
+        finally:
+            self.finished = time.time()
+            self._wake()
+
+    async def follow(self, offset=0):
+        '''Yield (seq, message) from sequence number offset on, live, until
+        the job is over. Messages that have already dropped out of the
+        history are skipped; the gap shows in the sequence numbers.'''
+        while True:
+            new = self._new
+            for seq, message in list(self.history):
+                if seq >= offset:
+                    yield seq, message
+                    offset = seq + 1
+            offset = max(offset, self.oldest())
+            if offset >= self.seq:
+                if not self.active:
+                    return
+                await new.wait()
+
+    def status(self):
+        return {
+            'id': self.id,
+            'name': self.name,
+            'params': self.params,
+            'table': self.table.id if self.table else None,
+            'state': self.state,
+            'error': self.error,
+            'created': self.created,
+            'started': self.started,
+            'finished': self.finished,
+            'messages': self.seq,
+            'oldest': self.oldest(),
+        }
+
+
+#==============================================================================
+# JobManager:
+#==============================================================================
+class JobManager(object):
+    '''The jobs of the app, newest last. Only the last keep jobs that have
+    finished are remembered.'''
+    def __init__(self, keep=50, history=1000):
+        self.keep = keep
+        self.history = history
+        self.jobs = collections.OrderedDict()
+        self._ids = itertools.count(1)
+
+    def submit(self, name, messages, params=None, table=None):
+        '''Start a job that publishes the messages of the async generator
+        messages, and return it.'''
+        job = Job(str(next(self._ids)), name, params, table, self.history)
+        job.task = asyncio.create_task(job.run(messages))
+        self.jobs[job.id] = job
+        self._prune()
+        logger.info(f'Job {job.id}: {name} {params or ""}')
+        return job
+
+    def _prune(self):
+        done = [job_id for job_id, job in self.jobs.items() if not job.active]
+        for job_id in done[:max(0, len(done) - self.keep)]:
+            del self.jobs[job_id]
+
+    def get(self, job_id):
+        '''The job with this ID. Raises KeyError if there is none.'''
+        return self.jobs[job_id]
+
+    def __iter__(self):
+        return iter(self.jobs.values())
+
+    def running(self, table=None):
+        '''Jobs that haven't finished, optionally only those on table.'''
+        return [job for job in self
+                if job.active and (table is None or job.table is table)]
+
+    async def cancel(self, job_id):
+        '''Cancel the job's task outright, and wait for it to finish.'''
+        job = self.get(job_id)
+        if job.task and not job.task.done():
+            job.task.cancel()
+            await asyncio.gather(job.task, return_exceptions=True)
+        return job
+
+    async def stop(self):
+        '''Cancel every job still running, e.g. when the app shuts down.'''
+        for job in self.running():
+            await self.cancel(job.id)
+# vim:expandtab:sw=4:ts=4
@@ -0,0 +1,193 @@
+#! /usr/bin/env python
+'''Binary journal of every command sent to the GT6 and the reply it got.
+
+Each exchange becomes one fixed width record: monotonic send and receive
+times, the StepMotor operation that sent it (MoveDegrees, GoHome, ...),
+the command, the reply text and how the reply ended. Records go into a
+memory mapped segment file, so logging one is a struct.pack_into() and
+no system call. When a segment is full a new one is started. Only the
+newest `keep` segments with the journal's prefix are kept; StepMotor
+gives the journal of each port a prefix of its own (see port_prefix()),
+so tables sharing a directory don't prune each other's segments.
+
+Each segment header carries a wall clock / monotonic clock pair, so
+load_journal() can put absolute times on every record:
+
+    python journal.py ~/.rotation_table/journal/gt6-ttyUSB0-*.bin
+'''
+
+import os
+import re
+import sys
+import glob
+import mmap
+import time
+import struct
+import logging
+import itertools
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b'GT6J'
+VERSION = 1
+
+# magic, version, record size, wall time and monotonic time at start, count
+HEADER = struct.Struct('<4sHHddQ')
+HEADER_SIZE = 64
+COUNT_OFFSET = 24
+
+# t_send, t_recv, operation, command, reply, status
+RECORD = struct.Struct('<dd16s24s48sB7x')
+
+# How the reply ended.
+OK = 0              # "> "
+ERROR = 1           # "? "
+PROGRAM = 2         # "- ", stored in a program definition
+TIMEOUT = 3         # No prompt before the deadline
+NO_REPLY = 4        # Sent without waiting for a reply (or dry run)
+STATUS_NAMES = ['ok', 'error', 'program', 'timeout', 'no_reply']
+
+# Numbers the journals of this process, so two of them (one per table)
+# never map the same file.
+_instances = itertools.count()
+
+
+def port_prefix(port, prefix='gt6'):
+    '''Segment file prefix for the journal of a serial port, e.g.
+    gt6-ttyUSB0 for /dev/ttyUSB0.'''
+    name = re.sub(r'[^A-Za-z0-9_.]+', '_', os.path.basename(port))
+    return f'{prefix}-{name}'
+
+
+#==============================================================================
+# Journal:
+#==============================================================================
+class Journal(object):
+    def __init__(self, directory, max_bytes=16 << 20, keep=20, prefix='gt6'):
+        self.directory = directory
+        self.max_bytes = max(max_bytes, HEADER_SIZE + RECORD.size)
+        self.keep = keep
+        self.prefix = prefix
+        self.path = None
+        self._file = None
+        self._mm = None
+        self._segment = 0
+        self._instance = next(_instances)
+        os.makedirs(directory, exist_ok=True)
+        self._open_segment()
+
+    def _open_segment(self):
+        stamp = time.strftime('%Y%m%d-%H%M%S')
+        self.path = os.path.join(
+            self.directory,
+            f'{self.prefix}-{stamp}-{os.getpid()}.{self._instance}-{self._segment:03d}.bin')
+        self._segment += 1
+        self._file = open(self.path, 'w+b')
+        self._file.truncate(self.max_bytes)
+        self._mm = mmap.mmap(self._file.fileno(), self.max_bytes)
+        HEADER.pack_into(self._mm, 0, MAGIC, VERSION, RECORD.size,
+                         time.time(), time.monotonic(), 0)
+        self.count = 0
+        self.capacity = (self.max_bytes - HEADER_SIZE) // RECORD.size
+        self._prune()
+        logger.info(f'Journal: {self.path}')
+
+    def _close_segment(self):
+        used = HEADER_SIZE + self.count * RECORD.size
+        self._mm.close()
+        self._file.truncate(used)
+        self._file.close()
+        self._mm = self._file = None
+
+    def _prune(self):
+        # Segment names go on with the date after the prefix, so e.g. gt6
+        # doesn't take in gt6-ttyUSB0-..., nor gt6-ttyUSB1 gt6-ttyUSB10-...
+        old = sorted(glob.glob(os.path.join(self.directory, f'{self.prefix}-[0-9]*.bin')),
+                     key=os.path.getmtime)
+        for fname in old[:-self.keep]:
+            if fname != self.path:
+                os.remove(fname)
+
+    def record(self, t_send, t_recv, op, cmd, reply, status):
+        '''Append one exchange. reply is stored without its prompt.'''
+        if self._mm is None:
+            return
+        if self.count >= self.capacity:
+            self._close_segment()
+            self._open_segment()
+        RECORD.pack_into(self._mm, HEADER_SIZE + self.count * RECORD.size,
+                         t_send, t_recv, op.encode(), cmd.encode(),
+                         reply.encode(errors='replace'), status)
+        self.count += 1
+        struct.pack_into('<Q', self._mm, COUNT_OFFSET, self.count)
+
+    def close(self):
+        if self._mm is not None:
+            self._close_segment()
+
+
+#==============================================================================
+# Reading:
+#==============================================================================
+def record_dtype():
+    '''NumPy dtype matching RECORD.'''
+    # NumPy is only needed to read journals, not to write them.
+    import numpy as np
+    dtype = np.dtype([
+        ('t_send', '<f8'),
+        ('t_recv', '<f8'),
+        ('op', 'S16'),
+        ('cmd', 'S24'),
+        ('reply', 'S48'),
+        ('status', 'u1'),
+        ('pad', 'V7'),
+    ])
+    assert dtype.itemsize == RECORD.size
+    return dtype
+
+
+def load_journal(path):
+    '''Load one segment into a dict of NumPy arrays: t_send, t_recv (monotonic
+    seconds), wall_send, wall_recv (time.time() seconds), op, cmd, reply
+    (bytes) and status.'''
+    import numpy as np
+    with open(path, 'rb') as f:
+        magic, version, rsize, wall0, mono0, count = HEADER.unpack(f.read(HEADER.size))
+    if magic != MAGIC or rsize != RECORD.size:
+        raise ValueError(f'{path} is not a version {VERSION} journal')
+    rec = np.fromfile(path, dtype=record_dtype(), count=count, offset=HEADER_SIZE)
+    out = {name: rec[name] for name in ('t_send', 't_recv', 'op', 'cmd', 'reply', 'status')}
+    out['wall_send'] = rec['t_send'] - mono0 + wall0
+    out['wall_recv'] = rec['t_recv'] - mono0 + wall0
+    return out
+
+
+def load_journals(paths):
+    '''Load and concatenate several segments, in time order.'''
+    import numpy as np
+    parts = [load_journal(p) for p in paths]
+    if not parts:
+        return {}
+    out = {k: np.concatenate([p[k] for p in parts]) for k in parts[0]}
+    order = np.argsort(out['wall_send'], kind='stable')
+    return {k: v[order] for k, v in out.items()}
+
+
+def fmt_time(t):
+    return time.strftime('%H:%M:%S', time.localtime(t)) + f'.{int(t * 1000) % 1000:03d}'
+
+
+def main():
+    j = load_journals(sys.argv[1:])
+    for i in range(len(j.get('cmd', []))):
+        print(fmt_time(j['wall_send'][i]),
+              f"{1000 * (j['t_recv'][i] - j['t_send'][i]):8.1f}ms",
+              f"{j['op'][i].decode():16s}",
+              f"{j['cmd'][i].decode():12s}",
+              f"{STATUS_NAMES[j['status'][i]]:8s}",
+              j['reply'][i].decode())
+
+
+if __name__ == '__main__':
+    main()
+# vim:expandtab:sw=4:ts=4
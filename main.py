@@ -1,27 +1,54 @@
-from fastapi import FastAPI, Request, Query
-from fastapi.responses import HTMLResponse, StreamingResponse
+from fastapi import FastAPI, Request, Query, Header, Depends, HTTPException
+from fastapi.responses import HTMLResponse, StreamingResponse, Response
 from fastapi.templating import Jinja2Templates
+import json
 import asyncio
 import time
 import datetime
+import contextlib
 
 import StepMotor
+import metrics
+from AsyncStepMotor import AsyncStepMotor
+from motor_session import LINK_ERRORS
+from table_registry import TableRegistry
+from jobs import JobManager
 
 
+# One connection per table for the life of the app, each with its position
+# readout sampled whenever its motor isn't busy. Set ROTATION_TABLES (or
+# ROTATION_TABLE_PORT for a single table) to skip the port search; see
+# table_registry.py. Routes without a table ID use the first table.
+registry = TableRegistry.from_env()
+
+# Back and forth runs, in the background so they outlive the page that
+# started them. See jobs.py.
+jobs = JobManager()
+
+@contextlib.asynccontextmanager
+async def lifespan(app: FastAPI):
+    await registry.start()
+    yield
+    await jobs.stop()
+    await registry.stop()
+
 # Initialize FastAPI app and Jinja2 templates
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
 templates = Jinja2Templates(directory="templates")
 
-# Global cancel event to signal when the process should stop
-cancel_event = asyncio.Event()
+def get_table(table_id):
+    """The table with this ID (the first one for None), or a 404."""
+    try:
+        return registry.get(table_id)
+    except KeyError:
+        raise HTTPException(status_code=404, detail=f"No table {table_id!r}")
 
 @app.get("/", response_class=HTMLResponse)
 async def home(request: Request):
     """Render the main web page with the form, submit, and stop buttons."""
     return templates.TemplateResponse("index.html", {"request": request})
 
-@app.get("/progress")
-async def stream_progress(
+def back_forth_params(
     dry_run: bool = Query(False),
     velocity: float = Query(1.0),
     accel: float = Query(1.0),
@@ -31,101 +58,313 @@ async def stream_progress(
     degrees_back: float = Query(0.0),
     home_start: bool = Query(True),
     home_end: bool = Query(False),
+    table: str = Query(None),
     ):
-    """Stream real-time progress updates from the do_back_forth() function with user input."""
-    cancel_event.clear()  # Reset cancel event when a new process starts
+    """The do_back_forth() settings of a request."""
+    return dict(dry_run=dry_run, velocity=velocity, accel=accel,
+                sleep_seconds=sleep_seconds, number=number,
+                degrees_fwd=degrees_fwd, degrees_back=degrees_back,
+                home_start=home_start, home_end=home_end, table=table)
+
+
+def start_back_forth(params):
+    """Start do_back_forth() as a background job."""
+    table = get_table(params["table"])
+    table.cancel_event.clear()  # Reset cancel event when a new process starts
+    args = dict(params, table=table)
+    return jobs.submit("back_forth", do_back_forth(**args), params, table)
+
+
+def sse(seq, message):
+    """One server-sent event; the id lets a reconnecting client resume."""
+    data = "".join(f"data: {line}\n" for line in str(message).split("\n"))
+    return f"id: {seq}\n{data}\n"
+
 
+def stream_job(job, offset=0):
+    """Stream a job's messages from offset on, then an "end" event."""
     async def event_generator():
-        """Yield progress messages from the do_back_forth() function."""
-        try:
-            for progress in do_back_forth(
-                dry_run, velocity, accel, sleep_seconds,
-                number, degrees_fwd, degrees_back, home_start, home_end
-            ):
-                if cancel_event.is_set():  # Check if the process should stop
-                    yield "data: Operation stopped by user.\n\n"
-                    break
-                yield f"data: {progress}\n\n"
-                await asyncio.sleep(0.5)
-        except asyncio.CancelledError:
-            yield "data: Operation was canceled.\n\n"
+        async for seq, message in job.follow(offset):
+            yield sse(seq, message)
+        yield f"event: end\ndata: {job.state}\n\n"
 
     return StreamingResponse(event_generator(), media_type="text/event-stream")
 
 
+def get_job(job_id):
+    try:
+        return jobs.get(job_id)
+    except KeyError:
+        raise HTTPException(status_code=404, detail=f"No job {job_id!r}")
+
+
+@app.get("/progress")
+async def stream_progress(params: dict = Depends(back_forth_params)):
+    """Start a back and forth run and stream its progress. The run is a
+    background job, see /jobs; it carries on if this stream is closed."""
+    return stream_job(start_back_forth(params))
+
+
+@app.post("/jobs")
+async def submit_job(params: dict = Depends(back_forth_params)):
+    """Start a back and forth run in the background. Follow it with
+    /jobs/{id}/events."""
+    return start_back_forth(params).status()
+
+
+@app.get("/jobs")
+async def list_jobs():
+    """Recent jobs, oldest first."""
+    return [job.status() for job in jobs]
+
+
+@app.get("/jobs/{job_id}")
+async def job_status(job_id: str):
+    return get_job(job_id).status()
+
+
+@app.get("/jobs/{job_id}/events")
+async def job_events(
+    job_id: str,
+    offset: int = Query(0, ge=0),
+    last_event_id: str = Header(None),
+    ):
+    """Stream a job's progress: the messages from offset on, live until the
+    job ends. Any number of clients can follow the same job. A reconnecting
+    EventSource carries on after the last message it got."""
+    job = get_job(job_id)
+    if last_event_id and last_event_id.isdigit():
+        offset = int(last_event_id) + 1
+    return stream_job(job, offset)
+
+
+@app.post("/jobs/{job_id}/stop")
+async def stop_job(job_id: str):
+    """Stop a job, and the table it runs on."""
+    job = get_job(job_id)
+    # A dry run only has a throw away motor; the table may be busy with
+    # something else, so leave it alone.
+    if job.table and not job.params.get("dry_run"):
+        return await stop_process(job.table.id, kill=True)
+    await jobs.cancel(job_id)
+    return {"message": "Job canceled"}
+
+
+@app.get("/status")
+async def status(table: str = Query(None)):
+    """Report whether the table is connected and whether it is in use."""
+    session = get_table(table).session
+    return {"connected": session.connected, "busy": session.lock.locked()}
+
+
+@app.get("/telemetry")
+async def stream_telemetry(rate: float = Query(2.0, gt=0, le=50), table: str = Query(None)):
+    """Stream the table position as JSON events, at most rate per second."""
+    telemetry = get_table(table).telemetry
+
+    async def event_generator():
+        async for sample in telemetry.subscribe(rate):
+            yield f"data: {json.dumps(sample)}\n\n"
+
+    return StreamingResponse(event_generator(), media_type="text/event-stream")
+
+
+@app.get("/metrics")
+async def serve_metrics():
+    """Serial link and drive counters in the Prometheus text format: command
+    latency by opcode, error replies, bytes, moves, degrees travelled, port
+    probes. See the metrics at the top of StepMotor.py."""
+    return Response(metrics.render(), media_type=metrics.CONTENT_TYPE)
+
+
+@app.get("/tables")
+async def list_tables():
+    """Every table this app drives, with its port and state."""
+    return registry.status()
+
+
+async def table_operation(table_id, fn):
+    """Run fn(motor) with exclusive use of one table and report where it ended up."""
+    table = get_table(table_id)
+    try:
+        async with table.session.connection() as motor:
+            await fn(motor)
+            tpc, tpe, tas = await motor.read_position()
+    except StepMotor.StepMotorAborted:
+        raise HTTPException(status_code=409, detail=f"Table {table.id}: stopped")
+    except LINK_ERRORS as exc:
+        raise HTTPException(status_code=503, detail=f"Table {table.id}: {exc}")
+    deg = 360 / motor.motor.steps_per_rotation
+    return {"table": table.id, "position": tpc * deg if tpc is not None else None}
+
+
+@app.post("/tables/{table_id}/move")
+async def move_table(table_id: str, degrees: float):
+    """Move one table by degrees."""
+    return await table_operation(table_id, lambda motor: motor.move_degrees(degrees))
+
+
+@app.post("/tables/{table_id}/goto")
+async def goto_table(table_id: str, degrees: float):
+    """Move one table to an absolute position."""
+    return await table_operation(table_id, lambda motor: motor.go_to_degrees(degrees))
+
+
+@app.post("/tables/{table_id}/home")
+async def home_table(table_id: str):
+    """Home one table."""
+    return await table_operation(table_id, lambda motor: motor.go_home())
+
+
+@app.post("/goto_all")
+async def goto_all(degrees: float, tables: str = Query(None)):
+    """Move several tables (comma separated IDs, default all) to the same
+    absolute position at the same time."""
+    ids = tables.split(",") if tables else None
+    if ids:
+        for table_id in ids:
+            get_table(table_id)
+    t0 = time.monotonic()
+    results = await registry.go_to_degrees(degrees, ids)
+    return {
+        "degrees": degrees,
+        "elapsed": time.monotonic() - t0,
+        "tables": {table_id: "ok" if not isinstance(result, BaseException) else str(result)
+                   for table_id, result in results.items()},
+    }
+
+
+@contextlib.asynccontextmanager
+async def open_motor(dry_run: bool, table=None, motor=None):
+    """The motor for one operation: the one given, the table's session, or a
+    throw away dry run one."""
+    if motor is not None:
+        yield motor
+    elif dry_run:
+        motor = await AsyncStepMotor.open('dryrun')
+        try:
+            yield motor
+        finally:
+            await motor.close()
+    else:
+        table = table or registry.get()
+        async with table.session.connection() as motor:
+            yield motor
+
+
 @app.post("/stop")
-async def stop_process():
-    """Stop the do_back_forth process by setting the cancel event."""
-    return {"message": "Process stopped"}
+async def stop_process(table: str = Query(None), kill: bool = Query(True)):
+    """Emergency stop one table, or every table if none is given.
+
+    Sets the table's cancel event, so a running back and forth ends, and
+    sends the controller its immediate kill (or with kill=false, stop)
+    command without waiting for the command queue. A move in progress is cut
+    short. Reports how long it took to get the stop out, in ms.
+    """
+    t0 = time.monotonic()
+    tables = [get_table(table)] if table else list(registry)
 
-def do_back_forth(
+    async def stop(t):
+        t.cancel_event.set()
+        if await t.session.abort(kill) is None:
+            return None             # Not connected, nothing to stop.
+        return 1000 * (time.monotonic() - t0)
+
+    latency = await asyncio.gather(*(stop(t) for t in tables))
+    latency = {t.id: ms for t, ms in zip(tables, latency)}
+    return {"message": "Process stopped", "latency_ms": latency}
+
+async def do_back_forth(
     dry_run: bool,
     velocity: float,
     accel: float,
     sleep_seconds: float,
     number: int, degrees_fwd: float, degrees_back: float,
-    home_start: bool, home_end: bool
+    home_start: bool, home_end: bool,
+    table=None,
+    motor=None,
 ):
-    """Simulate a process that provides real-time updates using user-provided parameters."""
+    """Move the table back and forth, yielding real-time progress updates.
+
+    The motor is the table's long lived session (see open_motor()), driven
+    through AsyncStepMotor so the serial I/O and the waits for motion happen
+    off the event loop. An AsyncStepMotor passed as motor is used instead,
+    e.g. one replaying a recording (see replay.py); the dwells and times
+    follow its clock.
+    """
 
     yield f"{dry_run=}\t{velocity=}\t{accel=}\t{sleep_seconds=}"
     yield f"{number=}\t{degrees_fwd=}\t{degrees_back=}"
     yield f"{home_start=}\t{home_end=}\n"
-    time.sleep(0.5)
 
-    start_time = datetime.datetime.now()
+    def check_stop():
+        """Don't start another move once stop has been pressed."""
+        if table is not None and table.cancel_event.is_set():
+            raise StepMotor.StepMotorAborted("Stopped")
+
+    async def pause(secs):
+        """Dwell, but no longer than it takes someone to press stop."""
+        event = table.cancel_event if table is not None else asyncio.Event()
+        await clock.wait_async(event, secs)
 
     deg = 0
-    if dry_run:
-        print('Init dry run')
-        if not dry_run:
-            motor = StepMotor.StepMotor('dry_run')
-    else:
-        print('Go for it')
-        if not dry_run:
-            motor = StepMotor.StepMotor()
-
-    if velocity and accel:
-        print('Initializing Motor Parameters')
-        if not dry_run:
-            motor.InitializeDrive(enable_limits=False,
-                          vel=velocity,
-                          accel=accel,
-                          )
-        print('Done')
-
-    if home_start:
-        yield "Homing to start position..."
-        if not dry_run:
-            motor.GoHome()
-        yield f"   Done"
-        time.sleep(sleep_seconds)
-        yield f"   Sleep Done"
-
-    for i in range(1, number + 1):
-        deg += degrees_fwd
-        yield f"n:{i} - Fwd {degrees_fwd} — Position {deg} degrees"
-        if not dry_run:
-            motor.MoveDegrees(degrees_fwd)
-        yield f"   Done"
-        time.sleep(sleep_seconds)
-        yield f"   Sleep Done"
-
-        deg -= degrees_back
-        yield f"n:{i} - Rev {degrees_back} — Position {deg} degrees"
-        if not dry_run:
-            motor.MoveDegrees(-degrees_back)
-        yield f"   Done"
-        time.sleep(sleep_seconds)
-        yield f"   Sleep Done"
-
-    if home_end:
-        yield "Homing to end position..."
-        if not dry_run:
-            motor.GoHome()
-        yield f"   Done"
-        time.sleep(sleep_seconds)
-        yield f"   Sleep Done"
-
-    end_time = datetime.datetime.now()
+    print('Init dry run' if dry_run else 'Go for it')
+    async with open_motor(dry_run, table, motor) as motor:
+        clock = motor.motor.clock
+        start_time = clock.now()
+        if velocity and accel:
+            print('Initializing Motor Parameters')
+            await motor.initialize_drive(enable_limits=False,
+                                         vel=velocity,
+                                         accel=accel,
+                                         )
+            print('Done')
+
+        # Predicted finish of each move (dwell included), for the ETA.
+        moves = [degrees_fwd, -degrees_back] * number
+        model = motor.motor.motion_model()
+        schedule = model.schedule(moves, sleep_seconds) if model and moves else None
+        def eta(done):
+            if schedule is None:
+                return ""
+            left = schedule[-1] - (schedule[done - 1] if done else 0)
+            return f" — ETA {datetime.timedelta(seconds=round(left))}"
+
+        if schedule is not None:
+            yield f"Estimated time for the moves: {datetime.timedelta(seconds=round(schedule[-1]))}"
+
+        if home_start:
+            yield "Homing to start position..."
+            check_stop()
+            await motor.go_home()
+            yield f"   Done"
+            await pause(sleep_seconds)
+            yield f"   Sleep Done"
+
+        for i in range(1, number + 1):
+            deg += degrees_fwd
+            yield f"n:{i} - Fwd {degrees_fwd} — Position {deg} degrees{eta(2 * i - 2)}"
+            check_stop()
+            await motor.move_degrees(degrees_fwd)
+            yield f"   Done"
+            await pause(sleep_seconds)
+            yield f"   Sleep Done"
+
+            deg -= degrees_back
+            yield f"n:{i} - Rev {degrees_back} — Position {deg} degrees{eta(2 * i - 1)}"
+            check_stop()
+            await motor.move_degrees(-degrees_back)
+            yield f"   Done"
+            await pause(sleep_seconds)
+            yield f"   Sleep Done"
+
+        if home_end:
+            yield "Homing to end position..."
+            check_stop()
+            await motor.go_home()
+            yield f"   Done"
+            await pause(sleep_seconds)
+            yield f"   Sleep Done"
+
+        end_time = clock.now()
     yield f'Done. Elapsed time: {end_time - start_time}'
@@ -0,0 +1,177 @@
+#! /usr/bin/env python
+'''Counters and histograms for the serial link, in Prometheus text format.
+
+Every metric lives in a Registry (REGISTRY unless told otherwise) and is
+rendered by render(), which main.py serves as /metrics. Labelled metrics
+hand out a child per set of label values; callers on a hot path look the
+child up once and keep it. Histogram buckets are fixed when the metric is
+made, so an observation is a bisect and three additions under a lock, and
+nothing is allocated.
+
+    LATENCY = Histogram('gt6_command_seconds', 'Command round trip',
+                        ('opcode', 'port'), LATENCY_BUCKETS)
+    LATENCY.labels('TPC', '/dev/ttyUSB0').observe(0.012)
+'''
+
+import bisect
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Seconds. The reply to GO and HOM only comes at the end of the move, so the
+# top buckets cover whole moves.
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1, 2.5, 5, 10, 30, 60, 120)
+
+
+#==============================================================================
+# Registry:
+#==============================================================================
+class Registry(object):
+    def __init__(self):
+        self.metrics = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            if metric.name in self.metrics:
+                raise ValueError(f'Duplicate metric {metric.name}')
+            self.metrics[metric.name] = metric
+        return metric
+
+    def render(self):
+        '''All metrics in the Prometheus text exposition format.'''
+        lines = []
+        for metric in list(self.metrics.values()):
+            lines.append(f'# HELP {metric.name} {metric.help}')
+            lines.append(f'# TYPE {metric.name} {metric.kind}')
+            lines.extend(metric.samples())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+
+def _escape(value):
+    return str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+
+def _labels(names, values, extra=()):
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    pairs += [f'{n}="{v}"' for n, v in extra]
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _fmt(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+#==============================================================================
+# Metrics:
+#==============================================================================
+class Metric(object):
+    kind = 'untyped'
+
+    def __init__(self, name, help, labelnames=(), registry=REGISTRY):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.children = {}
+        self._lock = threading.Lock()
+        if registry is not None:
+            registry.register(self)
+
+    def labels(self, *values):
+        '''The child for these label values, made on first use.'''
+        values = tuple(str(v) for v in values)
+        child = self.children.get(values)
+        if child is None:
+            if len(values) != len(self.labelnames):
+                raise ValueError(f'{self.name}: expected labels {self.labelnames}')
+            with self._lock:
+                child = self.children.setdefault(values, self._child())
+        return child
+
+    def samples(self):
+        for values, child in list(self.children.items()):
+            yield from child.samples(self.name, self.labelnames, values)
+
+
+class _CounterChild(object):
+    __slots__ = ('value', '_lock')
+
+    def __init__(self):
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def samples(self, name, labelnames, values):
+        yield f'{name}{_labels(labelnames, values)} {_fmt(self.value)}'
+
+
+class Counter(Metric):
+    '''A count that only goes up. Name it ..._total.'''
+    kind = 'counter'
+
+    def _child(self):
+        return _CounterChild()
+
+    def inc(self, amount=1):
+        '''Count for a metric without labels.'''
+        self.labels().inc(amount)
+
+
+class _HistogramChild(object):
+    __slots__ = ('bounds', 'counts', 'sum', '_lock')
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)   # The last one is +Inf
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        i = bisect.bisect_left(self.bounds, value)
+        with self._lock:
+            self.counts[i] += 1
+            self.sum += value
+
+    def samples(self, name, labelnames, values):
+        with self._lock:
+            counts, total = list(self.counts), self.sum
+        cumulative = 0
+        for bound, n in zip(self.bounds + (float('inf'),), counts):
+            cumulative += n
+            yield f'{name}_bucket{_labels(labelnames, values, [("le", _fmt(bound))])} {cumulative}'
+        yield f'{name}_sum{_labels(labelnames, values)} {_fmt(total)}'
+        yield f'{name}_count{_labels(labelnames, values)} {cumulative}'
+
+
+class Histogram(Metric):
+    '''Observations counted into fixed buckets, given as their upper bounds.'''
+    kind = 'histogram'
+
+    def __init__(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS,
+                 registry=REGISTRY):
+        self.buckets = tuple(float(b) for b in sorted(buckets))
+        super().__init__(name, help, labelnames, registry)
+
+    def _child(self):
+        return _HistogramChild(self.buckets)
+
+    def observe(self, value):
+        '''Observe for a metric without labels.'''
+        self.labels().observe(value)
+
+
+def render(registry=REGISTRY):
+    return registry.render()
+# vim:expandtab:sw=4:ts=4
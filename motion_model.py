@@ -0,0 +1,122 @@
+#! /usr/bin/env python
+'''How long table moves take, from the drive parameters.
+
+The GT6 moves with a trapezoidal velocity profile: accelerate at A up to V
+(revs/s of the motor), cruise, and decelerate at AD. A move that is too
+short to reach V has a triangular profile instead. Distances are in motor
+revolutions; DRES counts make one revolution and steps_per_rotation counts
+one turn of the table.
+
+Everything here works on NumPy arrays as well as single numbers, so a
+whole plan of moves is timed in one call:
+
+    model = MotionModel(vel=5, accel=10)
+    model.time_deg([10, -10] * 1000).sum()
+'''
+
+import logging
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+DRES = 25000        # As set by StepMotor.InitializeDrive()
+
+# Host and serial link time on top of the motion itself, per move: the
+# command burst, the GO reply and the WaitForMotion() polls at 9600 baud,
+# as measured with bench.py.
+MOVE_OVERHEAD = 0.2
+
+
+def _result(x):
+    return x if np.ndim(x) else float(x)
+
+
+def _profile(revs, vel, accel, decel):
+    '''Peak velocity, acceleration time, deceleration time and total time
+    for moves of revs (>= 0) revolutions.'''
+    d_ramps = vel * vel / (2 * accel) + vel * vel / (2 * decel)
+    vpeak = np.where(revs >= d_ramps, vel,
+                     np.sqrt(2 * revs * accel * decel / (accel + decel)))
+    t_acc = vpeak / accel
+    t_dec = vpeak / decel
+    total = t_acc + t_dec + np.maximum(revs - d_ramps, 0) / vel
+    return vpeak, t_acc, t_dec, total
+
+
+def move_time(revs, vel, accel, decel=None):
+    '''Seconds to move revs motor revolutions with a trapezoidal profile,
+    falling back to a triangular one if the move is too short to reach vel.'''
+    if decel is None:
+        decel = accel
+    revs = np.abs(np.asarray(revs, dtype=float))
+    return _result(_profile(revs, vel, accel, decel)[3])
+
+
+def move_position(t, revs, vel, accel, decel=None):
+    '''Distance (revs, same sign as revs) covered t seconds into a move.'''
+    if decel is None:
+        decel = accel
+    revs = np.asarray(revs, dtype=float)
+    t = np.maximum(np.asarray(t, dtype=float), 0)
+    dist = np.abs(revs)
+    vpeak, t_acc, t_dec, total = _profile(dist, vel, accel, decel)
+    left = total - t
+    d = np.where(t < t_acc, 0.5 * accel * t * t,
+        np.where(t < total - t_dec, vpeak * t_acc / 2 + vpeak * (t - t_acc),
+                 dist - 0.5 * decel * left * left))
+    d = np.where(t >= total, dist, d)
+    return _result(np.copysign(d, revs))
+
+
+#==============================================================================
+# MotionModel:
+#==============================================================================
+class MotionModel(object):
+    '''Move times for one set of drive parameters, in table units.'''
+    def __init__(self, steps_per_rotation=900000, vel=5, accel=10, decel=None,
+                 dres=DRES, overhead=MOVE_OVERHEAD):
+        self.steps_per_rotation = steps_per_rotation
+        self.vel = vel
+        self.accel = accel
+        self.decel = accel if decel is None else decel
+        self.dres = dres
+        self.overhead = overhead
+
+    @classmethod
+    def from_settings(cls, settings, steps_per_rotation=900000, **kwargs):
+        '''Model for the drive settings in a dict like StepMotor.shadow
+        ({'V': 5.0, 'A': 10.0, ...}). None if V or A are not known.'''
+        if not settings.get('V') or not settings.get('A'):
+            return None
+        return cls(steps_per_rotation,
+                   vel=settings['V'],
+                   accel=settings['A'],
+                   decel=settings.get('AD') or settings['A'],
+                   dres=settings.get('DRES') or DRES,
+                   **kwargs)
+
+    def revs(self, steps):
+        return np.asarray(steps, dtype=float) / self.dres
+
+    def time_steps(self, steps):
+        '''Seconds of motion for moves of steps (D command units).'''
+        return move_time(self.revs(steps), self.vel, self.accel, self.decel)
+
+    def time_deg(self, deg):
+        '''Seconds of motion for moves of deg table degrees.'''
+        return self.time_steps(np.asarray(deg, dtype=float) * self.steps_per_rotation / 360)
+
+    def leg_times(self, positions, start=0.0):
+        '''Seconds of motion for each leg of a tour of absolute positions
+        (degrees), starting at start.'''
+        positions = np.asarray(positions, dtype=float)
+        return self.time_deg(np.diff(positions, prepend=start))
+
+    def schedule(self, deg, dwell=0.0):
+        '''Seconds from the start until each of a series of relative moves
+        (degrees) and the dwell after it are done, host overhead included.
+        The last value is the run time of the whole series.'''
+        step = self.time_deg(deg) + self.overhead + np.asarray(dwell, dtype=float)
+        return np.cumsum(np.broadcast_to(step, np.shape(deg)))
+# vim:expandtab:sw=4:ts=4
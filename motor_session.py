@@ -0,0 +1,123 @@
+#! /usr/bin/env python
+'''Long lived connection to the rotation table for the web app.
+
+Instead of discovering the port and opening it for every request, the app
+owns one MotorSession for its whole lifetime. The session keeps a single
+AsyncStepMotor open. Its worker thread queues the serial commands; the
+session lock gives one operation at a time exclusive use of the table. A
+background task checks the link while it is idle and reconnects if the
+USB adapter went away.
+'''
+
+import asyncio
+import logging
+import contextlib
+
+import serial
+
+import StepMotor
+from AsyncStepMotor import AsyncStepMotor
+
+logger = logging.getLogger(__name__)
+
+# Errors that mean the serial link is gone or out of step.
+LINK_ERRORS = (serial.SerialException, OSError, StepMotor.StepMotorError)
+
+
+#==============================================================================
+# MotorSession:
+#==============================================================================
+class MotorSession(object):
+    def __init__(self, port=None, health_interval=10, health_timeout=2, **motor_kwargs):
+        self.port = port
+        self.health_interval = health_interval
+        self.health_timeout = health_timeout
+        self.motor_kwargs = motor_kwargs
+        self.motor = None
+        self.lock = asyncio.Lock()
+        self._task = None
+
+    @property
+    def connected(self):
+        return self.motor is not None
+
+    async def start(self):
+        '''Connect (if the table is there) and start the health checks.'''
+        try:
+            await self._connect()
+        except LINK_ERRORS as exc:
+            logger.warning(f'Motor not available yet: {exc}')
+        self._task = asyncio.create_task(self._health_loop())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._task
+            self._task = None
+        async with self.lock:
+            await self._drop()
+
+    async def _connect(self):
+        logger.info('Connecting to motor')
+        self.motor = await AsyncStepMotor.open(self.port, **self.motor_kwargs)
+
+    async def _drop(self):
+        '''Close the connection, ignoring errors from a dead port.'''
+        motor, self.motor = self.motor, None
+        if motor:
+            logger.info('Dropping motor connection')
+            with contextlib.suppress(*LINK_ERRORS):
+                await motor.close()
+
+    @contextlib.asynccontextmanager
+    async def connection(self):
+        '''Exclusive use of the motor for one operation:
+
+            async with session.connection() as motor:
+                await motor.move_degrees(10)
+
+        Connects first if needed. If the link fails during the operation the
+        connection is dropped, so the next one starts with a fresh one.
+        '''
+        async with self.lock:
+            if self.motor is None:
+                await self._connect()
+            try:
+                yield self.motor
+            except StepMotor.StepMotorAborted:
+                raise               # Stopped on purpose, the link is fine.
+            except LINK_ERRORS:
+                await self._drop()
+                raise
+
+    async def abort(self, kill=True):
+        '''Emergency stop the table, without waiting for the lock or the
+        worker thread. Returns the seconds it took to send the stop, or None
+        if not connected.'''
+        motor = self.motor
+        if motor is None:
+            return None
+        return await motor.abort(kill)
+
+    async def check(self):
+        '''Ping the controller; reconnect if that fails. Returns True if the
+        table is connected afterwards.'''
+        async with self.lock:
+            try:
+                if self.motor is None:
+                    await self._connect()
+                else:
+                    await self.motor.send_cmd('', timeout=self.health_timeout)
+                return True
+            except LINK_ERRORS as exc:
+                logger.warning(f'Motor health check failed: {exc}')
+                await self._drop()
+                return False
+
+    async def _health_loop(self):
+        while True:
+            await asyncio.sleep(self.health_interval)
+            if self.lock.locked():
+                continue            # Busy, which is proof enough of life.
+            await self.check()
@@ -0,0 +1,233 @@
+#! /usr/bin/env python
+'''Load GT6 setup files (.prg) into the controller, but only when needed.
+
+A setup file such as OS22B-SNFLY.prg sets values the controller keeps in
+NV memory, so it only has to be sent again when it has changed or the
+controller has been reset. To know which, every upload ends by defining a
+small marker program on the controller that WRITEs a digest of the file:
+
+    DEF ZP3A9F
+    WRITE"9c1e04d2b7a85f11"
+    END
+
+The marker name comes from the file name and the digest from its commands
+(comments, white space and case don't count). Running the marker answers
+with the digest of the copy the controller has, or *UNDEFINED_LABEL if it
+has none, so checking costs one round trip. A file is sent when the digest
+differs; the old marker is deleted first, so an upload that fails half way
+is sent again next time.
+
+The marker only says what was last uploaded. RFS and changes made by hand
+leave it in place, so --verify also reads back each "NAME number" setting
+of the file and uploads again if any of them differ. Bit patterns such as
+INLVL 11000000 are compared bit by bit, not as numbers.
+
+The commands are streamed with StepMotor.send_stream(): the next one goes
+out as soon as there is room for it in the controller's input buffer,
+rather than after the reply to the one before.
+
+    python prg_upload.py OS22B-SNFLY.prg
+    python prg_upload.py OS22B-SNFLY.prg --verify
+    python prg_upload.py OS22B-SNFLY.prg --check
+'''
+
+import os
+import re
+import sys
+import math
+import hashlib
+import argparse
+import logging
+
+import StepMotor
+import gemini_program
+
+logger = logging.getLogger(__name__)
+
+# Marker programs are this followed by 4 hex digits of the file name hash,
+# which keeps them within a Gemini label (see gemini_program.NAME_RE).
+MARKER_PREFIX = 'ZP'
+
+# Hex digits of the digest a marker WRITEs.
+DIGEST_LEN = 16
+
+# Setting lines --verify can read back: a name and a plain number.
+SETTING_RE = re.compile(r'([A-Z]+)\s*([-+]?\d*\.?\d+)')
+
+# Settings that are bit patterns, one character per input or output, bit 1
+# first: 0, 1, or X to leave it as it is. The controller reports them with
+# a _ every four bits, e.g. INLVL 11000000 as *INLVL1100_0000.
+BIT_FIELDS = ('ERROR', 'INEN', 'INLVL', 'OUTEN', 'OUTLVL')
+BITS_RE = re.compile(r'(' + '|'.join(BIT_FIELDS) + r')\s*([01X_]+)')
+
+# Reported values are rounded by the controller, e.g. DMTJ 25.420 -> 25.42.
+REL_TOL = 1e-4
+
+
+def normalise(cmd):
+    '''A command as the controller sees it: upper case and without white
+    space, except inside quotes.'''
+    parts = cmd.split('"')
+    parts[::2] = [re.sub(r'\s+', '', p).upper() for p in parts[::2]]
+    return '"'.join(parts)
+
+
+def script_digest(cmds):
+    '''Digest of a script's commands (see StepMotor.read_script()).'''
+    h = hashlib.sha256()
+    for cmd in cmds:
+        h.update(normalise(cmd).encode() + b'\n')
+    return h.hexdigest()[:DIGEST_LEN]
+
+
+def marker_name(fname):
+    '''Name of the marker program for a script file.'''
+    base = os.path.basename(fname).lower()
+    return MARKER_PREFIX + hashlib.sha256(base.encode()).hexdigest()[:4].upper()
+
+
+def stored_digest(motor, marker):
+    '''The digest the controller's marker program holds, or None if it has
+    none.'''
+    resp = motor.send_cmd(marker)
+    if not resp.endswith(StepMotor.RESP_TERM):
+        return None
+    m = re.search(rf'[0-9a-f]{{{DIGEST_LEN}}}', resp)
+    return m.group(0) if m else None
+
+
+def parse_setting(cmd):
+    '''(name, value) of a setting --verify can read back, or None. value is
+    a float, or for a bit pattern a str of its bits.'''
+    cmd = cmd.upper()
+    m = BITS_RE.fullmatch(cmd)
+    if m:
+        return m.group(1), m.group(2).replace('_', '')
+    m = SETTING_RE.fullmatch(cmd)
+    if m:
+        return m.group(1), float(m.group(2))
+    return None
+
+
+def same_setting(name, value, resp):
+    '''True if the reply to a query of setting name reports value.'''
+    if isinstance(value, str):
+        m = re.search(rf'\*{name}\s*([01_]+)', resp)
+        if not m:
+            return False
+        # Bits the controller doesn't report count as 0.
+        have = m.group(1).replace('_', '').ljust(len(value), '0')
+        return all(want in ('X', bit) for want, bit in zip(value, have))
+    m = re.search(rf'\*{name}\s*([-+]?\d*\.?\d+)', resp)
+    return bool(m) and math.isclose(float(m.group(1)), value,
+                                    rel_tol=REL_TOL, abs_tol=REL_TOL)
+
+
+def readback(motor, cmds):
+    '''Read back the settings a script makes. Returns the (command, reply)
+    pairs where the controller reports something else.'''
+    settings = {}
+    for cmd in cmds:
+        setting = parse_setting(cmd)
+        if setting:
+            name, value = setting
+            settings[name] = (cmd, value)
+    names = list(settings)
+    replies = motor.send_stream(names)
+    if not motor.serialport:
+        return []
+    differ = []
+    for name, resp in zip(names, replies):
+        cmd, value = settings[name]
+        if not same_setting(name, value, resp):
+            differ.append((cmd, resp.strip()))
+    return differ
+
+
+def upload_script(motor, fname, force=False, verify=False):
+    '''Send a script file to the controller unless it already has it.
+    Returns True if it was sent. Raises StepMotorError if the controller
+    rejects any of its lines.'''
+    cmds = StepMotor.read_script(fname)
+    digest = script_digest(cmds)
+    marker = marker_name(fname)
+    if not force and stored_digest(motor, marker) == digest:
+        differ = readback(motor, cmds) if verify else []
+        if not differ:
+            logger.info(f'{fname}: unchanged ({marker} {digest})')
+            return False
+        logger.warning(f'{fname}: controller settings differ: {differ}')
+
+    logger.info(f'{fname}: uploading {len(cmds)} commands')
+    motor.send_cmd(f'DEL {marker}')
+    replies = motor.send_stream(cmds)
+    bad = [(cmd, resp.strip()) for cmd, resp in zip(cmds, replies)
+           if resp.endswith(StepMotor.RESP_UNDEF)]
+    if bad:
+        raise StepMotor.StepMotorError(f'{fname}: rejected {bad}')
+    gemini_program.upload_program(motor, [f'DEF {marker}', f'WRITE"{digest}"', 'END'])
+    return True
+
+
+def main():
+    parser = argparse.ArgumentParser(
+          description="Upload GT6 setup files (.prg) the controller doesn't have yet.",
+          formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+          )
+    parser.add_argument("files",
+                        nargs='+',
+                        help="Setup files, sent in this order",
+                        )
+    parser.add_argument("--force",
+                        action='store_true',
+                        help="Upload even if the controller has the same version",
+                        )
+    parser.add_argument("--verify",
+                        action='store_true',
+                        help="Also read back the settings, and upload if any differ",
+                        )
+    parser.add_argument("--check",
+                        action='store_true',
+                        help="Only report which files would be uploaded; exit status 1 if any",
+                        )
+    parser.add_argument("--port",
+                        default=None,
+                        help="Serial port of the controller. Default: search for it",
+                        )
+    parser.add_argument(
+        "--verbose", "-v",
+        action='count',
+        default=0,
+        help="use multiple -v for more detailed messages."
+    )
+    args = parser.parse_args()
+    logging.basicConfig(
+          format='%(levelname)-8s [%(filename)s:%(lineno)d] %(message)s',
+          level=logging.WARNING - (10 * args.verbose),
+          )
+
+    motor = StepMotor.StepMotor(args.port)
+    stale = 0
+    try:
+        motor.send_cmd('ECHO0')         # As InitializeDrive(); echoes get in the way
+        for fname in args.files:
+            if args.check:
+                cmds = StepMotor.read_script(fname)
+                same = stored_digest(motor, marker_name(fname)) == script_digest(cmds)
+                if same and args.verify:
+                    same = not readback(motor, cmds)
+                print(f'{fname}: {"up to date" if same else "needs upload"}')
+                stale += not same
+            else:
+                sent = upload_script(motor, fname, args.force, args.verify)
+                print(f'{fname}: {"uploaded" if sent else "unchanged"}')
+    except (OSError, StepMotor.StepMotorError) as exc:
+        sys.exit(str(exc))
+    finally:
+        motor.close()
+    sys.exit(1 if stale else 0)
+
+
+if __name__ == '__main__':
+    main()
+# vim:expandtab:sw=4:ts=4
@@ -0,0 +1,217 @@
+#! /usr/bin/env python
+'''Record the serial traffic of a session with the controller, and play it
+back to StepMotor without a controller.
+
+A recording is a JSON lines file. The first line describes the port, every
+other line is one write to or read from it, with the time since the
+recording started and the bytes (as latin-1 text):
+
+    {"port": "/dev/ttyUSB0", "baudrate": 19200, "wall": 1760000000.0}
+    {"t": 0.0012, "op": "w", "data": "TAS\\nTPE\\n"}
+    {"t": 0.0113, "op": "r", "data": "*TAS0000_0000...\\r\\n> "}
+
+Record with StepMotor(..., record='session.jsonl'), or back_forth.py
+--record. ReplayPort serves a recording to StepMotor in place of the
+serial port: each write has to be what was written at that point in the
+recording, and each read gets what came back, as long after the write
+before it as it did then. On a VirtualClock (see clock.py) those waits,
+and the dwells and polls of the code under test, take no time at all, so
+an hour long run replays in seconds:
+
+    clock = VirtualClock()
+    motor = StepMotor.StepMotor(ReplayPort('session.jsonl', clock),
+                                clock=clock, journal=False)
+
+The code under test has to send what was sent when the recording was
+made; anything else raises ReplayError, which says where they parted.
+
+    python replay.py session.jsonl
+'''
+
+import json
+import argparse
+import logging
+
+from clock import SYSTEM_CLOCK
+
+logger = logging.getLogger(__name__)
+
+WRITE = 'w'
+READ = 'r'
+
+
+class ReplayError(Exception): pass
+
+
+def load_recording(fname):
+    '''(header, events) of a recording; events are (t, op, bytes).'''
+    with open(fname) as f:
+        header = json.loads(f.readline())
+        events = []
+        for line in f:
+            if line.strip():
+                e = json.loads(line)
+                events.append((e['t'], e['op'], e['data'].encode('latin-1')))
+    return header, events
+
+
+#==============================================================================
+# RecordingPort:
+#==============================================================================
+class RecordingPort(object):
+    '''Wraps an open serial port and writes everything that goes through
+    it to fname. Anything else is passed on to the port.'''
+    def __init__(self, port, fname, clock=SYSTEM_CLOCK):
+        self._port = port
+        self._clock = clock
+        self._t0 = clock.monotonic()
+        self._file = open(fname, 'w', buffering=1)   # A line per event
+        header = dict(port=port.port, baudrate=port.baudrate, wall=clock.time())
+        self._file.write(json.dumps(header) + '\n')
+        logger.info(f'Recording {port.port} to {fname}')
+
+    def __getattr__(self, name):
+        return getattr(self._port, name)
+
+    @property
+    def baudrate(self):
+        return self._port.baudrate
+
+    @baudrate.setter
+    def baudrate(self, rate):
+        self._port.baudrate = rate
+
+    def _record(self, op, data):
+        if data and not self._file.closed:
+            t = self._clock.monotonic() - self._t0
+            self._file.write(json.dumps(dict(t=round(t, 6), op=op,
+                                             data=bytes(data).decode('latin-1'))) + '\n')
+
+    def write(self, data):
+        n = self._port.write(data)
+        self._record(WRITE, data)
+        return n
+
+    def read(self, size=1):
+        data = self._port.read(size)
+        self._record(READ, data)
+        return data
+
+    def close(self):
+        self._file.close()
+        self._port.close()
+
+
+#==============================================================================
+# ReplayPort:
+#==============================================================================
+class ReplayPort(object):
+    '''Plays a recording back in place of a serial port, see the module
+    docstring. Reads wait on clock, for at most timeout seconds, as
+    pyserial's do.'''
+    def __init__(self, fname, clock=SYSTEM_CLOCK, timeout=0.1):
+        header, self.events = load_recording(fname)
+        self.port = f'replay:{fname}'
+        self.baudrate = header.get('baudrate')
+        self.timeout = timeout
+        self.clock = clock
+        self.is_open = True
+        self.pos = 0                    # Next event
+        self._expect = b''              # Recorded bytes the next writes must match
+        self._unread = b''              # Rest of a read event larger than asked for
+        # Recorded and replay times of the last write, which the read
+        # times are relative to.
+        self._t_rec = 0.0
+        self._t_replay = clock.monotonic()
+
+    def _next(self, op):
+        '''The next event if it is an op, else None.'''
+        if self.pos < len(self.events) and self.events[self.pos][1] == op:
+            return self.events[self.pos]
+        return None
+
+    def _due(self, t):
+        return self._t_replay + (t - self._t_rec)
+
+    def write(self, data):
+        data = bytes(data)
+        t = self._t_rec
+        while len(self._expect) < len(data) and self._next(WRITE):
+            t, _, chunk = self.events[self.pos]
+            self._expect += chunk
+            self.pos += 1
+        if not self._expect.startswith(data):
+            have = repr(self._expect[:len(data)]) if self._expect else 'a read'
+            raise ReplayError(f'Event {self.pos}: wrote {data!r}, the recording has {have}')
+        self._expect = self._expect[len(data):]
+        self._t_rec, self._t_replay = t, self.clock.monotonic()
+        return len(data)
+
+    @property
+    def in_waiting(self):
+        if self._unread:
+            return len(self._unread)
+        e = self._next(READ)
+        if e and not self._expect and self._due(e[0]) <= self.clock.monotonic():
+            return len(e[2])
+        return 0
+
+    def read(self, size=1):
+        if not self._unread:
+            e = self._next(READ)
+            wait = self._due(e[0]) - self.clock.monotonic() if e and not self._expect else None
+            if wait is None or wait > self.timeout:
+                # Nothing more comes until something is written.
+                self.clock.sleep(self.timeout)
+                return b''
+            self.clock.sleep(wait)
+            self._unread = e[2]
+            self.pos += 1
+        data, self._unread = self._unread[:size], self._unread[size:]
+        return data
+
+    @property
+    def done(self):
+        '''True once the whole recording has been played.'''
+        return self.pos >= len(self.events) and not self._unread and not self._expect
+
+    def flush(self):
+        pass
+
+    def flushInput(self):
+        pass
+
+    def flushOutput(self):
+        pass
+
+    def reset_input_buffer(self):
+        pass
+
+    def cancel_read(self):
+        pass
+
+    def close(self):
+        self.is_open = False
+
+
+def main():
+    parser = argparse.ArgumentParser(
+          description="Summarise a serial recording.",
+          formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+          )
+    parser.add_argument("recording",
+                        help="Recording file, as written by StepMotor(record=...)",
+                        )
+    args = parser.parse_args()
+
+    header, events = load_recording(args.recording)
+    sent = sum(len(data) for _, op, data in events if op == WRITE)
+    received = sum(len(data) for _, op, data in events if op == READ)
+    print(f'{args.recording}: {header.get("port")} at {header.get("baudrate")} baud')
+    print(f'{len(events)} events over {events[-1][0] if events else 0:.1f}s, '
+          f'{sent} bytes sent, {received} received')
+
+
+if __name__ == '__main__':
+    main()
+# vim:expandtab:sw=4:ts=4
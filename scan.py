@@ -0,0 +1,92 @@
+#! /usr/bin/env python
+'''Turn the table at a constant speed and record its angle against time.
+
+Instead of stopping at each heading, the table turns through the whole
+range in one go while its position is read back every --interval
+seconds. The resulting track (CSV: time.time() seconds, degrees, steps)
+can be used to tag any data recorded meanwhile with the table heading:
+
+    python scan.py --degrees 360 --velocity 1 -o scan.csv
+
+At the default 900000 steps per table turn, one motor rev/s is 10
+degrees/s of table rotation.
+'''
+
+import time
+import argparse
+import logging
+
+import numpy as np
+
+import StepMotor
+
+logger = logging.getLogger(__name__)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+          description="Continuous rotation scan with a timestamped angle track.",
+          formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+          )
+    parser.add_argument("-d", "--degrees",
+                        type=float,
+                        default=360,
+                        help="How far to turn (negative for the other way)",
+                        )
+    parser.add_argument("-V", "--velocity",
+                        type=float,
+                        default=1,
+                        help="Scan velocity (motor revs/s)",
+                        )
+    parser.add_argument("-A", "--accel",
+                        type=float,
+                        default=10,
+                        help="Motor Acceleration",
+                        )
+    parser.add_argument("--interval",
+                        type=float,
+                        default=0.05,
+                        help="Seconds between position readings",
+                        )
+    parser.add_argument("--start",
+                        type=float,
+                        default=None,
+                        help="Go to this absolute position (degrees) first",
+                        )
+    parser.add_argument("--port",
+                        default=None,
+                        help="Serial port of the controller. Default: search for it",
+                        )
+    parser.add_argument("-o", "--output",
+                        default=None,
+                        help="CSV file for the track. Default: scan-<date>-<time>.csv",
+                        )
+    parser.add_argument(
+        "--verbose", "-v",
+        action='count',
+        default=0,
+        help="use multiple -v for more detailed messages."
+    )
+    args = parser.parse_args()
+    logging.basicConfig(
+          format='%(levelname)-8s [%(filename)s:%(lineno)d] %(message)s',
+          level=logging.WARNING - (10 * args.verbose),
+          )
+
+    output = args.output or time.strftime('scan-%Y%m%d-%H%M%S.csv')
+    motor = StepMotor.StepMotor(args.port)
+    try:
+        motor.InitializeDrive(False, args.velocity, args.accel)
+        track = motor.Scan(args.degrees, args.velocity, args.interval, args.start)
+    finally:
+        motor.close()
+    track.save(output)
+    if len(track):
+        print(f'{len(track)} readings over {track.t[-1] - track.t[0]:.1f}s, '
+              f'{track.deg[0]:.3f} to {track.deg[-1]:.3f} degrees, '
+              f'median latency {1000 * np.median(track.latency):.1f}ms -> {output}')
+
+
+if __name__ == '__main__':
+    main()
+# vim:expandtab:sw=4:ts=4
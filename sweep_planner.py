@@ -0,0 +1,267 @@
+#! /usr/bin/env python
+'''Plan the order in which to visit a set of table headings.
+
+A measurement campaign is a list of headings with a dwell time at each.
+Visiting them in the order they were written down usually sends the table
+back and forth across the circle. A quick tour is a sweep in one
+direction that skips a wide gap between neighbouring headings. The
+planner looks at every start heading and both directions. For each one it
+picks an absolute position (heading + n * 360) that keeps the sweep inside
+the cable wrap limits set by InitializeDrive() and is close to where the
+table is now. It keeps the tour with the shortest total motion time, as
+predicted by motion_model.
+
+    python sweep_planner.py 0 90 180 270 355 5 --dwell 10
+    python sweep_planner.py --file headings.txt --run --port /dev/ttyUSB0
+
+A headings file has one heading per line, optionally followed by a dwell
+time for that heading.
+'''
+
+import sys
+import argparse
+import logging
+
+import numpy as np
+
+import StepMotor
+from motion_model import MotionModel
+
+logger = logging.getLogger(__name__)
+
+
+def travel_limits(steps_per_rotation=900000):
+    '''(lowest, highest) absolute table position in degrees allowed by the
+    soft limits.'''
+    return (StepMotor.LSNEG_STEPS * 360 / steps_per_rotation,
+            StepMotor.LSPOS_STEPS * 360 / steps_per_rotation)
+
+
+#==============================================================================
+# SweepPlan:
+#==============================================================================
+class SweepPlan(object):
+    '''An ordered list of stops: (absolute degrees, dwell seconds).
+
+    motion_time is the predicted time spent moving, baseline_time the same
+    for visiting the headings in the order given.
+    '''
+    def __init__(self, stops, motion_time, baseline_time, start=0.0):
+        self.stops = stops
+        self.motion_time = motion_time
+        self.baseline_time = baseline_time
+        self.start = start
+
+    @property
+    def dwell_time(self):
+        return sum(dwell for _, dwell in self.stops)
+
+    def __len__(self):
+        return len(self.stops)
+
+    def __iter__(self):
+        return iter(self.stops)
+
+    def execute(self, motor, on_stop=None, sleep=None):
+        '''Drive motor (a StepMotor) through the plan. on_stop(i, deg) is
+        called on arrival at each stop, before the dwell. The dwells are
+        slept with sleep, by default on motor.clock.'''
+        sleep = sleep or motor.clock.sleep
+        for i, (deg, dwell) in enumerate(self.stops):
+            motor.GoToDegrees(deg)
+            if on_stop:
+                on_stop(i, deg)
+            if dwell > 0:
+                sleep(dwell)
+
+
+def _merge(headings, dwells):
+    '''Unique headings in [0, 360), sorted, with the longest dwell asked for
+    at each.'''
+    h = np.mod(np.asarray(headings, dtype=float), 360)
+    h = np.round(h, 6) % 360
+    d = np.broadcast_to(np.asarray(dwells, dtype=float), h.shape)
+    uniq, inv = np.unique(h, return_inverse=True)
+    dwell = np.zeros(len(uniq))
+    np.maximum.at(dwell, inv, d)
+    return uniq, dwell
+
+
+def _candidates(h, direction, start, lo, hi, cost, offset):
+    '''Best tour for each start heading h[k] sweeping in direction, with the
+    first stop at h[k] + 360 * m, m the given rounding of the turns needed
+    to get close to start. Returns (cost, j, positions) per k, where j is
+    the number of stops visited on the way out (see plan_sweep).'''
+    n = len(h)
+    k = np.arange(n)
+    order = (k[:, None] + direction * k[None, :]) % n
+    rel = direction * np.mod(direction * (h[order] - h[:, None]), 360)
+    span = np.abs(rel[:, -1])
+    low = np.where(direction > 0, 0, -span)
+    m_lo = np.ceil((lo - low - h) / 360)
+    m_hi = np.floor((hi - low - span - h) / 360)
+    m = np.clip(offset((start - h) / 360), m_lo, m_hi)
+    pos = (h + 360 * m)[:, None] + rel
+    legs = cost(np.diff(rel, axis=1))
+    done = np.concatenate((np.zeros((n, 1)), np.cumsum(legs, axis=1)), axis=1)
+    # Stops between the start and the first stop are visited on the way out.
+    j = np.count_nonzero(direction * (pos[:, 1:] - start) < 0, axis=1)
+    jn = np.minimum(j + 1, n - 1)
+    back = np.where(j < n - 1, cost(rel[k, jn] - rel[:, 0]) + done[:, -1] - done[k, jn], 0)
+    total = cost(start - pos[k, j]) + done[k, j] + back
+    return np.where(m_lo <= m_hi, total, np.inf), j, pos
+
+
+def plan_sweep(headings, dwells=0, start=0.0, steps_per_rotation=900000,
+               vel=5, accel=10, limits=None):
+    '''Order headings (degrees, any range) to minimise motion time.
+
+    dwells is one dwell time for all headings or one per heading. start is
+    the current absolute table position in degrees. limits is (low, high)
+    in absolute degrees; by default the InitializeDrive() soft limits.
+    Raises ValueError if the headings cannot all be reached within limits.
+
+    Each tour is a sweep in one direction. If the table starts part way
+    along the sweep, it may first run out to the sweep's start and stop at
+    the headings it passes, then turn round and do the rest.
+    '''
+    if len(headings) == 0:
+        return SweepPlan([], 0.0, 0.0, start)
+    if limits is None:
+        limits = travel_limits(steps_per_rotation)
+    lo, hi = limits
+    cost = MotionModel(steps_per_rotation, vel, accel).time_deg
+
+    h, dwell = _merge(headings, dwells)
+    n = len(h)
+    best = (np.inf,)
+    for direction in (1, -1):
+        for offset in (np.floor, np.ceil):
+            total, j, pos = _candidates(h, direction, start, lo, hi, cost, offset)
+            k = int(np.argmin(total))
+            if total[k] < best[0]:
+                best = (total[k], direction, k, j[k], pos[k])
+    if not np.isfinite(best[0]):
+        raise ValueError(f'Headings do not fit between {lo:g} and {hi:g} degrees')
+
+    total, direction, k, j, pos = best
+    order = (k + direction * np.arange(n)) % n
+    visit = np.concatenate((np.arange(j, -1, -1), np.arange(j + 1, n)))
+    stops = [(float(pos[i]), float(dwell[order[i]])) for i in visit]
+
+    given = np.asarray(headings, dtype=float)
+    baseline = float(cost(np.diff(np.concatenate(([start], given)))).sum())
+    logger.info(f'Sweep of {n} headings: {total:.1f}s moving, '
+                f'{baseline:.1f}s in the order given')
+    return SweepPlan(stops, float(total), baseline, start)
+
+
+def read_headings(fname):
+    '''(headings, dwells) from a file with "heading [dwell]" per line.
+    Blank lines and # comments are skipped. dwells is None if no line has
+    one.'''
+    headings, dwells = [], []
+    with open(fname) as f:
+        for line in f:
+            fields = line.split('#')[0].split()
+            if not fields:
+                continue
+            headings.append(float(fields[0]))
+            dwells.append(float(fields[1]) if len(fields) > 1 else None)
+    if all(d is None for d in dwells):
+        return headings, None
+    return headings, dwells
+
+
+def main():
+    parser = argparse.ArgumentParser(
+          description="Plan the quickest tour of a set of table headings.",
+          formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+          )
+    parser.add_argument("headings",
+                        type=float,
+                        nargs='*',
+                        help="Headings in degrees",
+                        )
+    parser.add_argument("-f", "--file",
+                        default=None,
+                        help="Read headings (and optional dwell times) from a file",
+                        )
+    parser.add_argument("-d", "--dwell",
+                        type=float,
+                        default=0,
+                        help="Dwell time (s) at each heading",
+                        )
+    parser.add_argument("--start",
+                        type=float,
+                        default=0,
+                        help="Current absolute table position (degrees); read from the table with --run",
+                        )
+    parser.add_argument("-V", "--velocity",
+                        type=float,
+                        default=5,
+                        help="Motor Velocity",
+                        )
+    parser.add_argument("-A", "--accel",
+                        type=float,
+                        default=10,
+                        help="Motor Acceleration",
+                        )
+    parser.add_argument("--run",
+                        action='store_true',
+                        help="Execute the plan on the table",
+                        )
+    parser.add_argument("--port",
+                        default=None,
+                        help="Serial port of the controller. Default: search for it",
+                        )
+    parser.add_argument(
+        "--verbose", "-v",
+        action='count',
+        default=0,
+        help="use multiple -v for more detailed messages."
+    )
+    args = parser.parse_args()
+    logging.basicConfig(
+          format='%(levelname)-8s [%(filename)s:%(lineno)d] %(message)s',
+          level=logging.WARNING - (10 * args.verbose),
+          )
+
+    headings, dwells = list(args.headings), args.dwell
+    if args.file:
+        more, file_dwells = read_headings(args.file)
+        if file_dwells is not None:
+            dwells = [args.dwell if d is None else d
+                      for d in [None] * len(headings) + file_dwells]
+        headings += more
+    if not headings:
+        parser.error('no headings given')
+
+    motor, start = None, args.start
+    if args.run:
+        motor = StepMotor.StepMotor(args.port)
+        motor.InitializeDrive(True, args.velocity, args.accel)
+        tpc, _, _ = motor.ReadPosition()
+        if tpc is not None:
+            start = tpc * 360 / motor.steps_per_rotation
+    try:
+        plan = plan_sweep(headings, dwells, start,
+                          vel=args.velocity, accel=args.accel)
+    except ValueError as exc:
+        if motor:
+            motor.close()
+        sys.exit(str(exc))
+    for deg, dwell in plan:
+        print(f'{deg:10.4f} {dwell:8.2f}')
+    saved = plan.baseline_time - plan.motion_time
+    print(f'# {len(plan)} stops, {plan.motion_time:.1f}s moving + {plan.dwell_time:.1f}s dwell'
+          f' ({saved:.1f}s less moving than in the order given)')
+
+    if motor:
+        plan.execute(motor, lambda i, deg: print(f'At {deg:.4f} ({i + 1}/{len(plan)})'))
+        motor.close()
+
+
+if __name__ == '__main__':
+    main()
+# vim:expandtab:sw=4:ts=4
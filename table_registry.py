@@ -0,0 +1,174 @@
+#! /usr/bin/env python
+'''Several rotation tables driven from one process.
+
+Each table has its own MotorSession, and with it its own AsyncStepMotor
+worker thread and command queue, health checks and telemetry. A slow move
+on one table never holds up another. Tables are known by an ID: the name
+given in the configuration, or the USB serial number of the adapter for
+tables found by searching the serial ports.
+
+The tables come from the environment:
+
+    ROTATION_TABLES="east=/dev/ttyUSB0,west=/dev/ttyUSB1"
+
+names them explicitly. ROTATION_TABLE_PORT=/dev/ttyUSB0 gives a single
+table called "default", and with neither set every port a controller
+answers on becomes a table.
+'''
+
+import os
+import re
+import asyncio
+import logging
+
+import StepMotor
+from motor_session import MotorSession, LINK_ERRORS
+from telemetry import TelemetrySampler
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_ID = 'default'
+ID_RE = re.compile(r'[A-Za-z0-9_.-]+')
+
+
+#==============================================================================
+# Table:
+#==============================================================================
+class Table(object):
+    '''One rotation table: its session, telemetry and cancel flag.'''
+    def __init__(self, table_id, port=None, telemetry_rate=10, **motor_kwargs):
+        self.id = table_id
+        self.session = MotorSession(port, **motor_kwargs)
+        self.telemetry = TelemetrySampler(self.session, rate=telemetry_rate)
+        # Set to ask whatever is running on this table to stop.
+        self.cancel_event = asyncio.Event()
+
+    @property
+    def port(self):
+        motor = self.session.motor
+        if motor and motor.motor.serialport:
+            return motor.motor.serialport.port
+        return self.session.port
+
+    async def start(self):
+        await self.session.start()
+        await self.telemetry.start()
+
+    async def stop(self):
+        await self.telemetry.stop()
+        await self.session.stop()
+
+    def status(self):
+        return {
+            'id': self.id,
+            'port': self.port,
+            'connected': self.session.connected,
+            'busy': self.session.lock.locked(),
+        }
+
+
+#==============================================================================
+# TableRegistry:
+#==============================================================================
+class TableRegistry(object):
+    '''The tables of this process, by ID.
+
+    ports maps table IDs to serial ports. If it is None, start() searches
+    the USB serial ports and adds a table for every controller that
+    answers; if none does, there is one "default" table that keeps looking.
+    '''
+    def __init__(self, ports=None, **table_kwargs):
+        self.ports = ports
+        self.table_kwargs = table_kwargs
+        self.tables = {}
+        if ports is not None:
+            for table_id, port in ports.items():
+                self.add(table_id, port)
+
+    @classmethod
+    def from_env(cls, environ=os.environ, **table_kwargs):
+        '''Registry configured from ROTATION_TABLES or ROTATION_TABLE_PORT.'''
+        spec = environ.get('ROTATION_TABLES')
+        if spec:
+            ports = {}
+            for item in spec.split(','):
+                table_id, _, port = item.strip().partition('=')
+                if not port:
+                    raise ValueError(f'ROTATION_TABLES: expected id=port, got {item!r}')
+                ports[table_id.strip()] = port.strip()
+            return cls(ports, **table_kwargs)
+        port = environ.get('ROTATION_TABLE_PORT')
+        if port:
+            return cls({DEFAULT_ID: port}, **table_kwargs)
+        return cls(None, **table_kwargs)
+
+    def add(self, table_id, port=None):
+        if not ID_RE.fullmatch(table_id):
+            raise ValueError(f'Bad table id {table_id!r}')
+        if table_id in self.tables:
+            raise ValueError(f'Duplicate table id {table_id!r}')
+        table = Table(table_id, port, **self.table_kwargs)
+        self.tables[table_id] = table
+        return table
+
+    async def discover(self):
+        '''Add a table for every serial port a controller answers on.'''
+        ports = StepMotor.candidate_ports()
+        found = await asyncio.to_thread(
+            StepMotor.find_controllers, [info.device for info in ports])
+        for info in ports:
+            if info.device in found:
+                table_id = info.serial_number or os.path.basename(info.device)
+                table_id = re.sub(r'[^A-Za-z0-9_.-]', '_', table_id)
+                logger.info(f'Table {table_id} on {info.device}')
+                self.add(table_id, info.device)
+
+    async def start(self):
+        if self.ports is None:
+            await self.discover()
+            if not self.tables:
+                logger.warning('No tables found, waiting for one to turn up')
+                self.add(DEFAULT_ID)
+        await asyncio.gather(*(table.start() for table in self.tables.values()))
+
+    async def stop(self):
+        await asyncio.gather(*(table.stop() for table in self.tables.values()))
+
+    def get(self, table_id=None):
+        '''The table with this ID; the first one if table_id is None.
+        Raises KeyError for an unknown ID.'''
+        if table_id is None:
+            if not self.tables:
+                raise KeyError('No tables')
+            return next(iter(self.tables.values()))
+        return self.tables[table_id]
+
+    def __iter__(self):
+        return iter(self.tables.values())
+
+    def __len__(self):
+        return len(self.tables)
+
+    def status(self):
+        return [table.status() for table in self]
+
+    async def run_all(self, fn, table_ids=None):
+        '''Run fn(motor) on several tables at once (all of them by default),
+        each with exclusive use of its own motor. Returns {id: result}; a
+        table that failed has the exception as its result instead.'''
+        tables = [self.get(i) for i in table_ids] if table_ids else list(self)
+
+        async def run(table):
+            async with table.session.connection() as motor:
+                return await fn(motor)
+
+        results = await asyncio.gather(*(run(t) for t in tables), return_exceptions=True)
+        for table, result in zip(tables, results):
+            if isinstance(result, BaseException) and not isinstance(result, LINK_ERRORS):
+                raise result
+        return {table.id: result for table, result in zip(tables, results)}
+
+    async def go_to_degrees(self, deg, table_ids=None):
+        '''Move several tables to the same absolute position, concurrently.'''
+        return await self.run_all(lambda motor: motor.go_to_degrees(deg), table_ids)
+# vim:expandtab:sw=4:ts=4
@@ -0,0 +1,161 @@
+#! /usr/bin/env python
+'''Live position telemetry for the web app.
+
+A TelemetrySampler reads the commanded position (TPC), the actual
+position (TPE) and the axis status (TAS) at a fixed rate. It only does so
+while the motor's worker thread has nothing else to do, so motion commands
+never queue up behind a sample. During a move the worker thread itself
+reads the position with the immediate !TPC and !TPE, and hands it over
+through StepMotor.on_position. Samples go into a TelemetryRing: fixed
+size, preallocated NumPy arrays that hold the most recent samples.
+Subscribers read the ring at whatever rate they like and get the newest
+sample each time, so a slow client never holds anything up.
+'''
+
+import time
+import asyncio
+import logging
+import contextlib
+
+import numpy as np
+
+import StepMotor
+from motor_session import LINK_ERRORS
+
+logger = logging.getLogger(__name__)
+
+
+#==============================================================================
+# TelemetryRing:
+#==============================================================================
+class TelemetryRing(object):
+    '''The last size samples of (time, commanded deg, actual deg, status).
+
+    Every sample gets a sequence number; seq is the number of samples ever
+    written, so sample n lives at index n % size until it is overwritten.
+    '''
+    def __init__(self, size=36000):
+        self.size = size
+        self.t = np.zeros(size)                     # time.time()
+        self.commanded = np.zeros(size)             # degrees
+        self.actual = np.zeros(size)                # degrees
+        self.status = np.zeros(size, dtype=np.uint32)   # TAS, bit 1 = LSB
+        self.seq = 0
+
+    def append(self, t, commanded, actual, status):
+        i = self.seq % self.size
+        self.t[i] = t
+        self.commanded[i] = commanded
+        self.actual[i] = actual
+        self.status[i] = status
+        self.seq += 1
+
+    def oldest(self):
+        '''Sequence number of the oldest sample still held.'''
+        return max(0, self.seq - self.size)
+
+    def sample(self, n):
+        '''Sample n as a dict, or None if it has been overwritten or not
+        written yet.'''
+        if not self.oldest() <= n < self.seq:
+            return None
+        i = n % self.size
+        status = int(self.status[i])
+        return {
+            'seq': n,
+            't': float(self.t[i]),
+            'commanded': float(self.commanded[i]),
+            'actual': float(self.actual[i]),
+            'moving': bool(status & (1 << (StepMotor.TAS_MOVING - 1))),
+            'status': status,
+        }
+
+    def arrays(self, start=0):
+        '''(t, commanded, actual, status) copies of the samples from sequence
+        number start on, oldest first.'''
+        start = max(start, self.oldest())
+        idx = np.arange(start, self.seq) % self.size
+        return self.t[idx], self.commanded[idx], self.actual[idx], self.status[idx]
+
+
+#==============================================================================
+# TelemetrySampler:
+#==============================================================================
+class TelemetrySampler(object):
+    def __init__(self, session, rate=10.0, size=36000):
+        self.session = session
+        self.rate = rate
+        self.ring = TelemetryRing(size)
+        self._new = asyncio.Event()
+        self._task = None
+
+    async def start(self):
+        self._task = asyncio.create_task(self._loop())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._task
+            self._task = None
+
+    def watch_moves(self, motor):
+        '''Have motor (an AsyncStepMotor) report its position during moves.'''
+        if motor.motor.on_position is not None:
+            return
+        loop = asyncio.get_running_loop()
+        deg = 360 / motor.motor.steps_per_rotation
+        moving = 1 << (StepMotor.TAS_MOVING - 1)
+
+        def on_position(t, tpc, tpe):
+            # On the worker thread; the ring belongs to the event loop.
+            with contextlib.suppress(RuntimeError):     # Loop closed
+                loop.call_soon_threadsafe(self._store, t, tpc * deg, tpe * deg, moving)
+        motor.motor.on_position = on_position
+        motor.motor.position_interval = 1 / self.rate
+
+    def _store(self, t, commanded, actual, status):
+        self.ring.append(t, commanded, actual, status)
+        self._new.set()
+        self._new = asyncio.Event()
+
+    async def sample(self):
+        '''Take one sample if the motor is connected and idle. Returns True
+        if a sample was stored.'''
+        motor = self.session.motor
+        if motor is None:
+            return False
+        self.watch_moves(motor)
+        if not motor.idle:
+            return False
+        try:
+            tpc, tpe, tas = await motor.read_position()
+        except LINK_ERRORS as exc:
+            logger.debug(f'Telemetry sample failed: {exc}')
+            return False
+        if tpc is None:
+            return False
+        deg = 360 / motor.motor.steps_per_rotation
+        actual = tpe if tpe is not None else tpc
+        self._store(time.time(), tpc * deg, actual * deg, StepMotor.bits_to_int(tas))
+        return True
+
+    async def _loop(self):
+        period = 1 / self.rate
+        next_t = time.monotonic()
+        while True:
+            await self.sample()
+            next_t = max(next_t + period, time.monotonic())
+            await asyncio.sleep(next_t - time.monotonic())
+
+    async def subscribe(self, rate=1.0):
+        '''Yield the newest sample at most rate times a second, skipping the
+        samples in between. Waits while there is nothing new.'''
+        period = 1 / rate
+        last = -1
+        while True:
+            if self.ring.seq - 1 <= last:
+                await self._new.wait()
+            last = self.ring.seq - 1
+            yield self.ring.sample(last)
+            await asyncio.sleep(period)
@@ -0,0 +1,54 @@
+#! /usr/bin/env python
+'''Abort() against the simulator: python -m pytest test_abort.py'''
+
+import time
+import asyncio
+
+import pytest
+
+import StepMotor
+import gt6_sim
+from AsyncStepMotor import AsyncStepMotor
+
+
+@pytest.fixture
+def sim():
+    with gt6_sim.GT6Simulator(time_scale=10) as sim:
+        yield sim
+
+
+def test_abort_while_queued(sim):
+    '''A stop that comes while the move still waits for the worker thread
+    stops the move.'''
+    async def run():
+        motor = await AsyncStepMotor.open(sim.device, journal=False)
+        try:
+            await motor.initialize_drive(False, 5, 10)
+            busy = asyncio.ensure_future(motor.run(time.sleep, 0.3))
+            move = asyncio.ensure_future(motor.move_degrees(1440))
+            await asyncio.sleep(0.1)
+            await motor.abort(True)
+            await busy
+            with pytest.raises(StepMotor.StepMotorAborted):
+                await move
+            tpc, _, _ = await motor.read_position()
+            return tpc
+        finally:
+            await motor.close()
+
+    assert asyncio.run(run()) == 0
+
+
+def test_abort_before_call(sim):
+    '''An abort with nothing running or queued doesn't stop what comes
+    after it.'''
+    motor = StepMotor.StepMotor(sim.device, journal=False)
+    try:
+        motor.InitializeDrive(False, 5, 10)
+        motor.Abort(True)
+        motor.MoveDegrees(10)
+        tpc, _, _ = motor.ReadPosition()
+        assert tpc == motor.steps_per_rotation // 36
+    finally:
+        motor.close()
+# vim:expandtab:sw=4:ts=4
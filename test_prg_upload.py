@@ -0,0 +1,45 @@
+#! /usr/bin/env python
+'''prg_upload.py against the simulator: python -m pytest test_prg_upload.py'''
+
+import os
+
+import pytest
+
+import StepMotor
+import gt6_sim
+import prg_upload
+
+PRG = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'OS22B-SNFLY.prg')
+
+
+@pytest.fixture
+def sim():
+    with gt6_sim.GT6Simulator(time_scale=10) as sim:
+        yield sim
+
+
+@pytest.fixture
+def motor(sim):
+    motor = StepMotor.StepMotor(sim.device, journal=False)
+    motor.send_cmd('ECHO0')
+    yield motor
+    motor.close()
+
+
+def test_verify_is_idempotent(sim, motor):
+    '''Once uploaded, --verify finds nothing to send again, also with the
+    bit patterns reported the way the controller does.'''
+    assert prg_upload.upload_script(motor, PRG)
+    sim.nv['INLVL'] = '1100_0000'
+    sim.nv['OUTLVL'] = '0000_000'
+    assert prg_upload.readback(motor, StepMotor.read_script(PRG)) == []
+    assert not prg_upload.upload_script(motor, PRG, verify=True)
+
+
+def test_verify_finds_changed_bits(sim, motor):
+    prg_upload.upload_script(motor, PRG)
+    sim.nv['INLVL'] = '1000_0000'
+    differ = prg_upload.readback(motor, StepMotor.read_script(PRG))
+    assert [cmd for cmd, _ in differ] == ['INLVL 11000000']
+    assert prg_upload.upload_script(motor, PRG, verify=True)
+# vim:expandtab:sw=4:ts=4
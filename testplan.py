@@ -0,0 +1,386 @@
+#! /usr/bin/env python
+'''Run a test described in a plan file.
+
+A plan is a JSON or YAML file with some drive settings and a list of
+steps:
+
+    velocity: 5
+    accel: 10
+    limits: false
+    steps:
+      - home
+      - goto: 90
+      - dwell: 2
+      - loop:
+          count: 100000
+          steps:
+            - move: 15
+            - dwell: 1
+            - move: -15
+      - velocity: 1
+      - scan: {degrees: 360, output: scan.csv}
+
+Steps: move (relative degrees), goto (absolute degrees), home, dwell
+(seconds), velocity and accel (new drive settings), scan (see
+StepMotor.Scan(), keys degrees, velocity, interval, output) and loop
+(count times the steps in it; loops nest).
+
+Loops are expanded as they run, so a plan of millions of moves takes no
+more memory than its text. For plans that really are that long, a .jsonl
+file with one step per line is read a line at a time.
+
+Progress is saved to a checkpoint file: the index of the next step, the
+table position the plan expects at that point and the drive settings. If a
+run is interrupted, --resume goes back to that position and carries on
+from that step:
+
+    python testplan.py overnight.yaml
+    python testplan.py overnight.yaml --resume
+'''
+
+import os
+import sys
+import json
+import hashlib
+import argparse
+import logging
+
+import StepMotor
+
+logger = logging.getLogger(__name__)
+
+STEP_KINDS = ('move', 'goto', 'home', 'dwell', 'velocity', 'accel', 'scan', 'loop')
+SCAN_KEYS = ('degrees', 'velocity', 'interval', 'output')
+
+
+class PlanError(ValueError): pass
+
+
+#==============================================================================
+# Plan files:
+#==============================================================================
+def file_digest(fname):
+    h = hashlib.sha256()
+    with open(fname, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 16), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def _jsonl_steps(fname, header_lines):
+    '''Steps of a .jsonl plan, read lazily: every line after the header.'''
+    with open(fname) as f:
+        for lineno, line in enumerate(f, 1):
+            if lineno <= header_lines or not line.strip() or line.lstrip().startswith('#'):
+                continue
+            try:
+                yield json.loads(line)
+            except ValueError as exc:
+                raise PlanError(f'{fname}:{lineno}: {exc}')
+
+
+def load_plan(fname):
+    '''Read a plan: a dict with the drive settings and 'steps'.
+
+    .yaml/.yml files need PyYAML, .json files are read in one go. In a
+    .jsonl file the first line may hold the settings, as in
+    {"plan": {"velocity": 5}}; every other line is one step, and 'steps'
+    is an iterator that reads them as it goes.
+    '''
+    ext = os.path.splitext(fname)[1].lower()
+    if ext == '.jsonl':
+        with open(fname) as f:
+            first = f.readline()
+        try:
+            header = json.loads(first)
+        except ValueError:
+            header = None
+        if isinstance(header, dict) and list(header) == ['plan']:
+            return dict(header['plan'], steps=_jsonl_steps(fname, 1))
+        return {'steps': _jsonl_steps(fname, 0)}
+    with open(fname) as f:
+        if ext in ('.yaml', '.yml'):
+            try:
+                import yaml
+            except ImportError:
+                raise PlanError(f'{fname}: YAML plans need PyYAML (pip install pyyaml)')
+            plan = yaml.safe_load(f)
+        else:
+            plan = json.load(f)
+    if isinstance(plan, list):
+        plan = {'steps': plan}
+    if not isinstance(plan, dict) or 'steps' not in plan:
+        raise PlanError(f'{fname}: no steps')
+    validate(plan['steps'])
+    return plan
+
+
+def parse_step(step):
+    '''(kind, value) of one step: 'home' or a single key dict.'''
+    if isinstance(step, str):
+        step = {step: None}
+    if not isinstance(step, dict) or len(step) != 1:
+        raise PlanError(f'Bad step {step!r}: expected one of {", ".join(STEP_KINDS)}')
+    (kind, value), = step.items()
+    if kind not in STEP_KINDS:
+        raise PlanError(f'Unknown step {kind!r}')
+    if kind in ('move', 'goto', 'dwell', 'velocity', 'accel'):
+        if not isinstance(value, (int, float)) or isinstance(value, bool):
+            raise PlanError(f'{kind}: expected a number, got {value!r}')
+        if kind != 'move' and kind != 'goto' and value < 0:
+            raise PlanError(f'{kind}: must not be negative')
+    elif kind == 'scan':
+        value = value or {}
+        if not isinstance(value, dict) or set(value) - set(SCAN_KEYS):
+            raise PlanError(f'scan: expected keys from {", ".join(SCAN_KEYS)}')
+    elif kind == 'loop':
+        if (not isinstance(value, dict) or not isinstance(value.get('count'), int)
+                or value['count'] < 0 or not isinstance(value.get('steps'), list)):
+            raise PlanError('loop: expected count (>= 0) and steps')
+    return kind, value
+
+
+def validate(steps):
+    '''Check every step of a plan (loop bodies once, not count times).'''
+    for step in steps:
+        kind, value = parse_step(step)
+        if kind == 'loop':
+            validate(value['steps'])
+
+
+def count_steps(steps):
+    '''Number of steps the plan runs, loops expanded.'''
+    total = 0
+    for step in steps:
+        kind, value = parse_step(step)
+        if kind == 'loop':
+            total += value['count'] * count_steps(value['steps'])
+        else:
+            total += 1
+    return total
+
+
+def iter_steps(steps, start=0):
+    '''Yield the (kind, value) of the steps to run, loops expanded as they
+    come, skipping the first start of them. Whole loop passes are skipped
+    by counting rather than by running through them.'''
+    for step in steps:
+        kind, value = parse_step(step)
+        if kind != 'loop':
+            if start > 0:
+                start -= 1
+            else:
+                yield kind, value
+            continue
+        body = value['steps']
+        if start > 0:
+            per_pass = count_steps(body)
+            skip = min(value['count'], start // per_pass) if per_pass else value['count']
+            start -= skip * per_pass
+            passes = value['count'] - skip
+        else:
+            passes = value['count']
+        for _ in range(passes):
+            sub = iter_steps(body, start)
+            start = 0
+            yield from sub
+
+
+#==============================================================================
+# PlanRunner:
+#==============================================================================
+class PlanRunner(object):
+    '''Runs a plan on a StepMotor, saving progress to checkpoint (a file
+    name, or None for no checkpoints) at most every checkpoint_interval
+    seconds, and after the last step.
+
+    on_step(index, kind, value) is called before each step. Dwells (sleep,
+    default motor.clock.sleep) and the checkpoint times follow motor.clock,
+    so a plan run on a replay takes no real time (see clock.py).
+    '''
+    def __init__(self, motor, plan, checkpoint=None, checkpoint_interval=1.0,
+                 digest=None, on_step=None, sleep=None):
+        self.motor = motor
+        self.plan = plan
+        self.checkpoint = checkpoint
+        self.checkpoint_interval = checkpoint_interval
+        self.digest = digest
+        self.on_step = on_step
+        self.sleep = sleep or motor.clock.sleep
+        self.index = 0                  # Next step to run
+        self.position = 0.0             # Where the plan has the table, degrees
+        self.velocity = plan.get('velocity', 5)
+        self.accel = plan.get('accel', 10)
+        self._saved = 0.0
+
+    def load_checkpoint(self):
+        '''Pick up where the checkpoint says the run stopped. Returns the
+        checkpoint, or None if there isn't one.'''
+        try:
+            with open(self.checkpoint) as f:
+                state = json.load(f)
+        except FileNotFoundError:
+            return None
+        if self.digest and state.get('sha256') not in (None, self.digest):
+            raise PlanError(f'{self.checkpoint} belongs to a different version of the plan')
+        self.index = state['index']
+        self.position = state['position']
+        self.velocity = state['velocity']
+        self.accel = state['accel']
+        return state
+
+    def save_checkpoint(self, done=False):
+        if not self.checkpoint:
+            return
+        state = {
+            'index': self.index,
+            'position': self.position,
+            'velocity': self.velocity,
+            'accel': self.accel,
+            'done': done,
+            'sha256': self.digest,
+            'time': self.motor.clock.now().isoformat(timespec='seconds'),
+        }
+        tmp = self.checkpoint + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(state, f)
+        os.replace(tmp, self.checkpoint)
+        self._saved = self.motor.clock.monotonic()
+
+    def run(self, resume=False, home_first=False):
+        '''Run the plan, or with resume=True, the rest of it. Returns the
+        number of steps run.'''
+        motor = self.motor
+        state = self.load_checkpoint() if resume and self.checkpoint else None
+        if state and state.get('done'):
+            logger.info('Plan already finished')
+            return 0
+        motor.InitializeDrive(self.plan.get('limits', False), self.velocity, self.accel)
+        if home_first:
+            motor.GoHome()
+        if state:
+            logger.info(f'Resuming at step {self.index}, position {self.position}')
+            motor.GoToDegrees(self.position)
+        else:
+            tpc, _, _ = motor.ReadPosition()
+            if tpc is not None:
+                self.position = tpc * 360 / motor.steps_per_rotation
+
+        start = self.index
+        try:
+            for kind, value in iter_steps(self.plan['steps'], self.index):
+                if self.on_step:
+                    self.on_step(self.index, kind, value)
+                self.run_step(kind, value)
+                self.index += 1
+                if motor.clock.monotonic() - self._saved >= self.checkpoint_interval:
+                    self.save_checkpoint()
+        except BaseException:
+            # Interrupted or failed: the step at index didn't (fully) happen.
+            self.save_checkpoint()
+            raise
+        self.save_checkpoint(done=True)
+        return self.index - start
+
+    def run_step(self, kind, value):
+        motor = self.motor
+        if kind == 'move':
+            motor.MoveDegrees(value)
+            self.position += value
+        elif kind == 'goto':
+            motor.GoToDegrees(value)
+            self.position = value
+        elif kind == 'home':
+            motor.GoHome()
+            self.position = 0.0
+        elif kind == 'dwell':
+            self.sleep(value)
+        elif kind == 'velocity':
+            motor.send_batch([f'V{value}'], elide=True)
+            self.velocity = value
+        elif kind == 'accel':
+            motor.send_batch([f'A{value}', f'AD{value}'], elide=True)
+            self.accel = value
+        elif kind == 'scan':
+            deg = value.get('degrees', 360)
+            track = motor.Scan(deg, value.get('velocity', self.velocity),
+                               value.get('interval', 0.05))
+            self.position += deg
+            if value.get('output'):
+                track.save(value['output'].format(index=self.index))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+          description="Run a test plan file.",
+          formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+          )
+    parser.add_argument("plan",
+                        help="Plan file (.json, .yaml or .jsonl)",
+                        )
+    parser.add_argument("--resume",
+                        action='store_true',
+                        help="Carry on from the checkpoint of an interrupted run",
+                        )
+    parser.add_argument("--home",
+                        action='store_true',
+                        help="Home before anything else, e.g. to resume after a power cycle",
+                        )
+    parser.add_argument("--checkpoint",
+                        default=None,
+                        help="Checkpoint file. Default: the plan file name + .checkpoint",
+                        )
+    parser.add_argument("--count",
+                        action='store_true',
+                        help="Just check the plan and print how many steps it has",
+                        )
+    parser.add_argument("--port",
+                        default=None,
+                        help="Serial port of the controller. Default: search for it",
+                        )
+    parser.add_argument("--dryrun",
+                        action=argparse.BooleanOptionalAction,
+                        default=False,
+                        help="Don't do anything. Just log the would be movements",
+                        )
+    parser.add_argument(
+        "--verbose", "-v",
+        action='count',
+        default=0,
+        help="use multiple -v for more detailed messages."
+    )
+    args = parser.parse_args()
+    logging.basicConfig(
+          format='%(levelname)-8s [%(filename)s:%(lineno)d] %(message)s',
+          level=logging.WARNING - (10 * args.verbose),
+          )
+
+    try:
+        plan = load_plan(args.plan)
+        if args.count:
+            print(count_steps(plan['steps']))
+            return
+    except (OSError, PlanError) as exc:
+        sys.exit(str(exc))
+
+    motor = StepMotor.StepMotor('dryrun' if args.dryrun else args.port)
+    runner = PlanRunner(
+        motor, plan,
+        checkpoint=args.checkpoint or args.plan + '.checkpoint',
+        digest=file_digest(args.plan),
+        on_step=lambda i, kind, value: logger.info(f'{i}: {kind} {value if value is not None else ""}'),
+    )
+    try:
+        n = runner.run(resume=args.resume, home_first=args.home)
+        print(f'Done: {n} steps')
+    except KeyboardInterrupt:
+        print(f'Interrupted before step {runner.index}; run again with --resume')
+    except PlanError as exc:
+        sys.exit(str(exc))
+    finally:
+        motor.close()
+
+
+if __name__ == '__main__':
+    main()
+# vim:expandtab:sw=4:ts=4